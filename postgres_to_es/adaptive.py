@@ -0,0 +1,73 @@
+import threading
+import time
+from typing import Optional
+
+from metrics import ADAPTIVE_BATCH_SIZE
+
+
+class AdaptiveBatchSize:
+    """
+    Batch size tuned by the measured cost of the requests made with it.
+
+    Every observation gives the cost of one item, and so the size which
+    would take `target_seconds` per request and, if set, `target_bytes`
+    per request body. A slower request shrinks the size at once, at most
+    by half. A faster one grows it halfway to that size, at most twice,
+    and only if the batch was full: a short batch says nothing about
+    larger ones. Elastic rejecting requests halves the size and stops
+    the growth for `cooldown` seconds.
+    """
+
+    def __init__(self,
+                 name: str,
+                 initial: int,
+                 minimum: int,
+                 maximum: int,
+                 target_seconds: float,
+                 target_bytes: Optional[int] = None,
+                 cooldown: float = 5):
+        self.name = name
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_seconds = target_seconds
+        self.target_bytes = target_bytes
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._size = self._clamp(initial)
+        self._grow_after = 0.0
+        ADAPTIVE_BATCH_SIZE.labels(name).set(self._size)
+
+    @property
+    def value(self) -> int:
+        return self._size
+
+    def observe(self, count: int, seconds: float, size_bytes: int = 0) -> None:
+        if count <= 0:
+            return
+
+        fitting = self.target_seconds * count / max(seconds, 1e-6)
+        if self.target_bytes and size_bytes:
+            fitting = min(fitting, self.target_bytes * count / size_bytes)
+
+        with self._lock:
+            if fitting < self._size:
+                size = max(fitting, self._size / 2)
+            elif count >= self._size and time.monotonic() >= self._grow_after:
+                size = min(self._size + (fitting - self._size) / 2,
+                           self._size * 2)
+            else:
+                return
+            self._set(size)
+
+    def reject(self) -> None:
+        """Elastic is overloaded: backs off."""
+        with self._lock:
+            self._grow_after = time.monotonic() + self.cooldown
+            self._set(self._size / 2)
+
+    def _set(self, size: float) -> None:
+        self._size = self._clamp(size)
+        ADAPTIVE_BATCH_SIZE.labels(self.name).set(self._size)
+
+    def _clamp(self, size: float) -> int:
+        return max(self.minimum, min(self.maximum, int(size)))
@@ -0,0 +1,383 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+from datetime import datetime
+from typing import Optional
+
+import asyncpg  # type: ignore
+from adaptive import AdaptiveBatchSize
+from backoff import backoff
+from config import (ES_BULK_CHUNK_SIZE, ES_BULK_MAX_BYTES, ES_BULK_MAX_RETRIES,
+                    ES_HTTP_COMPRESS, ES_INDEX, ES_POOL_SIZE, ETL_TRANSFORM,
+                    dsn, es_node)
+from elasticsearch import AsyncElasticsearch
+from elasticsearch.helpers import async_streaming_bulk
+from es_loader import (Document, elastic_breaker, expand_document,
+                       park_rejected, transform_pg_to_es, wrap_pg_documents)
+from fingerprint import FingerprintCache
+from metrics import DOCUMENTS, count_rows, timed
+from pg_extractor import (DocumentRow, FilmWorkRow, Statement,
+                          entity_ids_query, entity_position,
+                          query_film_work_documents, query_film_work_ids,
+                          query_film_works, set_entity_state)
+from psycopg2 import sql  # type: ignore
+from state import State
+
+log = logging.getLogger('AsyncPipeline')
+
+
+def as_text(query: sql.Composable) -> str:
+    """
+    Renders a query of `pg_extractor` without a psycopg2 connection.
+    They are built from plain SQL and identifiers only, and their `$1`
+    parameters are what asyncpg binds.
+    """
+    if isinstance(query, sql.Composed):
+        return ''.join(as_text(part) for part in query.seq)
+    if isinstance(query, sql.Identifier):
+        return '.'.join('"' + name.replace('"', '""') + '"'
+                        for name in query.strings)
+    return query.string
+
+
+async def init_connection(conn: asyncpg.Connection) -> None:
+    """
+    Decodes uuids to strings and json to Python objects, as psycopg2 does,
+    so the rows fit `transform_pg_to_es`.
+    """
+    await conn.set_type_codec('uuid', encoder=str, decoder=str,
+                              schema='pg_catalog', format='text')
+    await conn.set_type_codec('json', encoder=json.dumps, decoder=json.loads,
+                              schema='pg_catalog', format='text')
+
+
+@backoff()
+async def create_pg_pool(size: int) -> asyncpg.Pool:
+    """
+    asyncpg prepares every query once per connection on its own.
+    """
+    return await asyncpg.create_pool(
+        database=dsn['dbname'], user=dsn['user'], password=dsn['password'],
+        host=dsn['host'], port=dsn['port'],
+        server_settings={'search_path': 'content'},
+        min_size=size, max_size=size, init=init_connection,
+    )
+
+
+def create_es_client() -> AsyncElasticsearch:
+    # Unlike urllib3, the aiohttp connection takes only an integer port
+    node = {**es_node, 'port': int(es_node['port'] or 9200)}
+    return AsyncElasticsearch([node], maxsize=ES_POOL_SIZE,
+                              retry_on_timeout=True,
+                              http_compress=ES_HTTP_COMPRESS)
+
+
+@backoff()
+async def fetch(pg_pool: asyncpg.Pool,
+                statement: Statement,
+                *params) -> list[asyncpg.Record]:
+    return await pg_pool.fetch(as_text(statement.query), *params)
+
+
+@backoff(breaker=elastic_breaker)
+async def send_bulk(es_client: AsyncElasticsearch,
+                    documents: list[Document]) -> list[dict]:
+    """
+    Items rejected with 429 are sent again by the bulk helper. Returns
+    the results of the items that failed for good.
+    """
+    failed = []
+    async for ok, result in async_streaming_bulk(
+            es_client,
+            documents,
+            expand_action_callback=expand_document,
+            chunk_size=ES_BULK_CHUNK_SIZE,
+            max_chunk_bytes=ES_BULK_MAX_BYTES,
+            max_retries=ES_BULK_MAX_RETRIES,
+            raise_on_error=False):
+        # Deleting a document which isn't in the index is fine
+        if not ok and result.get('delete', {}).get('status') != 404:
+            log.error(f'{datetime.now()} Failed to save document: {result}')
+            failed.append(result)
+    return failed
+
+
+class AsyncBatch:
+    """
+    The `Batch` of the scheduler for coroutines: the producer waits until
+    every id of it is loaded before it moves the checkpoint.
+    """
+
+    def __init__(self):
+        self._loaded = asyncio.Event()
+        self._pending = 0
+        self._sealed = False
+        self.failed = False
+
+    def add(self, count: int) -> None:
+        self._pending += count
+
+    def done(self, count: int, failed: bool = False) -> None:
+        self._pending -= count
+        self.failed = self.failed or failed
+        self._notify()
+
+    def seal(self) -> None:
+        self._sealed = True
+        self._notify()
+
+    async def wait(self) -> None:
+        await self._loaded.wait()
+
+    def _notify(self) -> None:
+        if self._sealed and self._pending == 0:
+            self._loaded.set()
+
+
+class AsyncPipeline:
+    """
+    Loads film_works with asyncpg and the async Elastic client. Chunks of
+    film_work ids pass two stages, linked by bounded queues: extractors
+    enrich them in Postgres and transform them, loaders send the documents
+    to Elastic. While a loader waits for one bulk request, the extractors
+    already read the next chunks; a full queue holds back the stage
+    before it.
+    """
+
+    def __init__(self,
+                 pg_pool: asyncpg.Pool,
+                 es_client: AsyncElasticsearch,
+                 chunk_size: AdaptiveBatchSize,
+                 workers: int,
+                 queue_size: int,
+                 index: str = ES_INDEX,
+                 fingerprints: Optional[FingerprintCache] = None):
+        self.pg_pool = pg_pool
+        self.es_client = es_client
+        self.chunk_size = chunk_size
+        self.index = index
+        self.fingerprints = fingerprints
+        self.ids_queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.documents_queue: asyncio.Queue = asyncio.Queue(
+            maxsize=queue_size)
+        self.tasks = [asyncio.create_task(self.extract())
+                      for _ in range(workers)]
+        self.tasks += [asyncio.create_task(self.load())
+                       for _ in range(workers)]
+
+    async def submit(self, film_work_ids: list[str],
+                     batch: AsyncBatch) -> None:
+        """
+        Splits the ids into chunks of the current size and queues them.
+        Waits while the queue is full.
+        """
+        size = self.chunk_size.value
+        for start in range(0, len(film_work_ids), size):
+            chunk = film_work_ids[start:start + size]
+            batch.add(len(chunk))
+            await self.ids_queue.put((chunk, batch))
+
+    async def join(self) -> None:
+        await self.ids_queue.join()
+        await self.documents_queue.join()
+
+    async def close(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def extract(self) -> None:
+        while True:
+            film_work_ids, batch = await self.ids_queue.get()
+            try:
+                documents = await self.extract_documents(film_work_ids)
+                await self.documents_queue.put(
+                    (documents, len(film_work_ids), batch))
+            except Exception as err:
+                log.error(f'{datetime.now()} Failed while extracting '
+                          f'film_works.\n{err}\n\n')
+                batch.done(len(film_work_ids), failed=True)
+            finally:
+                self.ids_queue.task_done()
+
+    async def extract_documents(self,
+                                film_work_ids: list[str]) -> list[Document]:
+        """
+        Documents of the given film_works, shaped as `ETL_TRANSFORM` says.
+        The ids Postgres doesn't return are deleted from the index,
+        the rows parked by the transform aren't.
+        """
+        if ETL_TRANSFORM == 'sql':
+            with timed('film_work_documents'):
+                records = await fetch(self.pg_pool,
+                                      query_film_work_documents(),
+                                      film_work_ids)
+            count_rows('film_work_documents', len(records))
+            documents = wrap_pg_documents(
+                list(map(DocumentRow._make, records)), self.index)
+        else:
+            with timed('film_works'):
+                records = await fetch(self.pg_pool, query_film_works(),
+                                      film_work_ids)
+            count_rows('film_works', len(records))
+            documents = transform_pg_to_es(
+                list(map(FilmWorkRow._make, records)), self.index)
+
+        missing_ids = dict.fromkeys(film_work_ids)
+        for record in records:
+            missing_ids.pop(record['id'], None)
+        return documents + [Document(self.index, film_work_id, None)
+                            for film_work_id in missing_ids]
+
+    async def load(self) -> None:
+        while True:
+            documents, count, batch = await self.documents_queue.get()
+            try:
+                await self.save(documents)
+                batch.done(count)
+            except Exception as err:
+                log.error(f'{datetime.now()} Failed while saving '
+                          f'to ElasticSearch.\n{err}\n\n')
+                batch.done(count, failed=True)
+            finally:
+                self.documents_queue.task_done()
+
+    async def save(self, documents: list[Document]) -> None:
+        """
+        Documents rejected by Elastic are parked in the dead letters. Only
+        the fingerprints of the saved documents are stored. SQLite and
+        the dead letters file are used from a thread: they block.
+        """
+        if self.fingerprints:
+            documents = await asyncio.to_thread(self.fingerprints.changed,
+                                                documents)
+            if not documents:
+                return
+
+        started = time.perf_counter()
+        with timed('save'):
+            failed = await send_bulk(self.es_client, documents)
+
+        deleted = sum(document.source is None for document in documents)
+        DOCUMENTS.labels('indexed').inc(
+            len(documents) - deleted - len(failed))
+        DOCUMENTS.labels('deleted').inc(deleted)
+        DOCUMENTS.labels('failed').inc(len(failed))
+        self.chunk_size.observe(
+            len(documents), time.perf_counter() - started,
+            sum(len(document.source or '') for document in documents))
+        parked = await asyncio.to_thread(park_rejected, documents, failed) \
+            if failed else set()
+        if self.fingerprints:
+            await asyncio.to_thread(
+                self.fingerprints.remember,
+                [document for document in documents
+                 if document.id not in parked])
+
+
+async def produce(table_name: str,
+                  pipeline: AsyncPipeline,
+                  state: State,
+                  poll_interval: float,
+                  batch_size: AdaptiveBatchSize) -> None:
+    """
+    Polls one entity table and submits the affected film_works to the
+    pipeline. The checkpoint moves once every film_work of the batch
+    is loaded; a failed batch is extracted again on the next poll.
+    """
+    while True:
+        if elastic_breaker.is_open:
+            await asyncio.sleep(1)
+            continue
+        try:
+            log.info(f'Exporting {table_name}...\n')
+            await export(table_name, pipeline, state, batch_size)
+        except Exception as err:
+            log.error(f'{datetime.now()} Failed while exporting '
+                      f'{table_name}.\n{err}\n\n')
+        await asyncio.sleep(poll_interval)
+
+
+async def export(table_name: str,
+                 pipeline: AsyncPipeline,
+                 state: State,
+                 batch_size: AdaptiveBatchSize) -> None:
+    while True:
+        saved = state.get_state(table_name)
+        last_modified, last_id = entity_position(saved)
+        started = time.perf_counter()
+        with timed('entity_ids'):
+            entity_records = await fetch(
+                pipeline.pg_pool, entity_ids_query(table_name),
+                datetime.fromisoformat(last_modified), last_id,
+                batch_size.value)
+        batch_size.observe(len(entity_records),
+                           time.perf_counter() - started)
+        if not entity_records:
+            log.info(f'No modifications found in {table_name}.')
+            return
+        count_rows('entity_ids', len(entity_records))
+
+        entity_ids = [record['id'] for record in entity_records]
+        if table_name == 'film_work':
+            film_work_ids = entity_ids
+        else:
+            with timed('film_work_ids'):
+                film_work_ids = [
+                    record['id'] for record in await fetch(
+                        pipeline.pg_pool, query_film_work_ids(table_name),
+                        entity_ids)]
+            count_rows('film_work_ids', len(film_work_ids))
+
+        batch = AsyncBatch()
+        await pipeline.submit(film_work_ids, batch)
+        batch.seal()
+        await batch.wait()
+        if batch.failed:
+            raise Exception(f'Failed to load a batch of '
+                            f'{table_name} changes.')
+
+        set_entity_state(state, table_name, entity_records[-1], saved)
+
+
+async def run_async(table_names: list[str],
+                    state: State,
+                    stop_event: threading.Event,
+                    poll_interval: float,
+                    pg_pool_size: int,
+                    workers: int,
+                    queue_size: int,
+                    chunk_size: AdaptiveBatchSize,
+                    batch_sizes: dict[str, AdaptiveBatchSize],
+                    flush_interval: float,
+                    fingerprints: Optional[FingerprintCache] = None) -> None:
+    """
+    Runs a producer per table and the pipeline until `stop_event` is set,
+    flushing the checkpoints every `flush_interval` seconds.
+    """
+    pg_pool = await create_pg_pool(pg_pool_size)
+    es_client = create_es_client()
+    pipeline = AsyncPipeline(pg_pool, es_client, chunk_size, workers,
+                             queue_size, fingerprints=fingerprints)
+    producers = [
+        asyncio.create_task(produce(table_name, pipeline, state,
+                                    poll_interval, batch_sizes[table_name]))
+        for table_name in table_names
+    ]
+    try:
+        flushed = time.monotonic()
+        while not stop_event.is_set():
+            await asyncio.sleep(0.1)
+            if time.monotonic() - flushed >= flush_interval:
+                state.flush()
+                flushed = time.monotonic()
+    finally:
+        for producer in producers:
+            producer.cancel()
+        await asyncio.gather(*producers, return_exceptions=True)
+        await pipeline.close()
+        await es_client.close()
+        await pg_pool.close()
+        state.flush()
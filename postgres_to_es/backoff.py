@@ -1,50 +1,260 @@
+import asyncio
+import inspect
 import logging
+import random
+import threading
+import time
 from functools import wraps
 from time import sleep
-from typing import Callable
+from typing import Callable, Optional
+
+import asyncpg  # type: ignore
+import psycopg2  # type: ignore
+from elasticsearch import ConnectionError as ElasticConnectionError
+from elasticsearch import TransportError
+from metrics import CIRCUIT_OPEN, RETRIES
+from psycopg2.pool import PoolError  # type: ignore
+
+# Statuses of Elastic responses worth repeating: overloaded or restarting
+TRANSIENT_STATUSES = {429, 502, 503, 504}
+
+# Errors which may pass by themselves: lost connections and timeouts,
+# an exhausted pool, a serialization failure or a deadlock in Postgres
+TRANSIENT_ERRORS = (
+    ConnectionError,
+    TimeoutError,
+    asyncio.TimeoutError,
+    ElasticConnectionError,
+    psycopg2.OperationalError,
+    PoolError,
+    asyncpg.PostgresConnectionError,
+    asyncpg.CannotConnectNowError,
+    asyncpg.TooManyConnectionsError,
+    asyncpg.SerializationError,
+    asyncpg.DeadlockDetectedError,
+)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+def is_transient(error: Exception) -> bool:
+    """
+    Transient errors are retried, the others are raised at once: repeating
+    a bug or a rejected request gives the same result.
+    """
+    if isinstance(error, CircuitOpenError):
+        return True
+    if isinstance(error, TRANSIENT_ERRORS):
+        return True
+    if isinstance(error, TransportError):
+        return error.status_code in TRANSIENT_STATUSES
+    # psycopg2.InterfaceError is left out: a closed connection doesn't
+    # come back, the caller has to take another one.
+    return False
+
+
+class CircuitBreaker:
+    """
+    Stops calling a service which keeps failing. After `failure_threshold`
+    transient failures in a row the circuit opens: for `reset_timeout`
+    seconds calls fail at once with `CircuitOpenError`. Then one trial call
+    is let through: its success closes the circuit, its failure opens it
+    again.
+
+    Shared by every thread, so when Elastic is down the producers can
+    pause until it's back instead of feeding each worker's retry loop.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5,
+                 reset_timeout: float = 30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial = False
+        CIRCUIT_OPEN.labels(name).set(0)
+
+    @property
+    def is_open(self) -> bool:
+        """
+        Open until the reset timeout passes and a trial call may be made.
+        """
+        with self._lock:
+            return self._opened_at is not None and \
+                time.monotonic() - self._opened_at < self.reset_timeout
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._trial \
+                    or time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            self._trial = True
+            return True
+
+    def record(self, error: Optional[Exception] = None) -> None:
+        """
+        Only transient errors count as failures: any other answer means
+        the service is up.
+        """
+        with self._lock:
+            if error is None or not is_transient(error):
+                if self._opened_at is not None:
+                    logging.warning(f'Circuit {self.name} is closed.')
+                self._failures = 0
+                self._opened_at = None
+                self._trial = False
+                CIRCUIT_OPEN.labels(self.name).set(0)
+                return
+
+            self._failures += 1
+            if self._trial or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    logging.warning(f'Circuit {self.name} is open after '
+                                    f'{self._failures} failures: {error}')
+                self._opened_at = time.monotonic()
+                self._trial = False
+                CIRCUIT_OPEN.labels(self.name).set(1)
+
+
+class Retry:
+    """
+    Attempts of one call. Sleeps grow exponentially up to `border`, each
+    drawn at random below that bound ("full jitter"), so clients failed
+    together don't retry together.
+    """
+
+    def __init__(self, start: float, factor: float, border: float,
+                 deadline: float):
+        self.start = start
+        self.factor = factor
+        self.border = border
+        self.deadline = time.monotonic() + deadline
+        self.attempt = 0
+
+    def next_sleep(self, func_name: str, error: Exception) -> Optional[float]:
+        """
+        Returns `None` when the error has to be raised: it's permanent
+        or the next attempt would start after the deadline.
+        """
+        if not is_transient(error):
+            return None
+        bound = min(self.start * self.factor ** self.attempt, self.border)
+        sleep_time = random.uniform(0, bound)
+        if time.monotonic() + sleep_time > self.deadline:
+            return None
+        self.attempt += 1
+        logging.warning(f'{error!r}. Slept for {sleep_time:.2f}.')
+        RETRIES.labels(func_name).inc()
+        return sleep_time
+
+
+def check(breaker: Optional[CircuitBreaker]) -> None:
+    if breaker and not breaker.allow():
+        raise CircuitOpenError(f'Circuit {breaker.name} is open')
+
+
+def record(breaker: Optional[CircuitBreaker],
+           error: Optional[Exception] = None) -> None:
+    if breaker and not isinstance(error, CircuitOpenError):
+        breaker.record(error)
 
 
 def backoff(start_sleep_time: float = 0.1,
             factor: int = 2,
-            border_sleep_time: int = 10) -> Callable:
+            border_sleep_time: int = 10,
+            deadline: float = 300,
+            breaker: Optional[CircuitBreaker] = None) -> Callable:
     """
     Функция для повторного выполнения функции через некоторое время, если
-    возникла ошибка. Использует наивный экспоненциальный рост времени повтора
-    (factor) до граничного времени ожидания (border_sleep_time).
+    возникла временная ошибка (см. `is_transient`). Остальные ошибки
+    пробрасываются сразу. Время ожидания растёт экспоненциально (factor)
+    до граничного (border_sleep_time), а сама пауза выбирается случайно
+    от нуля до этой границы (full jitter).
 
     Формула:
-        t = start_sleep_time * 2^(n) if t < border_sleep_time
-        t = border_sleep_time if t >= border_sleep_time
+        t = random(0, min(start_sleep_time * factor^n, border_sleep_time))
+
+    Подходит для обычных функций, корутин и генераторов. Генератор
+    перезапускается, только пока он ничего не отдал: отданные элементы
+    вернуть нельзя, поэтому дальше ошибка пробрасывается.
+
+    С `breaker` вызовы не делаются, пока цепь разомкнута, а временные
+    ошибки размыкают её.
     :param start_sleep_time: начальное время повтора
     :param factor: во сколько раз нужно увеличить время ожидания
     :param border_sleep_time: граничное время ожидания
+    :param deadline: сколько секунд всего можно повторять вызов
+    :param breaker: общий для вызовов сервиса `CircuitBreaker`
     :return: результат выполнения функции
     """
 
+    def new_retry() -> Retry:
+        return Retry(start_sleep_time, factor, border_sleep_time, deadline)
+
     def func_wrapper(func: Callable) -> Callable:
-        @wraps(func)
-        def inner(*args, **kwargs) -> Callable:
-            sleep_time = start_sleep_time
-            n = 1
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_inner(*args, **kwargs):
+                retry = new_retry()
+                while True:
+                    try:
+                        check(breaker)
+                        result = await func(*args, **kwargs)
+                        record(breaker)
+                        return result
+                    except Exception as error:
+                        record(breaker, error)
+                        sleep_time = retry.next_sleep(func.__name__, error)
+                        if sleep_time is None:
+                            raise
+                    await asyncio.sleep(sleep_time)
+
+            return async_inner
+
+        if inspect.isgeneratorfunction(func):
+            @wraps(func)
+            def generator_inner(*args, **kwargs):
+                retry = new_retry()
+                while True:
+                    started = False
+                    try:
+                        check(breaker)
+                        for item in func(*args, **kwargs):
+                            started = True
+                            yield item
+                        record(breaker)
+                        return
+                    except Exception as error:
+                        record(breaker, error)
+                        sleep_time = None if started \
+                            else retry.next_sleep(func.__name__, error)
+                        if sleep_time is None:
+                            raise
+                    sleep(sleep_time)
 
+            return generator_inner
+
+        @wraps(func)
+        def inner(*args, **kwargs):
+            retry = new_retry()
             while True:
                 try:
-                    return func(*args, **kwargs)
+                    check(breaker)
+                    result = func(*args, **kwargs)
+                    record(breaker)
+                    return result
                 except Exception as error:
-                    logging.warning(f'{error}. Slept for {sleep_time}.')
-
-                    if sleep_time < border_sleep_time:
-                        sleep_time = min(start_sleep_time * (factor ** n),
-                                         border_sleep_time)
-                    else:
-                        sleep_time = border_sleep_time
-
-                    sleep(sleep_time)
-                    n += 1
-                    continue
-                finally:
-                    if n >= 500:
-                        raise Exception(f'Too many attempts ({n})!')
+                    record(breaker, error)
+                    sleep_time = retry.next_sleep(func.__name__, error)
+                    if sleep_time is None:
+                        raise
+                sleep(sleep_time)
 
         return inner
 
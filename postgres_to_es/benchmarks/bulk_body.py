@@ -0,0 +1,99 @@
+"""
+Benchmark of the bulk body: serialization time and bytes on the wire.
+
+The client path is how the Elastic client builds a body from dicts: every
+action and document is dumped by its stdlib `json` serializer and the
+lines are joined and encoded. The current path dumps the documents with
+orjson, as `transform_pg_to_es` does, and joins them into bodies in
+`iter_bulk_bodies`.
+
+Both run on the same synthetic film documents and are reported per 1000
+documents: milliseconds to serialize, body size, and the size and time
+of the gzip compression done by the client with `ES_HTTP_COMPRESS`.
+
+Run from the `postgres_to_es` directory:
+
+    python -m benchmarks.bulk_body --films 10000 --persons-per-film 50
+"""
+import argparse
+import gzip
+import io
+import json
+import time
+from typing import Callable
+
+from benchmarks.transform import generate_films
+from elasticsearch.serializer import JSONSerializer
+from es_loader import Document, dumps, iter_bulk_bodies, transform_pg_to_es
+
+INDEX = 'movies'
+CHUNK_SIZE = 500
+
+
+def client_path(documents: list[dict]) -> list[bytes]:
+    serializer = JSONSerializer()
+    bodies = []
+    for start in range(0, len(documents), CHUNK_SIZE):
+        lines = []
+        for document in documents[start:start + CHUNK_SIZE]:
+            lines.append(serializer.dumps(
+                {'index': {'_index': INDEX, '_id': document['id']}}))
+            lines.append(serializer.dumps(document))
+        bodies.append(('\n'.join(lines) + '\n').encode())
+    return bodies
+
+
+def current_path(documents: list[dict]) -> list[bytes]:
+    serialized = [Document(INDEX, document['id'], dumps(document))
+                  for document in documents]
+    return [body for body, _ in iter_bulk_bodies(serialized, CHUNK_SIZE,
+                                                 100 * 1024 * 1024)]
+
+
+def gzip_compress(body: bytes) -> bytes:
+    """
+    Compresses as the client does for `http_compress`.
+    """
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb') as f:
+        f.write(body)
+    return buffer.getvalue()
+
+
+def measure(path: Callable, documents: list[dict],
+            repeat: int) -> tuple[float, int, int, float]:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        bodies = path(documents)
+    serialize = (time.perf_counter() - started) / repeat
+
+    started = time.perf_counter()
+    compressed = sum(len(gzip_compress(body)) for body in bodies)
+    compress = time.perf_counter() - started
+    return serialize, sum(map(len, bodies)), compressed, compress
+
+
+def run(films: int, persons_per_film: int, repeat: int) -> None:
+    documents = [json.loads(document.source) for document in
+                 transform_pg_to_es(generate_films(films, persons_per_film))]
+    per_1k = 1000 / films
+
+    print(f'documents: {films}, persons per film: {persons_per_film}')
+    print(f'{"path":<10}{"ms/1k":>10}{"KiB/1k":>10}{"gzip KiB/1k":>14}'
+          f'{"gzip ms/1k":>12}')
+    for name, path in (('client', client_path), ('current', current_path)):
+        serialize, size, compressed, compress = measure(path, documents,
+                                                        repeat)
+        print(f'{name:<10}{serialize * 1000 * per_1k:>10.1f}'
+              f'{size / 1024 * per_1k:>10.1f}'
+              f'{compressed / 1024 * per_1k:>14.1f}'
+              f'{compress * 1000 * per_1k:>12.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--films', type=int, default=10_000)
+    parser.add_argument('--persons-per-film', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    run(args.films, args.persons_per_film, args.repeat)
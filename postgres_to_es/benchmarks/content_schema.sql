@@ -0,0 +1,63 @@
+-- The `content` schema of the movies database, without the data,
+-- for the synthetic catalogue of benchmarks/offline.py.
+CREATE SCHEMA IF NOT EXISTS content;
+
+CREATE TABLE content.film_work (
+    created timestamp with time zone NOT NULL,
+    modified timestamp with time zone NOT NULL,
+    id uuid NOT NULL PRIMARY KEY,
+    title character varying(255) NOT NULL,
+    description text,
+    file_path text,
+    rating double precision,
+    type character varying(128) NOT NULL,
+    creation_date date
+);
+
+CREATE TABLE content.genre (
+    created timestamp with time zone NOT NULL,
+    modified timestamp with time zone NOT NULL,
+    id uuid NOT NULL PRIMARY KEY,
+    name character varying(255) NOT NULL,
+    description text,
+    CONSTRAINT genre_name_idx UNIQUE (name)
+);
+
+CREATE TABLE content.person (
+    created timestamp with time zone NOT NULL,
+    modified timestamp with time zone NOT NULL,
+    id uuid NOT NULL PRIMARY KEY,
+    full_name character varying(255) NOT NULL
+);
+
+CREATE TABLE content.genre_film_work (
+    id uuid NOT NULL PRIMARY KEY,
+    created timestamp with time zone NOT NULL,
+    film_work_id uuid NOT NULL REFERENCES content.film_work (id)
+        DEFERRABLE INITIALLY DEFERRED,
+    genre_id uuid NOT NULL REFERENCES content.genre (id)
+        DEFERRABLE INITIALLY DEFERRED,
+    CONSTRAINT genre_film_work_idx UNIQUE (genre_id, film_work_id)
+);
+
+CREATE TABLE content.person_film_work (
+    id uuid NOT NULL PRIMARY KEY,
+    role character varying(255),
+    created timestamp with time zone NOT NULL,
+    film_work_id uuid NOT NULL REFERENCES content.film_work (id)
+        DEFERRABLE INITIALLY DEFERRED,
+    person_id uuid NOT NULL REFERENCES content.person (id)
+        DEFERRABLE INITIALLY DEFERRED,
+    CONSTRAINT film_work_person_role_idx UNIQUE (film_work_id, person_id, role)
+);
+
+CREATE INDEX film_work_creation_date_idx
+    ON content.film_work (creation_date, rating);
+CREATE INDEX genre_film_work_film_work_id_idx
+    ON content.genre_film_work (film_work_id);
+CREATE INDEX genre_film_work_genre_id_idx
+    ON content.genre_film_work (genre_id);
+CREATE INDEX person_film_work_film_work_id_idx
+    ON content.person_film_work (film_work_id);
+CREATE INDEX person_film_work_person_id_idx
+    ON content.person_film_work (person_id);
@@ -0,0 +1,79 @@
+"""
+Memory benchmark for the keyset-paginated `get_entity_ids`.
+
+Creates `content.bench_entity` with a million rows (ten rows share every
+`modified` value, so ties are exercised), walks it with `get_entity_ids`
+and reports the peak Python memory allocated per batch. The peak must stay
+flat from the first batch to the last, and every row must be read once.
+
+Run from the `postgres_to_es` directory:
+
+    python -m benchmarks.entity_ids_memory --rows 1000000
+"""
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+from pg_extractor import connect_pg, get_entity_ids
+from state import JsonFileStorage, State
+
+TABLE_NAME = 'bench_entity'
+
+
+def create_table(pg_cursor, rows: int) -> None:
+    pg_cursor.execute(f"""
+    DROP TABLE IF EXISTS content.{TABLE_NAME};
+    CREATE TABLE content.{TABLE_NAME} AS
+    SELECT gen_random_uuid() AS id,
+           now() - (i / 10) * interval '1 second' AS modified
+    FROM generate_series(1, {rows}) AS i;
+    CREATE INDEX ON content.{TABLE_NAME} (modified, id);
+    ANALYZE content.{TABLE_NAME};
+    """)
+    pg_cursor.connection.commit()
+
+
+def drop_table(pg_cursor) -> None:
+    pg_cursor.execute(f'DROP TABLE IF EXISTS content.{TABLE_NAME};')
+    pg_cursor.connection.commit()
+
+
+def run(rows: int, batch_size: int) -> None:
+    pg_cursor = connect_pg()
+    create_table(pg_cursor, rows)
+
+    state_dir = tempfile.mkdtemp()
+    state = State(JsonFileStorage(os.path.join(state_dir, 'state.json')))
+
+    batch_peaks: list[int] = []
+    seen = 0
+    started = time.perf_counter()
+    tracemalloc.start()
+    try:
+        for entity_ids in get_entity_ids(pg_cursor, state, TABLE_NAME,
+                                         batch_size=batch_size):
+            seen += len(entity_ids)
+            batch_peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+    finally:
+        tracemalloc.stop()
+        drop_table(pg_cursor)
+    elapsed = time.perf_counter() - started
+
+    tenth = max(len(batch_peaks) // 10, 1)
+    print(f'rows: {rows}, read: {seen}, batches: {len(batch_peaks)}')
+    print(f'elapsed: {elapsed:.1f}s ({seen / elapsed:.0f} rows/s)')
+    print(f'peak KiB per batch, first 10%: '
+          f'{max(batch_peaks[:tenth]) / 1024:.1f}, '
+          f'last 10%: {max(batch_peaks[-tenth:]) / 1024:.1f}, '
+          f'overall: {max(batch_peaks) / 1024:.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--batch-size', type=int, default=100)
+    args = parser.parse_args()
+    run(args.rows, args.batch_size)
@@ -0,0 +1,149 @@
+"""
+Stand-in for Elastic in the benchmarks: answers the few calls the pipeline
+makes and records the bulk requests, without indexing anything.
+
+    fake = FakeElastic(latency=0.01)
+    fake.start()
+    ...  # ELASTIC_HOST=127.0.0.1 ELASTIC_PORT=fake.port
+    fake.stop()
+"""
+import gzip
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+
+class FakeElastic:
+    """
+    Every bulk item succeeds, except updates of documents never indexed:
+    they get 404 like in Elastic. `latency` seconds are slept per bulk
+    request to stand for the indexing time.
+    """
+
+    def __init__(self, port: int = 0, latency: float = 0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.ids: set[str] = set()
+        self.bulk_requests = 0
+        self.bulk_bytes = 0
+        self.items: dict[str, int] = dict.fromkeys(
+            ['index', 'create', 'update', 'delete', 'missing'], 0)
+        self.first_bulk_at: Optional[float] = None
+        self.last_bulk_at: Optional[float] = None
+        self.server = ThreadingHTTPServer(('127.0.0.1', port),
+                                          self.handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'bulk_requests': self.bulk_requests,
+                    'bulk_bytes': self.bulk_bytes,
+                    'documents': len(self.ids),
+                    **self.items}
+
+    def bulk(self, wire_bytes: int, body: bytes) -> list[dict]:
+        lines = iter(line for line in body.split(b'\n') if line)
+        results = []
+        with self.lock:
+            for line in lines:
+                op, meta = next(iter(json.loads(line).items()))
+                result: dict = {'_id': meta['_id'], 'status': 200}
+                counted = op
+                if op == 'delete':
+                    self.ids.discard(meta['_id'])
+                else:
+                    # Only the action line is parsed, the source is skipped
+                    next(lines)
+                    if op != 'update':
+                        self.ids.add(meta['_id'])
+                    elif meta['_id'] not in self.ids:
+                        result['status'] = 404
+                        result['error'] = {
+                            'type': 'document_missing_exception'}
+                        counted = 'missing'
+                self.items[counted] += 1
+                results.append({op: result})
+
+            self.bulk_requests += 1
+            self.bulk_bytes += wire_bytes
+            now = time.perf_counter()
+            self.first_bulk_at = self.first_bulk_at or now
+            self.last_bulk_at = now
+        return results
+
+    def handler(self) -> type:
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args) -> None:
+                pass
+
+            def reply(self, status: int, body: Optional[dict] = None) -> None:
+                data = json.dumps(body or {}).encode()
+                self.send_response(status)
+                self.send_header('X-Elastic-Product', 'Elasticsearch')
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(data)
+
+            def read_body(self) -> tuple[int, bytes]:
+                raw = self.rfile.read(int(self.headers.get('Content-Length',
+                                                           0)))
+                if self.headers.get('Content-Encoding') == 'gzip':
+                    return len(raw), gzip.decompress(raw)
+                return len(raw), raw
+
+            def do_GET(self) -> None:
+                if self.path == '/':
+                    self.reply(200, {'version': {'number': '7.17.0',
+                                                 'build_flavor': 'default'},
+                                     'tagline': 'You Know, for Search'})
+                else:
+                    self.reply(200, {'count': len(fake.ids)})
+
+            def do_HEAD(self) -> None:
+                # Every index exists, so the pipeline doesn't create it
+                self.reply(200)
+
+            def do_PUT(self) -> None:
+                self.read_body()
+                self.reply(200, {'acknowledged': True})
+
+            def do_POST(self) -> None:
+                wire_bytes, body = self.read_body()
+                if '_bulk' not in self.path:
+                    self.reply(200, {'acknowledged': True})
+                    return
+                if fake.latency:
+                    time.sleep(fake.latency)
+                items = fake.bulk(wire_bytes, body)
+                self.reply(200, {
+                    'took': int(fake.latency * 1000),
+                    'errors': any(item.get('status', 200) >= 300
+                                  for result in items
+                                  for item in result.values()),
+                    'items': items,
+                })
+
+            do_DELETE = do_PUT
+
+        return Handler
@@ -0,0 +1,75 @@
+"""
+Scaling benchmark for the sharded `full_load`.
+
+Loads the whole `content.film_work` catalogue into a scratch index with
+1, 2, 4, ... shards and reports film_works per second and the speedup
+over one shard. The speedup should follow the number of shards up to
+the number of cores, until Postgres or Elastic saturates. The catalogue
+has to be large enough for the load to outweigh the process start-up.
+
+Run from the `postgres_to_es` directory:
+
+    python -m benchmarks.full_load --max-shards 8
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from config import ES_SCHEMA_FILE
+from es_loader import connect_elastic, get_elastic_schema
+from full_load import full_load
+from pg_extractor import connect_pg
+from state import JsonFileStorage
+
+INDEX = 'bench_full_load'
+
+
+def count_film_works() -> int:
+    pg_cursor = connect_pg()
+    try:
+        pg_cursor.execute('SELECT count(*) AS count FROM content.film_work;')
+        return pg_cursor.fetchone()['count']
+    finally:
+        pg_cursor.connection.close()
+
+
+def run(max_shards: int, batch_size: int) -> None:
+    film_works = count_film_works()
+    es_client = connect_elastic()
+    schema = get_elastic_schema(ES_SCHEMA_FILE)
+    state_dir = tempfile.mkdtemp()
+
+    def create_storage(name: str) -> JsonFileStorage:
+        return JsonFileStorage(os.path.join(state_dir, name))
+
+    print(f'film_works: {film_works}, cores: {os.cpu_count()}')
+    print(f'{"shards":<8}{"seconds":>10}{"films/s":>12}{"speedup":>10}')
+    baseline = None
+    shards = 1
+    while shards <= max_shards:
+        es_client.indices.delete(index=INDEX, ignore_unavailable=True)
+        es_client.indices.create(index=INDEX, body=schema)
+
+        started = time.perf_counter()
+        if not full_load(shards, create_storage, threading.Event(),
+                         index=INDEX, batch_size=batch_size):
+            raise Exception(f'Full load with {shards} shards failed.')
+        elapsed = time.perf_counter() - started
+
+        baseline = baseline or elapsed
+        print(f'{shards:<8}{elapsed:>10.2f}{film_works / elapsed:>12.0f}'
+              f'{baseline / elapsed:>10.2f}')
+        shards *= 2
+
+    es_client.indices.delete(index=INDEX, ignore_unavailable=True)
+    es_client.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--max-shards', type=int, default=os.cpu_count())
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args()
+    run(args.max_shards, args.batch_size)
@@ -0,0 +1,374 @@
+"""
+Offline benchmark of the whole pipeline on a synthetic catalogue.
+
+Creates a scratch database next to `POSTGRES_DB` with the `content`
+schema of `content_schema.sql`, filled by Postgres itself with `--films`
+film_works, `--persons-per-film` persons and `--genres-per-film` of
+`--genres` genres each. Then runs `main.py` against it and against
+`FakeElastic`, with its own state file and without Redis, CDC and the
+fingerprint cache, until every film_work is indexed and no bulk request
+came for `--idle` seconds.
+
+The results are read from the metrics of the pipeline itself:
+
+* film_works per second, from the start of the process to the last bulk
+  request;
+* p50/p99 of every stage, `load` being the whole chunk of a worker. They
+  are interpolated in the buckets of `etl_stage_seconds`, like Prometheus
+  does, so they are exact only up to the bucket bounds;
+* Postgres round trips per prepared statement;
+* peak RSS of the pipeline process.
+
+They are printed and saved as JSON with `--output`, next to the commit,
+so runs of two commits can be compared: `--baseline` prints the change
+against an earlier result.
+
+The role of `POSTGRES_USER` has to be allowed to create databases. Run
+from the `postgres_to_es` directory:
+
+    python -m benchmarks.offline --films 10000 --output bench.json
+"""
+import argparse
+import json
+import math
+import os
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from datetime import datetime
+from typing import Optional
+
+import psycopg2  # type: ignore
+from benchmarks.fake_elastic import FakeElastic
+from config import dsn
+from prometheus_client.parser import text_string_to_metric_families
+from psycopg2 import sql
+
+SCHEMA_FILE = 'benchmarks/content_schema.sql'
+ROLES = ['actor'] * 6 + ['writer'] * 3 + ['director']
+
+GENERATE = [
+    """
+    SELECT setseed(0.42);
+    """,
+    """
+    INSERT INTO content.genre (created, modified, id, name, description)
+    SELECT now(), now(), gen_random_uuid(), 'Genre ' || i,
+           'Synthetic genre ' || i
+    FROM generate_series(1, %(genres)s) i;
+    """,
+    """
+    INSERT INTO content.person (created, modified, id, full_name)
+    SELECT now(), now(), gen_random_uuid(), 'Person ' || i
+    FROM generate_series(1, %(persons)s) i;
+    """,
+    """
+    INSERT INTO content.film_work (created, modified, id, title,
+                                   description, rating, type, creation_date)
+    SELECT now(), now(), gen_random_uuid(), 'Film ' || i,
+           repeat('Synthetic description of film ' || i || '. ', 5),
+           round((random() * 100)::numeric) / 10, 'movie',
+           date '1950-01-01' + (random() * 25000)::int
+    FROM generate_series(1, %(films)s) i;
+    """,
+    # Numbers the rows, so every film_work takes the next persons and
+    # genres in a circle: they are distinct within a film_work
+    """
+    CREATE TEMPORARY TABLE numbered AS
+    SELECT 'film_work' AS entity, id,
+           row_number() OVER (ORDER BY id) - 1 AS n
+    FROM content.film_work
+    UNION ALL
+    SELECT 'person', id, row_number() OVER (ORDER BY id) - 1
+    FROM content.person
+    UNION ALL
+    SELECT 'genre', id, row_number() OVER (ORDER BY id) - 1
+    FROM content.genre;
+    CREATE INDEX ON numbered (entity, n);
+    """,
+    """
+    INSERT INTO content.person_film_work (id, role, created, film_work_id,
+                                          person_id)
+    SELECT gen_random_uuid(), (%(roles)s::text[])[j %% 10 + 1], now(),
+           fw.id, p.id
+    FROM numbered fw
+    CROSS JOIN generate_series(0, %(persons_per_film)s - 1) j
+    JOIN numbered p
+      ON p.entity = 'person'
+     AND p.n = (fw.n * %(persons_per_film)s + j) %% %(persons)s
+    WHERE fw.entity = 'film_work';
+    """,
+    """
+    INSERT INTO content.genre_film_work (id, created, film_work_id,
+                                         genre_id)
+    SELECT gen_random_uuid(), now(), fw.id, g.id
+    FROM numbered fw
+    CROSS JOIN generate_series(0, %(genres_per_film)s - 1) j
+    JOIN numbered g
+      ON g.entity = 'genre' AND g.n = (fw.n + j) %% %(genres)s
+    WHERE fw.entity = 'film_work';
+    """,
+    """
+    ANALYZE;
+    """,
+]
+
+
+def connect(dbname: str):
+    conn = psycopg2.connect(**{**dsn, 'dbname': dbname})
+    conn.autocommit = True
+    return conn
+
+
+def create_catalogue(database: str, params: dict) -> None:
+    if database == dsn['dbname']:
+        raise Exception(f'{database} is the database of the pipeline.')
+    conn = connect(dsn['dbname'])
+    with conn.cursor() as pg_cursor:
+        pg_cursor.execute(sql.SQL('DROP DATABASE IF EXISTS {}').format(
+            sql.Identifier(database)))
+        pg_cursor.execute(sql.SQL('CREATE DATABASE {}').format(
+            sql.Identifier(database)))
+    conn.close()
+
+    conn = connect(database)
+    with conn.cursor() as pg_cursor, open(SCHEMA_FILE) as f:
+        pg_cursor.execute(f.read())
+        for statement in GENERATE:
+            pg_cursor.execute(statement, params)
+    conn.close()
+
+
+def drop_catalogue(database: str) -> None:
+    conn = connect(dsn['dbname'])
+    with conn.cursor() as pg_cursor:
+        pg_cursor.execute(sql.SQL('DROP DATABASE IF EXISTS {}').format(
+            sql.Identifier(database)))
+    conn.close()
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def quantile(buckets: list[tuple[float, float]], q: float) -> float:
+    """
+    Interpolates the quantile in the cumulative `(le, count)` buckets of
+    a histogram, as `histogram_quantile` of Prometheus does.
+    """
+    total = buckets[-1][1]
+    if not total:
+        return 0.0
+    rank = q * total
+    lower, below = 0.0, 0.0
+    for upper, count in buckets:
+        if count >= rank:
+            if math.isinf(upper):
+                return lower
+            return lower + (upper - lower) * (rank - below) / (count - below)
+        lower, below = upper, count
+    return lower
+
+
+def scrape(port: int) -> dict:
+    """
+    Reads the stage latencies, the rows and the round trips from
+    the metrics of the pipeline.
+    """
+    with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics') as r:
+        text = r.read().decode()
+
+    buckets: dict[str, list[tuple[float, float]]] = {}
+    counts: dict[str, dict[str, dict[str, float]]] = {
+        'stage_sums': {}, 'rows': {}, 'sql_round_trips': {}, 'documents': {}}
+    for family in text_string_to_metric_families(text):
+        for sample in family.samples:
+            labels = sample.labels
+            if sample.name == 'etl_stage_seconds_bucket':
+                buckets.setdefault(labels['stage'], []).append(
+                    (float(labels['le']), sample.value))
+            elif sample.name == 'etl_stage_seconds_sum':
+                counts['stage_sums'][labels['stage']] = sample.value
+            elif sample.name == 'etl_rows_total':
+                counts['rows'][labels['stage']] = sample.value
+            elif sample.name == 'etl_sql_queries_total':
+                counts['sql_round_trips'][labels['statement']] = sample.value
+            elif sample.name == 'etl_documents_total':
+                counts['documents'][labels['result']] = sample.value
+
+    stages = {}
+    for stage, stage_buckets in buckets.items():
+        stage_buckets.sort()
+        calls = stage_buckets[-1][1]
+        if not calls:
+            continue
+        stages[stage] = {
+            'calls': int(calls),
+            'mean_ms': counts['stage_sums'][stage] / calls * 1000,
+            'p50_ms': quantile(stage_buckets, 0.5) * 1000,
+            'p99_ms': quantile(stage_buckets, 0.99) * 1000,
+        }
+    return {
+        'stages': stages,
+        'rows': {k: int(v) for k, v in counts['rows'].items()},
+        'sql_round_trips': {k: int(v)
+                            for k, v in counts['sql_round_trips'].items()},
+        'documents': {k: int(v) for k, v in counts['documents'].items()},
+    }
+
+
+def run_pipeline(database: str, films: int, latency: float, idle: float,
+                 timeout: float) -> dict:
+    fake = FakeElastic(latency=latency)
+    fake.start()
+    metrics_port = free_port()
+    work_dir = tempfile.mkdtemp()
+    env = {
+        **os.environ,
+        'POSTGRES_DB': database,
+        'ELASTIC_HOST': '127.0.0.1',
+        'ELASTIC_PORT': str(fake.port),
+        'REDIS_HOST': '',
+        'STATE_FILE': os.path.join(work_dir, 'state.json'),
+        'ETL_DLQ_FILE': os.path.join(work_dir, 'dead_letters.ndjson'),
+        'ETL_FINGERPRINT_DB': '',
+        'ETL_CDC_ENABLED': 'false',
+        'METRICS_ADDR': '127.0.0.1',
+        'METRICS_PORT': str(metrics_port),
+    }
+
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, 'main.py'], env=env)
+    try:
+        while process.poll() is None:
+            time.sleep(0.1)
+            now = time.perf_counter()
+            if now - started > timeout:
+                raise Exception(f'The pipeline is not done in {timeout} s.')
+            stats = fake.stats()
+            if stats['documents'] >= films \
+                    and now - (fake.last_bulk_at or now) >= idle:
+                break
+        else:
+            raise Exception(f'The pipeline exited with {process.returncode}.')
+        metrics = scrape(metrics_port)
+    finally:
+        if process.poll() is None:
+            process.send_signal(signal.SIGTERM)
+            process.wait()
+        fake.stop()
+
+    seconds = (fake.last_bulk_at or started) - started
+    return {
+        'seconds': seconds,
+        'film_works_per_second': films / seconds,
+        'batch_p50_ms': metrics['stages'].get('load', {}).get('p50_ms'),
+        'batch_p99_ms': metrics['stages'].get('load', {}).get('p99_ms'),
+        # ru_maxrss is in KiB on Linux
+        'peak_rss_mib': resource.getrusage(
+            resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        'elastic': fake.stats(),
+        **metrics,
+    }
+
+
+def current_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(result: dict, baseline: Optional[dict]) -> None:
+    print(f'film_works: {result["params"]["films"]}, '
+          f'persons per film: {result["params"]["persons_per_film"]}, '
+          f'genres: {result["params"]["genres"]}')
+    for key, unit in (('film_works_per_second', 'films/s'),
+                      ('batch_p50_ms', 'ms'),
+                      ('batch_p99_ms', 'ms'),
+                      ('peak_rss_mib', 'MiB')):
+        value = result[key] or 0
+        line = f'{key:<24}{value:>10.1f} {unit}'
+        if baseline and baseline.get(key):
+            line += f'  ({(value / baseline[key] - 1) * 100:+.1f}%)'
+        print(line)
+
+    print(f'\n{"stage":<22}{"calls":>8}{"mean ms":>10}{"p50 ms":>10}'
+          f'{"p99 ms":>10}{"rows":>10}')
+    for stage, stats in sorted(result['stages'].items()):
+        print(f'{stage:<22}{stats["calls"]:>8}{stats["mean_ms"]:>10.1f}'
+              f'{stats["p50_ms"]:>10.1f}{stats["p99_ms"]:>10.1f}'
+              f'{result["rows"].get(stage, ""):>10}')
+
+    print(f'\n{"statement":<32}{"round trips":>12}')
+    for statement, count in sorted(result['sql_round_trips'].items()):
+        print(f'{statement:<32}{count:>12}')
+
+    elastic = result['elastic']
+    print(f'\nbulk requests: {elastic["bulk_requests"]}, '
+          f'bytes: {elastic["bulk_bytes"]}, '
+          f'updates of missing documents: {elastic["missing"]}')
+
+
+def run(args: argparse.Namespace) -> None:
+    params = {
+        'films': args.films,
+        'persons_per_film': args.persons_per_film,
+        'persons': args.persons or max(
+            args.persons_per_film, args.films * args.persons_per_film // 10),
+        'genres': args.genres,
+        'genres_per_film': min(args.genres_per_film, args.genres),
+        'roles': ROLES,
+    }
+    started = time.perf_counter()
+    create_catalogue(args.database, params)
+    print(f'catalogue generated in {time.perf_counter() - started:.1f} s')
+    try:
+        result = run_pipeline(args.database, args.films, args.latency,
+                              args.idle, args.timeout)
+    finally:
+        if not args.keep:
+            drop_catalogue(args.database)
+
+    del params['roles']
+    result = {'commit': current_commit(), 'date': str(datetime.now()),
+              'params': {**params, 'bulk_latency': args.latency},
+              **result}
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(result, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--films', type=int, default=10_000)
+    parser.add_argument('--persons-per-film', type=int, default=20)
+    parser.add_argument('--persons', type=int,
+                        help='default: every person in 10 films')
+    parser.add_argument('--genres', type=int, default=30)
+    parser.add_argument('--genres-per-film', type=int, default=3)
+    parser.add_argument('--database', default='movies_bench')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds the fake Elastic takes per request')
+    parser.add_argument('--idle', type=float, default=3,
+                        help='seconds without requests to consider it done')
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--output', help='file to save the results to')
+    parser.add_argument('--baseline', help='results to compare with')
+    parser.add_argument('--keep', action='store_true',
+                        help="don't drop the database afterwards")
+    run(parser.parse_args())
@@ -0,0 +1,98 @@
+"""
+Benchmark of the synchronous chain against the asyncio pipeline.
+
+Both load the whole `content.film_work` catalogue into a scratch index
+in chunks of `--chunk-size` film_works. The synchronous path extracts,
+transforms and saves one chunk after the other on one connection, as
+a worker of the scheduler does. The async path feeds the same chunks to
+`AsyncPipeline`, where the reads of the next chunks overlap with the
+bulk requests of the previous ones.
+
+Run from the `postgres_to_es` directory:
+
+    python -m benchmarks.pipeline --chunk-size 100 --workers 4
+"""
+import argparse
+import asyncio
+import time
+
+from adaptive import AdaptiveBatchSize
+from async_pipeline import (AsyncBatch, AsyncPipeline, create_es_client,
+                            create_pg_pool)
+from config import ES_SCHEMA_FILE
+from es_loader import connect_elastic, get_elastic_schema
+from pg_extractor import connect_pg, get_all_film_work_ids
+from scheduler import load_film_works
+
+INDEX = 'bench_pipeline'
+
+
+def fixed_size(size: int) -> AdaptiveBatchSize:
+    return AdaptiveBatchSize('bench', size, size, size, 1)
+
+
+def run_sync(chunks: list[list[str]]) -> None:
+    pg_cursor = connect_pg()
+    es_client = connect_elastic()
+    try:
+        for film_work_ids in chunks:
+            load_film_works(pg_cursor, es_client, film_work_ids, INDEX)
+    finally:
+        pg_cursor.connection.close()
+        es_client.close()
+
+
+async def run_async(chunks: list[list[str]], chunk_size: int,
+                    workers: int) -> None:
+    pg_pool = await create_pg_pool(workers)
+    es_client = create_es_client()
+    pipeline = AsyncPipeline(pg_pool, es_client, fixed_size(chunk_size),
+                             workers, workers * 2, index=INDEX)
+    try:
+        batch = AsyncBatch()
+        for film_work_ids in chunks:
+            await pipeline.submit(film_work_ids, batch)
+        batch.seal()
+        await batch.wait()
+        if batch.failed:
+            raise Exception('The async pipeline failed to load a chunk.')
+    finally:
+        await pipeline.close()
+        await es_client.close()
+        await pg_pool.close()
+
+
+def run(chunk_size: int, workers: int) -> None:
+    pg_cursor = connect_pg()
+    chunks = list(get_all_film_work_ids(pg_cursor, chunk_size))
+    pg_cursor.connection.close()
+    film_works = sum(map(len, chunks))
+
+    es_client = connect_elastic()
+    schema = get_elastic_schema(ES_SCHEMA_FILE)
+
+    print(f'film_works: {film_works}, chunk size: {chunk_size}, '
+          f'async workers: {workers}')
+    print(f'{"path":<8}{"seconds":>10}{"films/s":>12}')
+    for name, load in (
+            ('sync', lambda: run_sync(chunks)),
+            ('async', lambda: asyncio.run(run_async(chunks, chunk_size,
+                                                    workers)))):
+        es_client.indices.delete(index=INDEX, ignore_unavailable=True)
+        es_client.indices.create(index=INDEX, body=schema)
+
+        started = time.perf_counter()
+        load()
+        elapsed = time.perf_counter() - started
+        print(f'{name:<8}{elapsed:>10.2f}{film_works / elapsed:>12.0f}')
+
+    es_client.indices.delete(index=INDEX, ignore_unavailable=True)
+    es_client.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--chunk-size', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+    run(args.chunk_size, args.workers)
@@ -0,0 +1,106 @@
+"""
+Micro-benchmark of the film_works enrichment query: the old text query
+with the ids inlined into `IN (...)` against the prepared statement with
+an `= ANY($1)` bind parameter.
+
+For each path it reports the mean planning time per batch, taken from
+`EXPLAIN (ANALYZE)`, and the mean wall time of executing a batch and
+fetching its rows.
+
+Run from the `postgres_to_es` directory:
+
+    python -m benchmarks.query_plan --batches 200 --batch-size 100
+"""
+import argparse
+import json
+import random
+import statistics
+import time
+
+from pg_extractor import connect_pg, execute_prepared, query_film_works
+from psycopg2 import sql  # type: ignore
+
+
+def legacy_query_film_works(film_work_ids: list[str]) -> str:
+    """The query as it was built before the switch to bind parameters."""
+    ids = ', '.join("'" + i + "'" for i in film_work_ids)
+    return f"""
+    SELECT
+    fw.id, fw.title, fw.description, fw.rating, fw.type, fw.created,
+    fw.modified,
+    COALESCE (
+        json_agg(
+            DISTINCT jsonb_build_object(
+               'person_role', pfw.role,
+               'person_id', p.id,
+               'person_name', p.full_name
+            )
+        ) FILTER (WHERE p.id is not null),
+        '[]'
+    ) as persons,
+    array_agg(DISTINCT g.name) as genres
+    FROM content.film_work fw
+    LEFT JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id
+    LEFT JOIN content.person p ON p.id = pfw.person_id
+    LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
+    LEFT JOIN content.genre g ON g.id = gfw.genre_id
+    WHERE fw.id IN ({ids})
+    GROUP BY fw.id
+    ORDER BY fw.modified;
+    """
+
+
+def planning_time(pg_cursor, query, params=None) -> float:
+    explain = sql.SQL('EXPLAIN (ANALYZE, FORMAT JSON) ')
+    if isinstance(query, str):
+        query = sql.SQL(query)
+    pg_cursor.execute(explain + query, params)
+    plan = pg_cursor.fetchone()['QUERY PLAN']
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Planning Time']
+
+
+def run(batches: int, batch_size: int) -> None:
+    pg_cursor = connect_pg()
+    pg_cursor.execute('SELECT id FROM content.film_work;')
+    all_ids = [row['id'] for row in pg_cursor.fetchall()]
+    samples = [random.sample(all_ids, min(batch_size, len(all_ids)))
+               for _ in range(batches)]
+
+    statement = query_film_works()
+    legacy_plan, legacy_wall, prepared_plan, prepared_wall = [], [], [], []
+
+    for ids in samples:
+        started = time.perf_counter()
+        pg_cursor.execute(legacy_query_film_works(ids))
+        pg_cursor.fetchall()
+        legacy_wall.append(time.perf_counter() - started)
+        legacy_plan.append(planning_time(pg_cursor,
+                                         legacy_query_film_works(ids)))
+
+        started = time.perf_counter()
+        execute_prepared(pg_cursor, statement, (ids,))
+        pg_cursor.fetchall()
+        prepared_wall.append(time.perf_counter() - started)
+        prepared_plan.append(planning_time(
+            pg_cursor,
+            sql.SQL('EXECUTE {} (%s::uuid[])').format(
+                sql.Identifier(statement.name)),
+            (ids,),
+        ))
+
+    print(f'batches: {batches}, ids per batch: {batch_size}')
+    print(f'{"path":<10}{"plan ms":>10}{"wall ms":>10}')
+    for name, plan, wall in (('legacy', legacy_plan, legacy_wall),
+                             ('prepared', prepared_plan, prepared_wall)):
+        print(f'{name:<10}{statistics.mean(plan):>10.3f}'
+              f'{statistics.mean(wall) * 1000:>10.3f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--batches', type=int, default=200)
+    parser.add_argument('--batch-size', type=int, default=100)
+    args = parser.parse_args()
+    run(args.batches, args.batch_size)
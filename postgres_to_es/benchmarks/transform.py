@@ -0,0 +1,152 @@
+"""
+Benchmark of `transform_pg_to_es` on synthetic films, without Postgres
+or Elastic.
+
+The legacy path is the transformer as it was before the single-pass
+rewrite: dict rows, four `filter` passes over the persons and the
+documents serialized afterwards, as the Elastic client did it. The current
+path takes `FilmWorkRow`s and returns serialized `Document`s.
+
+For each path it reports films per second and the peak memory allocated
+while transforming and serializing all the films.
+
+Run from the `postgres_to_es` directory:
+
+    python -m benchmarks.transform --films 100000
+"""
+import argparse
+import json
+import random
+import time
+import tracemalloc
+import uuid
+from datetime import datetime
+from typing import Callable, Optional
+
+from es_loader import transform_pg_to_es
+from pg_extractor import FilmWorkRow
+
+ROLES = ['actor'] * 6 + ['writer'] * 3 + ['director']
+
+
+def legacy_transform(pg_data: list[dict]) -> list[dict]:
+    prepared_data: list[dict] = []
+
+    def is_writer(person: dict) -> bool:
+        return person.get('person_role') == 'writer'
+
+    def is_director(person: dict) -> bool:
+        return person.get('person_role') == 'director'
+
+    def get_names(persons: list[dict]) -> list[Optional[str]]:
+        def get_name(person: dict) -> Optional[str]:
+            return person.get('name')
+
+        return list(map(get_name, persons))
+
+    def is_actor(person: dict) -> bool:
+        return person.get('person_role') == 'actor'
+
+    def get_persons(persons: list[dict], pred: Callable) -> list[dict]:
+        def strip_fields(p: dict) -> dict:
+            return {'id': p.get('person_id'),
+                    'name': p.get('person_name')}
+
+        return list(map(strip_fields, filter(pred, persons)))
+
+    def get_director_name(persons: list[dict]) -> str:
+        directors = list(filter(is_director, persons))
+        director = list(filter(is_director, persons))[0] \
+            if len(directors) else {}
+        return director.get('person_name') or ''
+
+    for row in pg_data:
+        persons = row.get('persons')
+        actors = get_persons(persons, is_actor)
+        writers = get_persons(persons, is_writer)
+        prepared_data.append({'index': {'_index': 'movies',
+                                        '_id': row.get('id')}})
+        prepared_data.append({
+            'id': row.get('id'),
+            'imdb_rating': row.get('rating'),
+            'genre': row.get('genres'),
+            'title': row.get('title'),
+            'description': row.get('description'),
+            'director': get_director_name(persons),
+            'actors_names': get_names(actors),
+            'writers_names': get_names(writers),
+            'actors': actors,
+            'writers': writers,
+        })
+    return prepared_data
+
+
+def legacy_path(rows: list[dict]) -> list[str]:
+    return [json.dumps(item, ensure_ascii=False, separators=(',', ':'))
+            for item in legacy_transform(rows)]
+
+
+def current_path(rows: list[FilmWorkRow]) -> list:
+    return transform_pg_to_es(rows)
+
+
+def generate_films(count: int, persons_per_film: int) -> list[FilmWorkRow]:
+    now = datetime.now()
+    films = []
+    for number in range(count):
+        persons = [[random.choice(ROLES), str(uuid.uuid4()),
+                    f'Person {random.randrange(100_000)}']
+                   for _ in range(persons_per_film)]
+        films.append(FilmWorkRow(
+            id=str(uuid.uuid4()),
+            title=f'Film {number}',
+            description='Lorem ipsum dolor sit amet. ' * 8,
+            rating=round(random.uniform(1, 10), 1),
+            type='movie',
+            created=now,
+            modified=now,
+            persons=persons,
+            genres=random.sample(['Action', 'Drama', 'Comedy', 'Sci-Fi'], 2),
+        ))
+    return films
+
+
+def as_legacy_row(film: FilmWorkRow) -> dict:
+    row = film._asdict()
+    row['persons'] = [{'person_role': role, 'person_id': person_id,
+                       'person_name': name}
+                      for role, person_id, name in film.persons]
+    return row
+
+
+def measure(path: Callable, rows: list) -> tuple[float, int]:
+    started = time.perf_counter()
+    path(rows)
+    elapsed = time.perf_counter() - started
+
+    tracemalloc.start()
+    path(rows)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def run(films: int, persons_per_film: int) -> None:
+    rows = generate_films(films, persons_per_film)
+    legacy_rows = [as_legacy_row(film) for film in rows]
+
+    print(f'films: {films}, persons per film: {persons_per_film}')
+    print(f'{"path":<10}{"films/s":>12}{"peak MiB":>12}')
+    for name, path, data in (('legacy', legacy_path, legacy_rows),
+                             ('current', current_path, rows)):
+        elapsed, peak = measure(path, data)
+        print(f'{name:<10}{films / elapsed:>12.0f}'
+              f'{peak / 1024 / 1024:>12.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--films', type=int, default=100_000)
+    parser.add_argument('--persons-per-film', type=int, default=20)
+    args = parser.parse_args()
+    run(args.films, args.persons_per_film)
@@ -0,0 +1,134 @@
+import logging
+import queue
+import select
+import threading
+from datetime import datetime
+from typing import Optional
+
+from config import CDC_TRIGGERS_FILE
+from pg_extractor import connect_pg
+from psycopg2.extras import RealDictCursor  # type: ignore
+from scheduler import Batch, is_alive
+
+log = logging.getLogger('CDC')
+
+# Channel the triggers from `CDC_TRIGGERS_FILE` notify
+CDC_CHANNEL = 'film_work_changes'
+# Tables of the schema `content` with an `etl_notify` trigger
+CDC_TABLES = ['film_work', 'person', 'genre', 'person_film_work',
+              'genre_film_work']
+
+
+def install_triggers(pg_cursor: RealDictCursor,
+                     file_path: str = CDC_TRIGGERS_FILE) -> None:
+    """
+    Creates the triggers which notify `CDC_CHANNEL` about the changed
+    film_works. The script runs in one transaction and can be run again.
+    """
+    with open(file_path, 'r') as f:
+        pg_cursor.execute(f.read())
+
+
+def triggers_installed(pg_cursor: RealDictCursor) -> bool:
+    pg_cursor.execute("""
+        SELECT count(*) AS count
+        FROM pg_trigger t
+        JOIN pg_class c ON c.oid = t.tgrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE t.tgname = 'etl_notify'
+          AND n.nspname = 'content'
+          AND c.relname = ANY(%s);
+        """, (CDC_TABLES,))
+    return pg_cursor.fetchone()['count'] == len(CDC_TABLES)
+
+
+class ChangeListener(threading.Thread):
+    """
+    Listens to the notifications of the CDC triggers and feeds the ids of
+    the changed film_works to the coalescer, next to the producers.
+
+    Notifications sent while the listener is disconnected are lost: the
+    producers still poll the entity tables, so updates are caught up by
+    them. Deleted film_works are removed from Elastic when their id is
+    received and Postgres doesn't return them any more.
+    """
+
+    def __init__(self,
+                 film_work_queue: queue.Queue,
+                 stop_event: threading.Event,
+                 chunk_size: int = 100):
+        super().__init__(name='cdc-listener', daemon=True)
+        self.film_work_queue = film_work_queue
+        self.stop_event = stop_event
+        self.chunk_size = chunk_size
+        self.pg_cursor: Optional[RealDictCursor] = None
+        # Ids received but not loaded yet, kept in order of arrival
+        self.pending: dict[str, None] = {}
+
+    def run(self) -> None:
+        while not self.stop_event.is_set():
+            try:
+                if not is_alive(self.pg_cursor):
+                    self.connect()
+                self.receive(timeout=1)
+                if self.pending and not self.send():
+                    # Keeps the ids and tries them again a bit later
+                    self.stop_event.wait(1)
+            except Exception as err:
+                log.error(f'{datetime.now()} Failed while listening to '
+                          f'changes.\n{err}\n\n')
+                if self.pg_cursor:
+                    self.pg_cursor.close()
+                self.stop_event.wait(1)
+
+    def connect(self) -> None:
+        self.pg_cursor = connect_pg(failed_cursor=self.pg_cursor)
+        # Creating a trigger locks its table: a reconnect doesn't do it
+        # again while all of them are there
+        if not triggers_installed(self.pg_cursor):
+            install_triggers(self.pg_cursor)
+        self.pg_cursor.execute(f'LISTEN {CDC_CHANNEL};')
+        log.info(f'{datetime.now()} Listening to {CDC_CHANNEL}.')
+
+    def receive(self, timeout: float) -> None:
+        connection = self.pg_cursor.connection
+        if not connection.notifies:
+            select.select([connection], [], [], timeout)
+        connection.poll()
+        while connection.notifies:
+            notify = connection.notifies.pop(0)
+            self.pending[notify.payload] = None
+
+    def send(self) -> bool:
+        """
+        Sends the received ids as one batch and waits until it's loaded.
+        Returns `True` if every id was loaded.
+        """
+        batch = Batch()
+        film_work_ids = list(self.pending)
+        for start in range(0, len(film_work_ids), self.chunk_size):
+            chunk = film_work_ids[start:start + self.chunk_size]
+            batch.add(len(chunk))
+            if not self.put((chunk, batch)):
+                return False
+        batch.seal()
+
+        while not batch.wait(timeout=1):
+            if self.stop_event.is_set():
+                return False
+        if batch.failed:
+            return False
+
+        log.info(f'{datetime.now()} {len(film_work_ids)} changed film_works '
+                 f'were received from {CDC_CHANNEL}.')
+        self.pending = {}
+        return True
+
+    def put(self, item: tuple[list[str], Batch]) -> bool:
+        while not self.stop_event.is_set():
+            try:
+                self.film_work_queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
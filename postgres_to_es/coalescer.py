@@ -0,0 +1,186 @@
+import logging
+import queue
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Iterable, Optional
+
+from adaptive import AdaptiveBatchSize
+
+log = logging.getLogger('Coalescer')
+
+
+class InFlight:
+    """
+    Film_work ids being loaded. Two loads of one film_work mustn't
+    overlap: the one which read Postgres first could reach Elastic last
+    and overwrite the newer document.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._ids: set[str] = set()
+
+    def try_acquire(self, film_work_ids: Iterable[str]) -> list[str]:
+        """
+        Takes the ids which aren't in flight and returns them.
+        """
+        with self._condition:
+            free = [film_work_id for film_work_id in film_work_ids
+                    if film_work_id not in self._ids]
+            self._ids.update(free)
+            return free
+
+    def acquire(self, film_work_ids: list[str],
+                stop_event: Optional[threading.Event] = None) -> bool:
+        """
+        Waits until none of the ids is in flight and takes them all at
+        once, so two callers never wait for each other's ids. Returns
+        `False` if `stop_event` was set meanwhile.
+        """
+        with self._condition:
+            while not self._ids.isdisjoint(film_work_ids):
+                if stop_event and stop_event.is_set():
+                    return False
+                self._condition.wait(1)
+            self._ids.update(film_work_ids)
+            return True
+
+    def release(self, film_work_ids: Iterable[str]) -> None:
+        with self._condition:
+            self._ids.difference_update(film_work_ids)
+            self._condition.notify_all()
+
+    def wait(self, timeout: float) -> None:
+        """Waits for a release."""
+        with self._condition:
+            self._condition.wait(timeout)
+
+    def count(self) -> int:
+        return len(self._ids)
+
+
+class Coalescer(threading.Thread):
+    """
+    Sits between the producers and the workers. Collects film_work ids
+    during a window of `window_seconds` or until `window_size` distinct ids
+    are gathered, drops the duplicates and sends every film_work to the
+    workers once per window.
+
+    A producer waits for its batch to be loaded before it sends more ids,
+    so the window is closed early once every batch in it is sealed and
+    nothing else is queued.
+
+    Each chunk sent to the workers carries a counter of the producers'
+    batches with the number of ids every batch contributed, so the
+    batches are acknowledged even if their ids were merged. The size of
+    the chunks is taken from `chunk_size` as it adapts.
+
+    Ids still loaded from an earlier window are held back in `in_flight`
+    until the workers release them, and are sent with the next window.
+    """
+
+    def __init__(self,
+                 input_queue: queue.Queue,
+                 output_queue: queue.Queue,
+                 stop_event: threading.Event,
+                 window_seconds: float,
+                 window_size: int,
+                 chunk_size: AdaptiveBatchSize,
+                 in_flight: Optional[InFlight] = None):
+        super().__init__(name='coalescer', daemon=True)
+        self.input_queue = input_queue
+        self.output_queue = output_queue
+        self.stop_event = stop_event
+        self.window_seconds = window_seconds
+        self.window_size = window_size
+        self.chunk_size = chunk_size
+        self.in_flight = in_flight or InFlight()
+
+        self.pending: dict[str, list] = {}
+        self.window_batches: set = set()
+        self.ids_received = 0
+        self.ids_emitted = 0
+
+    def run(self) -> None:
+        while not self.stop_event.is_set():
+            self.collect()
+            self.flush()
+
+    def collect(self) -> None:
+        """
+        Fills the window. It starts with the first received id, so an idle
+        coalescer doesn't flush empty windows, or with the ids held back.
+        """
+        deadline: Optional[float] = None
+        if self.pending:
+            deadline = time.monotonic() + self.window_seconds
+
+        while len(self.pending) < self.window_size \
+                and not self.stop_event.is_set():
+            timeout = 1.0
+            if deadline is not None:
+                timeout = min(deadline - time.monotonic(), 0.05)
+                if timeout <= 0:
+                    break
+            try:
+                film_work_ids, batch = self.input_queue.get(timeout=timeout)
+            except queue.Empty:
+                if self.pending and all(window_batch.sealed for window_batch
+                                        in self.window_batches):
+                    break
+                continue
+
+            if deadline is None:
+                deadline = time.monotonic() + self.window_seconds
+            for film_work_id in film_work_ids:
+                self.pending.setdefault(film_work_id, []).append(batch)
+            self.window_batches.add(batch)
+            self.ids_received += len(film_work_ids)
+
+    def flush(self) -> None:
+        if not self.pending:
+            return
+
+        window_ids = self.in_flight.try_acquire(self.pending)
+        sent = set(window_ids)
+        held = {film_work_id: batches
+                for film_work_id, batches in self.pending.items()
+                if film_work_id not in sent}
+        start = 0
+        while start < len(window_ids):
+            chunk = window_ids[start:start + self.chunk_size.value]
+            start += len(chunk)
+            batches = Counter(batch
+                              for film_work_id in chunk
+                              for batch in self.pending[film_work_id])
+            if not self.put((chunk, batches)):
+                return
+            self.ids_emitted += len(chunk)
+
+        if window_ids:
+            log.info(f'{datetime.now()} Coalesced film_work ids: '
+                     f'{len(window_ids)} sent in this window, '
+                     f'{len(held)} held back, '
+                     f'{self.ids_received} received and '
+                     f'{self.ids_emitted} sent in total.')
+        self.pending = held
+        self.window_batches = {batch for batches in held.values()
+                               for batch in batches}
+        if held and not window_ids:
+            self.in_flight.wait(self.window_seconds)
+
+    def put(self, item: tuple[list[str], Counter]) -> bool:
+        while not self.stop_event.is_set():
+            try:
+                self.output_queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def stats(self) -> dict:
+        return {'ids_received': self.ids_received,
+                'ids_emitted': self.ids_emitted,
+                'ids_in_flight': self.in_flight.count()}
@@ -8,7 +8,88 @@ load_dotenv()
 logging.basicConfig(filename='logs/es.log', level='INFO')
 
 STATE_FILE = os.getenv('STATE_FILE')
+# Checkpoints are flushed to STATE_FILE every N updates and every T seconds
+STATE_FLUSH_EVERY = int(os.getenv('STATE_FLUSH_EVERY', 10))
+STATE_FLUSH_INTERVAL = float(os.getenv('STATE_FLUSH_INTERVAL', 5))
+ENTITY_TABLES = ['film_work', 'genre', 'person']
 ES_INDEX = 'movies'
+ES_SCHEMA_FILE = 'resources/es_schema.json'
+
+# Number of threads which enrich, transform and load film_works
+ETL_WORKERS = int(os.getenv('ETL_WORKERS', 4))
+# Seconds between two polls of the same entity table
+ETL_POLL_INTERVAL = float(os.getenv('ETL_POLL_INTERVAL', 1))
+# Chunks of film_work ids waiting for the workers
+ETL_QUEUE_SIZE = int(os.getenv('ETL_QUEUE_SIZE', 100))
+# Batch sizes tuned at runtime between ETL_BATCH_MIN and ETL_BATCH_MAX:
+# entity ids per poll query, and film_works per chunk of a worker, i.e. per
+# enrichment query and bulk request. They aim at ETL_BATCH_TARGET_SECONDS
+# per request and ETL_BATCH_TARGET_BYTES per bulk body.
+ETL_BATCH_MIN = int(os.getenv('ETL_BATCH_MIN', 10))
+ETL_BATCH_MAX = int(os.getenv('ETL_BATCH_MAX', 1000))
+ETL_BATCH_TARGET_SECONDS = float(os.getenv('ETL_BATCH_TARGET_SECONDS', 0.5))
+ETL_BATCH_TARGET_BYTES = int(os.getenv('ETL_BATCH_TARGET_BYTES',
+                                       5 * 1024 * 1024))
+# SQLite file with the digests of the saved documents: unchanged documents
+# aren't sent again. Not set turns the cache off.
+ETL_FINGERPRINT_DB = os.getenv('ETL_FINGERPRINT_DB')
+ETL_FINGERPRINT_SIZE = int(os.getenv('ETL_FINGERPRINT_SIZE', 1_000_000))
+# Append-only NDJSON file of the film_works which failed to transform or
+# were rejected by Elastic, loaded again by `main.py replay-dlq`
+ETL_DLQ_FILE = os.getenv('ETL_DLQ_FILE', 'dead_letters.ndjson')
+# Directory of the disk spool between extraction and loading: film_works
+# are extracted and checkpointed while Elastic is slow or down, a loader
+# drains the spool. Segments of ETL_SPOOL_SEGMENT_BYTES, at most
+# ETL_SPOOL_MAX_BYTES in all. Not set sends the documents directly.
+ETL_SPOOL_DIR = os.getenv('ETL_SPOOL_DIR')
+ETL_SPOOL_SEGMENT_BYTES = int(os.getenv('ETL_SPOOL_SEGMENT_BYTES',
+                                        64 * 1024 * 1024))
+ETL_SPOOL_MAX_BYTES = int(os.getenv('ETL_SPOOL_MAX_BYTES',
+                                    1024 * 1024 * 1024))
+# Postgres connections shared by the producers and the workers: a thread
+# waits up to PG_POOL_TIMEOUT seconds for a free one, and a connection idle
+# for PG_POOL_CHECK_INTERVAL seconds is checked before it's reused
+PG_POOL_SIZE = int(os.getenv('PG_POOL_SIZE',
+                             ETL_WORKERS + len(ENTITY_TABLES)))
+PG_POOL_TIMEOUT = float(os.getenv('PG_POOL_TIMEOUT', 30))
+PG_POOL_CHECK_INTERVAL = float(os.getenv('PG_POOL_CHECK_INTERVAL', 30))
+# Where documents are shaped: 'python' (transform_pg_to_es) or 'sql'
+ETL_TRANSFORM = os.getenv('ETL_TRANSFORM', 'python')
+# Changes pushed by the triggers from CDC_TRIGGERS_FILE through
+# LISTEN/NOTIFY. Polling stays as the catch-up path, just less frequent.
+ETL_CDC_ENABLED = os.getenv('ETL_CDC_ENABLED', 'false').lower() == 'true'
+ETL_CDC_POLL_INTERVAL = float(os.getenv('ETL_CDC_POLL_INTERVAL', 60))
+CDC_TRIGGERS_FILE = 'resources/cdc_triggers.sql'
+# Person and genre changes update only the fields built from them in the
+# documents of the linked film_works, instead of loading the film_works anew
+ETL_PARTIAL_UPDATES = os.getenv('ETL_PARTIAL_UPDATES',
+                                'true').lower() == 'true'
+PARTIAL_UPDATE_TABLES = ['genre', 'person']
+# Window in which duplicated film_work ids are merged: seconds and ids
+ETL_COALESCE_WINDOW = float(os.getenv('ETL_COALESCE_WINDOW', 1))
+ETL_COALESCE_SIZE = int(os.getenv('ETL_COALESCE_SIZE', 1000))
+
+# Bulk loading: documents and bytes per request, requests in flight
+# and attempts (and seconds for all of them) for the items rejected
+# by an overloaded Elastic
+ES_BULK_CHUNK_SIZE = int(os.getenv('ES_BULK_CHUNK_SIZE', 500))
+ES_BULK_MAX_BYTES = int(os.getenv('ES_BULK_MAX_BYTES', 10 * 1024 * 1024))
+ES_BULK_THREADS = int(os.getenv('ES_BULK_THREADS', 4))
+ES_BULK_MAX_RETRIES = int(os.getenv('ES_BULK_MAX_RETRIES', 3))
+ES_BULK_RETRY_DEADLINE = float(os.getenv('ES_BULK_RETRY_DEADLINE', 30))
+# Bulk bodies are sent gzipped: less traffic for some CPU on both sides
+ES_HTTP_COMPRESS = os.getenv('ES_HTTP_COMPRESS', 'false').lower() == 'true'
+# After ES_BREAKER_THRESHOLD failed requests in a row Elastic is considered
+# down: for ES_BREAKER_RESET seconds nothing is sent or extracted
+ES_BREAKER_THRESHOLD = int(os.getenv('ES_BREAKER_THRESHOLD', 5))
+ES_BREAKER_RESET = float(os.getenv('ES_BREAKER_RESET', 30))
+# Keep-alive HTTP connections to Elastic, enough for every bulk thread
+ES_POOL_SIZE = int(os.getenv('ES_POOL_SIZE', ETL_WORKERS * ES_BULK_THREADS))
+
+# Prometheus metrics are served on http://METRICS_ADDR:METRICS_PORT/metrics;
+# port 0 turns them off
+METRICS_ADDR = os.getenv('METRICS_ADDR', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 8000))
 
 dsn = {
     'dbname': os.getenv('POSTGRES_DB'),
@@ -23,3 +104,9 @@ es_node = {
     'host': os.getenv('ELASTIC_HOST'),
     'port': os.getenv('ELASTIC_PORT'),
 }
+
+# Shared state for several ETL processes; STATE_FILE is used when not set
+redis_node = {
+    'host': os.getenv('REDIS_HOST'),
+    'port': int(os.getenv('REDIS_PORT', 6379)),
+}
@@ -0,0 +1,105 @@
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+from typing import Any, Callable, Iterable
+
+from config import ETL_DLQ_FILE
+from metrics import DEAD_LETTERS, DEAD_LETTERS_REPLAYED
+
+log = logging.getLogger('DeadLetters')
+
+
+class DeadLetterQueue:
+    """
+    Append-only NDJSON file of the film_works which failed for good:
+    rows `transform_pg_to_es` couldn't shape and documents Elastic
+    rejected. They are parked there, so the rest of the batch is saved
+    and the checkpoint moves on. `replay` loads them again later.
+
+    Every line is `{"stage", "index", "id", "error", "data", "parked"}`.
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self._lock = threading.Lock()
+
+    @property
+    def replaying_path(self) -> str:
+        return f'{self.file_path}.replaying'
+
+    def park(self, stage: str, index: str,
+             items: Iterable[tuple[str, Any, Any]]) -> None:
+        """
+        Appends `(film_work_id, error, data)` items failed at `stage`.
+        The lines go in one `write` to a file opened with `O_APPEND`, so
+        processes sharing the file don't interleave them.
+        """
+        parked = str(datetime.now())
+        lines = ''.join(
+            json.dumps({'stage': stage, 'index': index, 'id': film_work_id,
+                        'error': error, 'data': data, 'parked': parked},
+                       ensure_ascii=False, default=str) + '\n'
+            for film_work_id, error, data in items)
+        if not lines:
+            return
+        encoded = lines.encode()
+        with self._lock:
+            fd = os.open(self.file_path,
+                         os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                written = os.write(fd, encoded)
+                # Regular files are written whole but for a signal or a full
+                # disk: the rest follows then
+                while written < len(encoded):
+                    written += os.write(fd, encoded[written:])
+            finally:
+                os.close(fd)
+        count = lines.count('\n')
+        DEAD_LETTERS.labels(stage).inc(count)
+        log.warning(f'{datetime.now()} {count} film_works failed at {stage} '
+                    f'and were parked in {self.file_path}.')
+
+    def replay(self,
+               load: Callable[[str, list[str]], None],
+               batch_size: int = 500) -> int:
+        """
+        Loads the parked film_works again with `load(index, ids)`, which
+        reads them from Postgres as they are now. Returns their number.
+
+        The file is moved aside first, so the film_works failing again
+        are parked in a new one. An interrupted replay leaves it there
+        and the next replay starts with it.
+        """
+        with self._lock:
+            if not os.path.exists(self.replaying_path):
+                if not os.path.exists(self.file_path):
+                    return 0
+                os.replace(self.file_path, self.replaying_path)
+
+        ids_by_index: dict[str, dict[str, None]] = {}
+        with open(self.replaying_path) as f:
+            for line in f:
+                if line.strip():
+                    letter = json.loads(line)
+                    ids_by_index.setdefault(letter['index'], {})[
+                        letter['id']] = None
+
+        replayed = 0
+        for index, ids in ids_by_index.items():
+            film_work_ids = list(ids)
+            for start in range(0, len(film_work_ids), batch_size):
+                chunk = film_work_ids[start:start + batch_size]
+                load(index, chunk)
+                DEAD_LETTERS_REPLAYED.inc(len(chunk))
+                replayed += len(chunk)
+
+        os.remove(self.replaying_path)
+        log.info(f'{datetime.now()} {replayed} parked film_works were '
+                 f'replayed.')
+        return replayed
+
+
+# Shared by every thread of the process
+dead_letters = DeadLetterQueue(ETL_DLQ_FILE)
@@ -1,17 +1,35 @@
 import json
 import logging
+import os
+import threading
+import time
+from collections import Counter
 from datetime import datetime
-from typing import Callable, Optional
+from decimal import Decimal
+from itertools import chain
+from multiprocessing.pool import ThreadPool
+from typing import Any, Iterator, NamedTuple, Optional
 
-from backoff import backoff
-from config import ES_INDEX, es_node
-from elasticsearch import Elasticsearch
-from psycopg2.extras import RealDictRow  # type: ignore
+import orjson
+
+from adaptive import AdaptiveBatchSize
+from backoff import TRANSIENT_STATUSES, CircuitBreaker, Retry, backoff
+from config import (ES_BREAKER_RESET, ES_BREAKER_THRESHOLD,
+                    ES_BULK_CHUNK_SIZE, ES_BULK_MAX_BYTES, ES_BULK_MAX_RETRIES,
+                    ES_BULK_RETRY_DEADLINE, ES_BULK_THREADS, ES_HTTP_COMPRESS,
+                    ES_INDEX, ES_POOL_SIZE, ES_SCHEMA_FILE, es_node)
+from dlq import dead_letters
+from elasticsearch import Elasticsearch, TransportError
+from metrics import DOCUMENTS, timed_call
+from pg_extractor import DocumentRow, FilmWorkRow
 
 log = logging.getLogger('Elastic')
 
+# Shared by every bulk request of the process
+elastic_breaker = CircuitBreaker('elastic', ES_BREAKER_THRESHOLD,
+                                 ES_BREAKER_RESET)
+
 
-@backoff()
 def get_elastic_schema(file_path: str) -> dict:
     """
     Returns the schema for the ElasticSearch index as a Python dictionary.
@@ -26,77 +44,301 @@ def get_elastic_schema(file_path: str) -> dict:
         return json.loads(content)
 
 
-@backoff()
-def transform_pg_to_es(pg_data: list[RealDictRow]) -> list[dict]:
-    prepared_data: list[dict] = []
+class Document(NamedTuple):
+    """
+    A document for the bulk `index` action, already serialized to JSON.
+    A document without `source` is deleted from the index. A `partial`
+    one holds only some fields and is merged into the indexed document.
+    """
+    index: str
+    id: str
+    source: Optional[str]
+    partial: bool = False
+
 
-    def is_writer(person: dict) -> bool:
-        return person.get('person_role') == 'writer'
+def serialize_default(value: Any) -> Any:
+    """
+    orjson serializes uuids and datetimes itself; numeric columns come
+    as `Decimal`.
+    """
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f'{type(value)} is not JSON serializable')
 
-    def is_director(person: dict) -> bool:
-        return person.get('person_role') == 'director'
 
-    def get_names(persons: list[dict]) -> list[Optional[str]]:
-        def get_name(person: dict) -> Optional[str]:
-            return person.get('name')
+def dumps(document: dict) -> str:
+    return orjson.dumps(document, default=serialize_default).decode()
 
-        return list(map(get_name, persons))
 
-    def is_actor(person: dict) -> bool:
-        return person.get('person_role') == 'actor'
+@timed_call('transform')
+def transform_pg_to_es(pg_data: list[FilmWorkRow],
+                       index: str = ES_INDEX) -> list[Document]:
+    """
+    Builds the documents for the given rows. Persons are split by role
+    in one pass over the list.
 
-    def get_persons(persons: list[dict], pred: Callable) -> list[dict]:
-        def strip_fields(p: dict) -> dict:
-            return {'id': p.get('person_id'),
-                    'name': p.get('person_name')}
+    A row which can't be transformed is parked in the dead letters,
+    the others are returned.
+    """
+    documents: list[Document] = []
+    failed: list[tuple[str, str, dict]] = []
 
-        return list(map(strip_fields, filter(pred, persons)))
+    for row in pg_data:
+        try:
+            director = ''
+            actors, actors_names = [], []
+            writers, writers_names = [], []
 
-    def get_director_name(persons: list[dict]) -> str:
-        directors = list(filter(is_director, persons))
-        director = list(filter(is_director, persons))[0] \
-            if len(directors) else {}
-        return director.get('person_name') or ''
+            for role, person_id, name in row.persons:
+                if role == 'actor':
+                    actors.append({'id': person_id, 'name': name})
+                    actors_names.append(name)
+                elif role == 'writer':
+                    writers.append({'id': person_id, 'name': name})
+                    writers_names.append(name)
+                elif role == 'director' and not director:
+                    director = name or ''
 
-    try:
-        for row in pg_data:
-            persons = row.get('persons')
-            actors = get_persons(persons, is_actor)
-            writers = get_persons(persons, is_writer)
-            prepared_row = {
-                'id': row.get('id'),
-                'imdb_rating': row.get('rating'),
-                'genre': row.get('genres'),
-                'title': row.get('title'),
-                'description': row.get('description'),
-                'director': get_director_name(persons),
-                'actors_names': get_names(actors),
-                'writers_names': get_names(writers),
+            documents.append(Document(index, row.id, dumps({
+                'id': row.id,
+                'imdb_rating': row.rating,
+                'genre': row.genres,
+                'title': row.title,
+                'description': row.description,
+                'director': director,
+                'actors_names': actors_names,
+                'writers_names': writers_names,
                 'actors': actors,
                 'writers': writers,
-            }
-            row_index = {
-                'index': {
-                    '_index': ES_INDEX,
-                    '_id': row.get('id')
-                }
-            }
-
-            prepared_data.append(row_index)
-            prepared_data.append(prepared_row)
-    except Exception as err:
-        log.error(
-            f'{datetime.now()} Failed while transforming the data.\n{err}\n\n')
-        raise
+                'modified': row.modified,
+            })))
+        except Exception as err:
+            log.error(f'{datetime.now()} Failed while transforming '
+                      f'film_work {row.id}.\n{err}\n\n')
+            failed.append((row.id, repr(err), row._asdict()))
 
-    return prepared_data
+    dead_letters.park('transform', index, failed)
+    return documents
 
 
-@backoff()
-def save_to_elastic(es_client: Elasticsearch, es_data: list[dict]) -> None:
+def wrap_pg_documents(pg_data: list[DocumentRow],
+                      index: str = ES_INDEX) -> list[Document]:
+    """
+    Documents built by Postgres go to the bulk request as they are.
+    """
+    return [Document(index, row.id, row.source) for row in pg_data]
+
+
+def park_rejected(documents: list[Document], failed: list[dict]) -> set[str]:
+    """
+    Parks the documents of the bulk items rejected by Elastic in the dead
+    letters. Returns their ids.
+    """
+    documents_by_id = {document.id: document for document in documents}
+    rejected: dict[str, list] = {}
+    for op_result in failed:
+        for result in op_result.values():
+            document = documents_by_id[result['_id']]
+            rejected.setdefault(document.index, []).append(
+                (document.id, result.get('error') or result.get('status'),
+                 document.source))
+    for index, items in rejected.items():
+        dead_letters.park('save', index, items)
+    return {document_id for items in rejected.values()
+            for document_id, _, _ in items}
+
+
+def expand_document(document: Document) -> tuple[dict, Optional[str]]:
+    """
+    Turns a document into a bulk action line and its source. The source
+    is passed to the bulk body as is, without another serialization.
+    """
+    if document.source is None:
+        return ({'delete': {'_index': document.index, '_id': document.id}},
+                None)
+    if document.partial:
+        return ({'update': {'_index': document.index, '_id': document.id}},
+                f'{{"doc":{document.source}}}')
+    return ({'index': {'_index': document.index, '_id': document.id}},
+            document.source)
+
+
+# Sends the bulk bodies of the documents which don't fit one body. Shared
+# by every worker; created on first use, and again in a forked process,
+# which doesn't inherit the threads.
+bulk_pool: Optional[tuple[int, ThreadPool]] = None
+bulk_pool_lock = threading.Lock()
+
+
+def get_bulk_pool() -> ThreadPool:
+    global bulk_pool
+    with bulk_pool_lock:
+        if bulk_pool is None or bulk_pool[0] != os.getpid():
+            bulk_pool = (os.getpid(), ThreadPool(ES_BULK_THREADS))
+        return bulk_pool[1]
+
+
+def iter_bulk_bodies(documents: list[Document],
+                     chunk_size: int,
+                     max_bytes: int
+                     ) -> Iterator[tuple[bytes, list[Document]]]:
+    """
+    Yields the NDJSON bulk bodies of the documents, cut by document count
+    and byte size, one at a time. Sources are already serialized, only
+    the action lines are dumped here, and every body is joined once.
+    """
+    lines: list[bytes] = []
+    size = 0
+    chunk: list[Document] = []
+
+    for document in documents:
+        action, source = expand_document(document)
+        document_lines = [orjson.dumps(action,
+                                       option=orjson.OPT_APPEND_NEWLINE)]
+        if source is not None:
+            document_lines.append(source.encode() + b'\n')
+        document_size = sum(map(len, document_lines))
+        if chunk and (len(chunk) == chunk_size
+                      or size + document_size > max_bytes):
+            yield b''.join(lines), chunk
+            lines, size, chunk = [], 0, []
+        lines += document_lines
+        size += document_size
+        chunk.append(document)
+
+    if chunk:
+        yield b''.join(lines), chunk
+
+
+def send_body(es_client: Elasticsearch, body: bytes) -> list[dict]:
+    """
+    Sends one bulk body. Returns the results of the items rejected by
+    Elastic; the response keeps only what's needed to find them.
+    """
+    response = es_client.bulk(
+        body=body,
+        filter_path='errors,items.*._id,items.*.status,items.*.error')
+    if not response.get('errors'):
+        return []
+
+    failed = []
+    for item in response['items']:
+        op, result = next(iter(item.items()))
+        if 200 <= result.get('status', 500) < 300:
+            continue
+        # Deleting a document which isn't in the index is fine
+        if op == 'delete' and result.get('status') == 404:
+            continue
+        failed.append(item)
+    return failed
+
+
+def send_bulk(es_client: Elasticsearch,
+              documents: list[Document]) -> list[dict]:
+    """
+    Sends the documents in bodies built by `iter_bulk_bodies`. A single
+    body is sent by the calling thread; when the documents don't fit one,
+    the bodies are sent by the shared bulk pool as they are built.
+    Returns the results of the items rejected by Elastic.
+    """
+    bodies = (body for body, _ in iter_bulk_bodies(
+        documents, ES_BULK_CHUNK_SIZE, ES_BULK_MAX_BYTES))
+    first = next(bodies, None)
+    if first is None:
+        return []
+    second = next(bodies, None)
+    if second is None:
+        return send_body(es_client, first)
+
+    results = get_bulk_pool().imap_unordered(
+        lambda body: send_body(es_client, body),
+        chain((first, second), bodies))
+    return [item for failed in results for item in failed]
+
+
+@backoff(breaker=elastic_breaker)
+@timed_call('save')
+def save_to_elastic(es_client: Elasticsearch,
+                    es_data: list[Document],
+                    sizer: Optional[AdaptiveBatchSize] = None) -> list[dict]:
+    """
+    Saves the documents to Elastic. Refresh is left to the index's
+    `refresh_interval`.
+
+    Transient transport errors are retried by `backoff` for the whole
+    batch and count towards opening `elastic_breaker`. Items
+    rejected because Elastic is overloaded are sent again one by one,
+    not the whole batch, with the jittered sleeps of `Retry`, and make
+    the `sizer` back off. Returns the results of the items that failed
+    for good.
+    """
     try:
-        es_client.bulk(index=ES_INDEX, body=es_data, refresh=True)
+        documents_by_id = {document.id: document for document in es_data}
+        documents = es_data
+        # Items failed for good in any attempt, and the transient ones
+        # of the last attempt
+        permanent: list[dict] = []
+        transient: list[dict] = []
+        retry = Retry(0.1, 2, 10, ES_BULK_RETRY_DEADLINE)
+
+        while True:
+            transient = []
+            for op_result in send_bulk(es_client, documents):
+                if any(result.get('status') in TRANSIENT_STATUSES
+                       for result in op_result.values()):
+                    transient.append(op_result)
+                else:
+                    permanent.append(op_result)
+
+            retry_statuses = {result['_id']: result.get('status')
+                              for op_result in transient
+                              for result in op_result.values()}
+            if not retry_statuses:
+                break
+            if sizer and 429 in retry_statuses.values():
+                sizer.reject()
+            if retry.attempt == ES_BULK_MAX_RETRIES:
+                break
+            status = max(retry_statuses.values())
+            sleep_time = retry.next_sleep(
+                'save_to_elastic',
+                TransportError(status, f'{len(retry_statuses)} items '
+                                       f'rejected with {status}'))
+            if sleep_time is None:
+                break
+            retry_ids = list(retry_statuses)
+            documents = [documents_by_id[_id] for _id in retry_ids]
+            log.warning(f'{datetime.now()} Retrying {len(documents)} items '
+                        f'rejected by ElasticSearch.')
+            time.sleep(sleep_time)
+
+        failed = permanent + transient
+        failed_ops: Counter = Counter()
+        missing = 0
+        for op_result in failed:
+            for op, result in op_result.items():
+                failed_ops[op] += 1
+                # Documents not in the index yet can't be partially
+                # updated: the caller loads them in full
+                if op == 'update' and result.get('status') == 404:
+                    missing += 1
+                    continue
+                log.error(f'{datetime.now()} Failed to save document '
+                          f'{result.get("_id")} to ElasticSearch: '
+                          f'{result.get("status")} {result.get("error")}')
+
+        deleted = sum(document.source is None for document in es_data)
+        partial = sum(document.partial for document in es_data)
+        # Every op has only its own failures subtracted
+        DOCUMENTS.labels('indexed').inc(len(es_data) - deleted - partial
+                                        - failed_ops['index'])
+        DOCUMENTS.labels('updated').inc(partial - failed_ops['update'])
+        DOCUMENTS.labels('deleted').inc(deleted - failed_ops['delete'])
+        DOCUMENTS.labels('failed').inc(len(failed) - missing)
+        return failed
     except Exception as err:
+        if sizer and getattr(err, 'status_code', None) == 429:
+            sizer.reject()
         log.error(f'{datetime.now()} Failed while saving'
                   f'to ElasticSearch.\n{err}\n\n')
         raise
@@ -107,17 +349,25 @@ def connect_elastic(failed_client: Optional[Elasticsearch] = None) -> Elasticsea
     if failed_client:
         failed_client.close()
     try:
-        es_client = Elasticsearch([es_node])
+        # The client keeps up to `maxsize` connections alive and puts
+        # a failed node aside for a while instead of pinging it.
+        es_client = Elasticsearch([es_node], maxsize=ES_POOL_SIZE,
+                                  retry_on_timeout=True,
+                                  http_compress=ES_HTTP_COMPRESS)
 
         log.info(f'\n{datetime.now()} Successfully connected to ElasticSearch '
                  f'node {es_node.get("host")}:{es_node.get("port")}.')
 
-        schema = get_elastic_schema('resources/es_schema.json')
+        schema = get_elastic_schema(ES_SCHEMA_FILE)
         if not es_client.indices.exists(index=ES_INDEX):
             es_client.indices.create(index=ES_INDEX, body=schema)
             log.info(
                 f'{datetime.now()} Index {ES_INDEX} was successfully created.')
         else:
+            # Fields added to the schema since the index was created,
+            # e.g. `modified`: the mapping is strict
+            es_client.indices.put_mapping(index=ES_INDEX,
+                                          body=schema['mappings'])
             log.warning(
                 f'{datetime.now()} Index {ES_INDEX} is already created.')
 
@@ -0,0 +1,173 @@
+import hashlib
+import logging
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Iterable
+
+from elasticsearch import Elasticsearch, helpers
+from es_loader import Document, dumps
+
+log = logging.getLogger('Fingerprint')
+
+# Ids per `IN (...)` query, below the SQLite limit of bound variables
+QUERY_CHUNK = 500
+
+
+def digest(source: str) -> bytes:
+    return hashlib.blake2b(source.encode(), digest_size=16).digest()
+
+
+class FingerprintCache:
+    """
+    Digests of the documents last saved to Elastic, by film_work id, in
+    a SQLite file. Documents equal to the saved ones aren't sent again.
+
+    Holds up to `max_size` digests: the least recently used ones are
+    evicted. A lost or evicted digest only means the document is sent
+    once more, so the file is written without syncing every commit.
+    """
+
+    def __init__(self, file_path: str, max_size: int):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(file_path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL;')
+        self._conn.execute('PRAGMA synchronous=NORMAL;')
+        with self._conn:
+            self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS fingerprints (
+                id TEXT PRIMARY KEY,
+                digest BLOB NOT NULL,
+                used INTEGER NOT NULL
+            );
+            """)
+            self._conn.execute("""
+            CREATE INDEX IF NOT EXISTS fingerprints_used
+            ON fingerprints (used);
+            """)
+        self._size, self._clock = self._conn.execute(
+            'SELECT count(*), coalesce(max(used), 0) FROM fingerprints;'
+        ).fetchone()
+        self.checked = 0
+        self.skipped = 0
+
+    def changed(self, documents: list[Document]) -> list[Document]:
+        """
+        Returns the documents which differ from the saved ones. Deletions
+        are always returned.
+        """
+        known = self._get_digests([document.id for document in documents
+                                   if document.source is not None])
+        changed, hits = [], []
+        for document in documents:
+            if document.source is not None \
+                    and known.get(document.id) == digest(document.source):
+                hits.append(document.id)
+            else:
+                changed.append(document)
+
+        with self._lock:
+            self.checked += len(documents)
+            self.skipped += len(hits)
+            self._clock += 1
+            with self._conn:
+                self._conn.executemany(
+                    'UPDATE fingerprints SET used = ? WHERE id = ?;',
+                    [(self._clock, film_work_id) for film_work_id in hits])
+        return changed
+
+    def remember(self, documents: Iterable[Document]) -> None:
+        """
+        Stores the digests of saved documents. Deleted documents are
+        forgotten.
+        """
+        saved, deleted = [], []
+        for document in documents:
+            if document.source is None:
+                deleted.append(document.id)
+            else:
+                saved.append((document.id, digest(document.source)))
+        self.forget(deleted)
+        self._put(saved)
+
+    def forget(self, film_work_ids: Iterable[str]) -> None:
+        rows = [(film_work_id,) for film_work_id in film_work_ids]
+        if not rows:
+            return
+        with self._lock, self._conn:
+            deleted = self._conn.executemany(
+                'DELETE FROM fingerprints WHERE id = ?;', rows).rowcount
+            self._size -= deleted
+
+    def clear(self) -> None:
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM fingerprints;')
+            self._size = 0
+
+    def rebuild(self, es_client: Elasticsearch, index: str) -> int:
+        """
+        Fills the cache from the documents in the index. Their digests are
+        taken from `dumps(_source)`, i.e. as `transform_pg_to_es` serializes
+        them; documents built by Postgres are sent once more afterwards.
+        """
+        self.clear()
+        rebuilt = 0
+        batch: list[tuple[str, bytes]] = []
+        for hit in helpers.scan(es_client, index=index, size=1000):
+            batch.append((hit['_id'], digest(dumps(hit['_source']))))
+            if len(batch) == 1000:
+                self._put(batch)
+                rebuilt += len(batch)
+                batch = []
+        self._put(batch)
+        rebuilt += len(batch)
+        log.info(f'{datetime.now()} {rebuilt} fingerprints were rebuilt '
+                 f'from {index}.')
+        return rebuilt
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'size': self._size,
+                    'checked': self.checked,
+                    'skipped': self.skipped,
+                    'skip_ratio': self.skipped / self.checked
+                    if self.checked else 0.0}
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def _get_digests(self, film_work_ids: list[str]) -> dict[str, bytes]:
+        with self._lock:
+            return self._select_digests(film_work_ids)
+
+    def _select_digests(self, film_work_ids: list[str]) -> dict[str, bytes]:
+        digests: dict[str, bytes] = {}
+        for start in range(0, len(film_work_ids), QUERY_CHUNK):
+            chunk = film_work_ids[start:start + QUERY_CHUNK]
+            placeholders = ', '.join('?' * len(chunk))
+            digests.update(self._conn.execute(
+                f'SELECT id, digest FROM fingerprints '
+                f'WHERE id IN ({placeholders});', chunk))
+        return digests
+
+    def _put(self, rows: list[tuple[str, bytes]]) -> None:
+        if not rows:
+            return
+        with self._lock, self._conn:
+            known = self._select_digests([row[0] for row in rows])
+            self._clock += 1
+            self._conn.executemany("""
+            INSERT INTO fingerprints (id, digest, used) VALUES (?, ?, ?)
+            ON CONFLICT (id) DO UPDATE SET digest = excluded.digest,
+                                           used = excluded.used;
+            """, [(film_work_id, value, self._clock)
+                  for film_work_id, value in rows])
+            self._size += len({row[0] for row in rows} - set(known))
+            if self._size > self.max_size:
+                self._conn.execute("""
+                DELETE FROM fingerprints WHERE id IN (
+                    SELECT id FROM fingerprints ORDER BY used LIMIT ?
+                );
+                """, (self._size - self.max_size,))
+                self._size = self.max_size
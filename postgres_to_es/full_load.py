@@ -0,0 +1,156 @@
+import logging
+import multiprocessing
+import signal
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from multiprocessing.connection import wait
+from typing import Callable, NamedTuple
+
+from config import ES_INDEX
+from es_loader import connect_elastic
+from pg_extractor import MAX_UUID, MIN_UUID, connect_pg, get_all_film_work_ids
+from scheduler import load_film_works
+from state import BaseStorage, State
+
+log = logging.getLogger('FullLoad')
+
+
+class Shard(NamedTuple):
+    """
+    Film_works with ids after `after_id` and up to `last_id`.
+    """
+    number: int
+    after_id: str
+    last_id: str
+
+
+def split_id_range(shards: int) -> list[Shard]:
+    """
+    Splits the uuid space into `shards` ranges of equal width. Uuids are
+    random, so the ranges hold about the same number of film_works.
+    """
+    bounds = [MIN_UUID]
+    for number in range(1, shards):
+        value = f'{number * 2 ** 128 // shards:032x}'
+        bounds.append(f'{value[:8]}-{value[8:12]}-{value[12:16]}-'
+                      f'{value[16:20]}-{value[20:]}')
+    bounds.append(MAX_UUID)
+    return [Shard(number, bounds[number], bounds[number + 1])
+            for number in range(shards)]
+
+
+def shard_key(shard: Shard) -> str:
+    return f'shard_{shard.number}'
+
+
+def load_shard(shard: Shard,
+               storage: BaseStorage,
+               index: str,
+               batch_size: int) -> None:
+    """
+    Loads one shard with its own connections. The last loaded id is
+    checkpointed after every batch, so a restarted shard continues
+    where it stopped.
+    """
+    # The parent stops the shards with SIGTERM
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    state = State(storage)
+    key = shard_key(shard)
+    saved = state.get_state(key)
+    after_id = saved or shard.after_id
+    if after_id == shard.last_id:
+        return
+
+    def checkpoint(film_work_id: str) -> None:
+        nonlocal saved
+        if not state.compare_and_set(key, saved, film_work_id):
+            # Another process loads the shard: the restarted shard
+            # continues from its checkpoint
+            raise Exception(f'The checkpoint of shard {shard.number} '
+                            f'was moved by another process.')
+        saved = film_work_id
+
+    pg_cursor = connect_pg()
+    es_client = connect_elastic()
+    started = time.monotonic()
+    loaded = 0
+    try:
+        for film_work_ids in get_all_film_work_ids(pg_cursor, batch_size,
+                                                   after_id, shard.last_id):
+            load_film_works(pg_cursor, es_client, film_work_ids, index)
+            checkpoint(film_work_ids[-1])
+            loaded += len(film_work_ids)
+        checkpoint(shard.last_id)
+    finally:
+        pg_cursor.connection.close()
+        es_client.close()
+
+    log.info(f'{datetime.now()} Shard {shard.number}: {loaded} film_works '
+             f'in {time.monotonic() - started:.1f}s.')
+
+
+def full_load(shards: int,
+              create_storage: Callable[[str], BaseStorage],
+              stop_event: threading.Event,
+              index: str = ES_INDEX,
+              batch_size: int = 500,
+              max_restarts: int = 3) -> bool:
+    """
+    Loads every film_work to `index`, with a process per range of ids.
+
+    A shard whose process fails is restarted from its checkpoint up to
+    `max_restarts` times; the others go on. Returns `True` once every
+    shard is loaded. Then the checkpoints are reset, so the next full
+    load starts from the beginning. A stopped or failed load keeps them,
+    and the next run only loads what's left.
+    """
+    name = f'full_load_{index}_{shards}'
+    ranges = split_id_range(shards)
+    restarts: Counter = Counter()
+    failed: list[int] = []
+
+    def shard_storage(shard: Shard) -> BaseStorage:
+        # A storage per shard: the file storage rewrites the whole file,
+        # so the shards would undo each other's checkpoints in a shared one
+        return create_storage(f'{name}_{shard.number}')
+
+    def start(shard: Shard) -> multiprocessing.Process:
+        process = multiprocessing.Process(
+            target=load_shard,
+            args=(shard, shard_storage(shard), index, batch_size),
+            name=f'{name}_{shard.number}',
+        )
+        process.start()
+        return process
+
+    running = {start(shard): shard for shard in ranges}
+    while running and not stop_event.is_set():
+        for sentinel in wait([p.sentinel for p in running], timeout=1):
+            process = next(p for p in running if p.sentinel == sentinel)
+            shard = running.pop(process)
+            process.join()
+            if process.exitcode == 0:
+                continue
+            if restarts[shard.number] < max_restarts:
+                restarts[shard.number] += 1
+                log.warning(f'{datetime.now()} Shard {shard.number} exited '
+                            f'with {process.exitcode}, restarting it.')
+                running[start(shard)] = shard
+            else:
+                log.error(f'{datetime.now()} Shard {shard.number} failed '
+                          f'{max_restarts + 1} times.')
+                failed.append(shard.number)
+
+    for process in running:
+        process.terminate()
+        process.join()
+    if running or failed:
+        return False
+
+    for shard in ranges:
+        State(shard_storage(shard)).set_state(shard_key(shard), None)
+    return True
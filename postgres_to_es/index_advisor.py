@@ -0,0 +1,201 @@
+import json
+import logging
+from datetime import datetime
+from typing import Iterator, NamedTuple, Optional
+
+from config import ENTITY_TABLES, PARTIAL_UPDATE_TABLES
+from pg_extractor import (MAX_UUID, MIN_UUID, Statement,
+                          all_film_work_ids_query, entity_ids_query,
+                          execute_query, prepare, query_film_work_documents,
+                          query_film_work_ids, query_film_works,
+                          query_partial_documents)
+from psycopg2 import sql  # type: ignore
+from psycopg2.extras import RealDictCursor, RealDictRow  # type: ignore
+
+log = logging.getLogger('IndexAdvisor')
+
+
+class Index(NamedTuple):
+    table: str
+    columns: tuple[str, ...]
+
+    @property
+    def name(self) -> str:
+        return f'{self.table}_{"_".join(self.columns)}_etl_idx'
+
+
+# Btree indexes the extractor's query shapes rely on: the keyset position
+# `(modified, id)` of every entity table and both sides of the junctions
+INDEXES = [
+    *(Index(table_name, ('modified', 'id')) for table_name in ENTITY_TABLES),
+    *(Index(f'{table_name}_film_work', (column, ))
+      for table_name in ENTITY_TABLES if table_name != 'film_work'
+      for column in (f'{table_name}_id', 'film_work_id')),
+]
+
+
+class Explained(NamedTuple):
+    """
+    Planning plus execution time of the fastest of the runs, the buffers
+    it touched and the plan nodes worth a look.
+    """
+    statement: str
+    milliseconds: float
+    buffers: int
+    flags: list[str]
+
+
+def query_shapes(pg_cursor: RealDictCursor,
+                 batch_size: int = 100) -> Iterator[tuple[Statement, tuple]]:
+    """
+    Every statement the extractor prepares, with the parameters of
+    a typical batch: the first `batch_size` entities of each table.
+    """
+    def first_ids(table_name: str) -> list[str]:
+        pg_cursor.execute(sql.SQL("""
+            SELECT id FROM content.{} ORDER BY modified, id LIMIT %s
+            """).format(sql.Identifier(table_name)), (batch_size, ))
+        return [row['id'] for row in pg_cursor.fetchall()]
+
+    film_work_ids = first_ids('film_work')
+    yield all_film_work_ids_query(), (MIN_UUID, MAX_UUID, batch_size)
+    for table_name in ENTITY_TABLES:
+        yield entity_ids_query(table_name), \
+            (str(datetime.min), MIN_UUID, batch_size)
+        if table_name == 'film_work':
+            continue
+        entity_ids = first_ids(table_name)
+        yield query_film_work_ids(table_name), (entity_ids, )
+        if table_name in PARTIAL_UPDATE_TABLES:
+            yield query_partial_documents(table_name), (entity_ids, )
+    yield query_film_works(), (film_work_ids, )
+    yield query_film_work_documents(), (film_work_ids, )
+
+
+def flag(node: dict) -> Iterator[str]:
+    """
+    Sequential scans and sorts in the plan tree: on a growing catalogue
+    they cost as much as the whole table.
+    """
+    rows = node.get('Actual Rows', 0) * node.get('Actual Loops', 1)
+    if node['Node Type'] == 'Seq Scan':
+        yield f'Seq Scan on {node["Relation Name"]} ({rows} rows)'
+    elif node['Node Type'] in ('Sort', 'Incremental Sort'):
+        yield f'{node["Node Type"]} by {", ".join(node["Sort Key"])} ' \
+              f'({rows} rows)'
+    for child in node.get('Plans', []):
+        yield from flag(child)
+
+
+def explain(pg_cursor: RealDictCursor, statement: Statement, params: tuple,
+            repeat: int = 3) -> Explained:
+    """
+    Runs `EXPLAIN (ANALYZE, BUFFERS)` of the prepared statement, so
+    the plan is the one the extractor gets.
+    """
+    if repeat < 1:
+        raise ValueError(f'A statement is explained at least once, '
+                         f'not {repeat} times.')
+    prepare(pg_cursor, statement)
+    query = sql.SQL('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ') \
+        + execute_query(statement)
+
+    def run() -> dict:
+        pg_cursor.execute(query, params)
+        plan = pg_cursor.fetchone()['QUERY PLAN']
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        plan = plan[0]
+        plan['Total Time'] = plan['Planning Time'] + plan['Execution Time']
+        return plan
+
+    best = min((run() for _ in range(repeat)),
+               key=lambda plan: plan['Total Time'])
+    root = best['Plan']
+    return Explained(
+        statement.name,
+        best['Total Time'],
+        root.get('Shared Hit Blocks', 0) + root.get('Shared Read Blocks', 0),
+        list(flag(root)),
+    )
+
+
+def explain_all(pg_cursor: RealDictCursor) -> list[Explained]:
+    return [explain(pg_cursor, statement, params)
+            for statement, params in list(query_shapes(pg_cursor))]
+
+
+def find_index(pg_cursor: RealDictCursor,
+               index: Index) -> Optional[RealDictRow]:
+    """
+    A btree index of the table whose leading columns are the wanted
+    ones, e.g. the unique `(genre_id, film_work_id)` serves `genre_id`.
+    Valid indexes come first: a failed concurrent build leaves an
+    invalid one behind.
+    """
+    pg_cursor.execute("""
+        SELECT c.relname AS name, i.indisvalid AS valid
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        JOIN pg_class t ON t.oid = i.indrelid
+        JOIN pg_namespace n ON n.oid = t.relnamespace
+        JOIN pg_am am ON am.oid = c.relam
+        WHERE n.nspname = 'content'
+          AND t.relname = %(table)s
+          AND am.amname = 'btree'
+          AND i.indpred IS NULL
+          AND i.indnkeyatts >= %(count)s
+          AND ARRAY(
+              SELECT pg_get_indexdef(i.indexrelid, k, true)
+              FROM generate_series(1, %(count)s) k
+              ORDER BY k
+          ) = %(columns)s::text[]
+        ORDER BY i.indisvalid DESC, c.relname = %(name)s DESC
+        LIMIT 1;
+        """, {'table': index.table, 'count': len(index.columns),
+              'columns': list(index.columns), 'name': index.name})
+    return pg_cursor.fetchone()
+
+
+def ensure_indexes(pg_cursor: RealDictCursor) -> list[str]:
+    """
+    Creates the missing `INDEXES` without locking the tables against
+    writes. The cursor has to be in autocommit: a concurrent build
+    can't run in a transaction. Returns the names of the new indexes.
+    """
+    created = []
+    for index in INDEXES:
+        found = find_index(pg_cursor, index)
+        if found and found['valid']:
+            continue
+        if found and found['name'] == index.name:
+            pg_cursor.execute(sql.SQL(
+                'DROP INDEX CONCURRENTLY IF EXISTS content.{};').format(
+                sql.Identifier(index.name)))
+
+        log.info(f'{datetime.now()} Creating index {index.name}.')
+        pg_cursor.execute(sql.SQL(
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON content.{} ({});'
+        ).format(sql.Identifier(index.name), sql.Identifier(index.table),
+                 sql.SQL(', ').join(map(sql.Identifier, index.columns))))
+        pg_cursor.execute(sql.SQL('ANALYZE content.{};').format(
+            sql.Identifier(index.table)))
+        created.append(index.name)
+    return created
+
+
+def report(before: list[Explained],
+           after: Optional[list[Explained]] = None) -> str:
+    lines = [f'{"statement":<32}{"ms":>10}{"buffers":>10}'
+             + (f'{"ms after":>10}{"buffers":>10}' if after else '')
+             + '  flags']
+    for number, explained in enumerate(before):
+        line = f'{explained.statement:<32}{explained.milliseconds:>10.2f}' \
+               f'{explained.buffers:>10}'
+        flags = explained.flags
+        if after:
+            line += f'{after[number].milliseconds:>10.2f}' \
+                    f'{after[number].buffers:>10}'
+            flags = after[number].flags
+        lines.append(f'{line}  {"; ".join(flags) or "-"}')
+    return '\n'.join(lines)
@@ -1,89 +1,370 @@
+import argparse
+import asyncio
 import logging
-import time
-from datetime import datetime
-from typing import Any, Generator
+import os
+import queue
+import signal
+import threading
+from typing import Optional
 
-from config import STATE_FILE
-from es_loader import connect_elastic, save_to_elastic, transform_pg_to_es
-from pg_extractor import (connect_pg, get_entity_ids, get_film_work_ids,
-                          get_film_works)
-from state import JsonFileStorage, State
+from adaptive import AdaptiveBatchSize
+from async_pipeline import run_async
+from cdc import ChangeListener
+from coalescer import Coalescer, InFlight
+from config import (ENTITY_TABLES, ES_INDEX, ETL_BATCH_MAX, ETL_BATCH_MIN,
+                    ETL_BATCH_TARGET_BYTES, ETL_BATCH_TARGET_SECONDS,
+                    ETL_CDC_ENABLED, ETL_CDC_POLL_INTERVAL, ETL_COALESCE_SIZE,
+                    ETL_COALESCE_WINDOW, ETL_FINGERPRINT_DB,
+                    ETL_FINGERPRINT_SIZE, ETL_PARTIAL_UPDATES,
+                    ETL_POLL_INTERVAL, ETL_QUEUE_SIZE, ETL_SPOOL_DIR,
+                    ETL_SPOOL_MAX_BYTES, ETL_SPOOL_SEGMENT_BYTES,
+                    ETL_WORKERS, METRICS_ADDR, METRICS_PORT,
+                    PARTIAL_UPDATE_TABLES,
+                    PG_POOL_CHECK_INTERVAL, PG_POOL_SIZE, PG_POOL_TIMEOUT,
+                    STATE_FILE, STATE_FLUSH_EVERY, STATE_FLUSH_INTERVAL, dsn,
+                    redis_node)
+from dlq import dead_letters
+from es_loader import connect_elastic
+from fingerprint import FingerprintCache
+from full_load import full_load
+from index_advisor import ensure_indexes, explain_all, report
+from metrics import register_stats, serve
+from pg_extractor import connect_pg
+from pg_pool import PgPool
+from reconcile import reconcile
+from redis import Redis
+from reindex import full_reindex
+from scheduler import Producer, SpoolLoader, Worker, load_film_works
+from spool import Spool
+from state import BaseStorage, JsonFileStorage, RedisStorage, State
 
 log = logging.getLogger('Main')
 
-connections = {
-    'pg_cursor': None,
-    'es_client': None,
-    'state': None
-}
 
-
-def get_connections():
+def create_storage(name: Optional[str] = None) -> BaseStorage:
     """
-    Returns available connections to Postgres, Elastic, and State.
-    Tries to reconnect (using backoff-ed functions) if they're not available.
+    Keeps the state in Redis when it's configured, so several ETL processes
+    can share it. Otherwise the state is kept in `STATE_FILE`.
+
+    A named state is kept apart from the state of the pipeline: in its own
+    Redis hash or next to `STATE_FILE`.
     """
-    global connections
+    if redis_node['host']:
+        if name:
+            return RedisStorage(Redis(**redis_node), key=f'etl_state:{name}')
+        return RedisStorage(Redis(**redis_node))
+    if name:
+        return JsonFileStorage(f'{STATE_FILE or "state.json"}.{name}')
+    return JsonFileStorage(STATE_FILE)
+
+
+def create_batch_size(name: str, target_bytes: Optional[int] = None
+                      ) -> AdaptiveBatchSize:
+    return AdaptiveBatchSize(name, 100, ETL_BATCH_MIN, ETL_BATCH_MAX,
+                             ETL_BATCH_TARGET_SECONDS, target_bytes)
 
-    pg_cursor = connections['pg_cursor']
-    es_client = connections['es_client']
-    state = connections['state']
 
-    is_pg_alive = pg_cursor and (not pg_cursor.closed)
-    is_es_alive = es_client and es_client.ping()
-    is_state_alive = bool(state)
+def create_fingerprints() -> Optional[FingerprintCache]:
+    if ETL_FINGERPRINT_DB:
+        return FingerprintCache(ETL_FINGERPRINT_DB, ETL_FINGERPRINT_SIZE)
+    return None
 
-    if not is_pg_alive:
-        connections['pg_cursor'] = connect_pg(failed_cursor=pg_cursor)
-    if not is_es_alive:
-        connections['es_client'] = connect_elastic(failed_client=es_client)
-    if not is_state_alive:
-        connections['state'] = State(JsonFileStorage(STATE_FILE))
 
-    return connections['pg_cursor'], connections['es_client'], connections[
-        'state']
+def create_spool(state: State) -> Optional[Spool]:
+    if ETL_SPOOL_DIR:
+        return Spool(ETL_SPOOL_DIR, state, ETL_SPOOL_SEGMENT_BYTES,
+                     ETL_SPOOL_MAX_BYTES)
+    return None
 
 
-def run_pipeline(table_name: str) -> None:
+def run_pipeline(table_names: list[str], stop_event: threading.Event) -> None:
     """
     Runs the process for retrieving/transforming/saving data from Postgres
-    to Elastic.
+    to Elastic until `stop_event` is set.
+
+    Every table is polled concurrently by its own producer, so a backlog
+    in one table doesn't delay the others. Producers feed film_work ids
+    to the coalescer, which drops duplicates and fills one queue drained
+    by a pool of workers; a film_work is loaded by one worker at a time.
+    Producers and workers borrow Postgres connections
+    from one pool of `PG_POOL_SIZE`. The entity ids per poll query and
+    the film_works per chunk adapt to the measured request times.
+
+    With `ETL_CDC_ENABLED` the changes are also pushed by Postgres
+    triggers to a listener, and the tables are polled only every
+    `ETL_CDC_POLL_INTERVAL` seconds to catch up what it missed.
+
+    Checkpoints are kept in memory and flushed every `STATE_FLUSH_EVERY`
+    batches, every `STATE_FLUSH_INTERVAL` seconds and on shutdown.
+
+    With `ETL_SPOOL_DIR` the workers write the documents to a disk spool
+    and the checkpoints move once they are there; a loader drains it into
+    Elastic, so extraction doesn't wait for Elastic.
+
+    With `ETL_PARTIAL_UPDATES` person and genre changes only update the
+    fields built from them. With `ETL_FINGERPRINT_DB` the documents equal
+    to the ones already saved are skipped.
+
+    Metrics of the stages, the pool, the coalescer, the fingerprints and
+    the spool are served on `METRICS_PORT`.
     """
-    pg_cursor, es_client, state = get_connections()
+    state = State(create_storage(), flush_every=STATE_FLUSH_EVERY)
+    es_client = connect_elastic()
+    pg_pool = PgPool(dsn, PG_POOL_SIZE, PG_POOL_TIMEOUT,
+                     PG_POOL_CHECK_INTERVAL)
+    changes_queue: queue.Queue = queue.Queue(maxsize=ETL_QUEUE_SIZE)
+    film_work_queue: queue.Queue = queue.Queue(maxsize=ETL_QUEUE_SIZE)
+
+    poll_interval = ETL_CDC_POLL_INTERVAL if ETL_CDC_ENABLED \
+        else ETL_POLL_INTERVAL
+
+    chunk_size = create_batch_size('film_works', ETL_BATCH_TARGET_BYTES)
+    fingerprints = create_fingerprints()
+    spool = create_spool(state)
+    in_flight = InFlight()
+
+    threads: list[threading.Thread] = [
+        Producer(table_name, changes_queue, state, stop_event, poll_interval,
+                 pg_pool, create_batch_size(f'entity_ids_{table_name}'),
+                 es_client,
+                 ETL_PARTIAL_UPDATES and table_name in PARTIAL_UPDATE_TABLES,
+                 fingerprints, spool, in_flight)
+        for table_name in table_names
+    ]
+    if ETL_CDC_ENABLED:
+        threads.append(ChangeListener(changes_queue, stop_event))
+    coalescer = Coalescer(changes_queue, film_work_queue, stop_event,
+                          ETL_COALESCE_WINDOW, ETL_COALESCE_SIZE, chunk_size,
+                          in_flight)
+    threads.append(coalescer)
+    threads += [
+        Worker(number, film_work_queue, es_client, stop_event, pg_pool,
+               chunk_size, fingerprints, spool, in_flight)
+        for number in range(ETL_WORKERS)
+    ]
+    if spool:
+        threads.append(SpoolLoader(spool, es_client, stop_event, pg_pool,
+                                   fingerprints))
+        register_stats('spool', spool.stats)
+    register_stats('pg_pool', pg_pool.stats)
+    register_stats('coalescer', coalescer.stats)
+    if fingerprints:
+        register_stats('fingerprints', fingerprints.stats)
+    serve(METRICS_PORT, METRICS_ADDR)
 
+    for thread in threads:
+        thread.start()
+
+    while not stop_event.wait(STATE_FLUSH_INTERVAL):
+        state.flush()
+
+    if spool:
+        # Releases the workers waiting for room in a full spool
+        spool.close()
+    for thread in threads:
+        thread.join()
+    state.flush()
+    log.info(f'Postgres pool: {pg_pool.stats()}')
+    pg_pool.close()
+    es_client.close()
+    if fingerprints:
+        log.info(f'Fingerprints: {fingerprints.stats()}')
+        fingerprints.close()
+
+
+def run_async_pipeline(table_names: list[str],
+                       stop_event: threading.Event) -> None:
+    """
+    The pipeline of `run_pipeline` on asyncpg and the async Elastic client
+    in one event loop: Postgres reads overlap with the bulk requests.
+    Changes are only polled, the coalescer is not used.
+    """
+    # Creates the index if it's missing
+    connect_elastic().close()
+    state = State(create_storage(), flush_every=STATE_FLUSH_EVERY)
+    fingerprints = create_fingerprints()
+    if fingerprints:
+        register_stats('fingerprints', fingerprints.stats)
+    serve(METRICS_PORT, METRICS_ADDR)
     try:
-        for entity_ids in get_entity_ids(pg_cursor, state, table_name):
-            for film_work_ids in get_film_work_ids(pg_cursor, table_name, entity_ids):
-                if not film_work_ids:
-                    return
-                for film_works in get_film_works(pg_cursor, film_work_ids):
-                    es_data = transform_pg_to_es(film_works)
-                    save_to_elastic(es_client, es_data)
-    except Exception as pipeline_err:
-        log.error(
-            f'{datetime.now()} Failed while running the pipeline.'
-            f'\n{pipeline_err}\n\n')
+        asyncio.run(run_async(
+            table_names, state, stop_event, ETL_POLL_INTERVAL,
+            PG_POOL_SIZE, ETL_WORKERS, ETL_QUEUE_SIZE,
+            create_batch_size('film_works', ETL_BATCH_TARGET_BYTES),
+            {table_name: create_batch_size(f'entity_ids_{table_name}')
+             for table_name in table_names},
+            STATE_FLUSH_INTERVAL, fingerprints))
+    finally:
+        if fingerprints:
+            fingerprints.close()
 
 
-def cycle_through(lst: list[Any]) -> Generator[Any, None, None]:
+def clear_fingerprints() -> None:
     """
-    Yields one list item at a time endlessly.
+    A full load sends the documents without the cache, so the digests
+    may not match the index any more.
     """
-    idx = 0
-    while True:
-        yield lst[idx]
-        penultimate_idx = len(lst) - 1
-        idx = idx + 1 if idx < penultimate_idx else 0
+    fingerprints = create_fingerprints()
+    if fingerprints:
+        fingerprints.clear()
+        fingerprints.close()
 
 
-if __name__ == '__main__':
+def run_full_reindex() -> None:
+    """
+    Rebuilds the index from scratch next to the live one and moves
+    the alias to it when it's ready.
+    """
+    pg_cursor = connect_pg()
+    es_client = connect_elastic()
     try:
-        # Run pipeline forever for each table at a time
-        for table_name in cycle_through(['film_work', 'genre', 'person']):
-            log.info(f'Exporting {table_name}...\n')
-            run_pipeline(table_name)
-            time.sleep(1)
+        new_index = full_reindex(pg_cursor, es_client)
+        log.info(f'Full reindex into {new_index} is finished.')
+        clear_fingerprints()
+    finally:
+        pg_cursor.connection.close()
+        es_client.close()
+
+
+def run_full_load(shards: int, stop_event: threading.Event) -> None:
+    """
+    Loads the whole catalogue to the live index with a process per shard.
+    The index is created first, so the shards don't race to create it.
+    """
+    connect_elastic().close()
+    if full_load(shards, create_storage, stop_event):
+        log.info(f'Full load with {shards} shards is finished.')
+        clear_fingerprints()
+    else:
+        log.error(f'Full load with {shards} shards is not finished, '
+                  f'run it again to load the rest.')
 
+
+def run_rebuild_fingerprints() -> None:
+    """
+    Fills the fingerprint cache from the live index, e.g. after the cache
+    file is lost, so the pipeline doesn't resend every document.
+    """
+    fingerprints = create_fingerprints()
+    if not fingerprints:
+        raise Exception('ETL_FINGERPRINT_DB is not set.')
+    es_client = connect_elastic()
+    try:
+        fingerprints.rebuild(es_client, ES_INDEX)
+    finally:
+        es_client.close()
+        fingerprints.close()
+
+
+def run_replay_dlq() -> None:
+    """
+    Loads the parked film_works again, as they are in Postgres now.
+    The ones failing again are parked anew.
+    """
+    pg_cursor = connect_pg()
+    es_client = connect_elastic()
+    try:
+        dead_letters.replay(
+            lambda index, film_work_ids: load_film_works(
+                pg_cursor, es_client, film_work_ids, index))
+    finally:
+        pg_cursor.connection.close()
+        es_client.close()
+
+
+def run_explain(create_indexes: bool = False) -> None:
+    """
+    Prints the plans of the extractor's query shapes. With
+    `create_indexes` the missing indexes are built and the plans are
+    compared with the ones before.
+    """
+    pg_cursor = connect_pg()
+    try:
+        before = explain_all(pg_cursor)
+        if not create_indexes:
+            print(report(before))
+            return
+        created = ensure_indexes(pg_cursor)
+        print(report(before, explain_all(pg_cursor)))
+        print(f'\nCreated indexes: {", ".join(created) or "none"}')
+    finally:
+        pg_cursor.connection.close()
+
+
+def run_reconcile(dry_run: bool = False) -> None:
+    """
+    Repairs the documents which drifted from Postgres, e.g. after lost
+    bulk requests or a restored backup of either side. With `dry_run`
+    the drift is only counted.
+    """
+    pg_cursor = connect_pg()
+    es_client = connect_elastic()
+    fingerprints = create_fingerprints()
+    try:
+        stats = reconcile(pg_cursor, es_client, ES_INDEX, fingerprints,
+                          dry_run)
+        print(', '.join(f'{name}: {value}' for name, value in stats.items()))
+    finally:
+        pg_cursor.connection.close()
+        es_client.close()
+        if fingerprints:
+            fingerprints.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Loads film_works from Postgres to ElasticSearch.')
+    parser.add_argument('--full-reindex', action='store_true',
+                        help='rebuild the index and swap the alias to it')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='run the pipeline on asyncio')
+    commands = parser.add_subparsers(dest='command')
+    full_load_parser = commands.add_parser(
+        'full-load', help='load every film_work with a process per id range')
+    full_load_parser.add_argument('--shards', type=int,
+                                  default=os.cpu_count())
+    commands.add_parser(
+        'rebuild-fingerprints',
+        help='fill the fingerprint cache from the documents in the index')
+    commands.add_parser(
+        'replay-dlq',
+        help='load the film_works parked in the dead letters again')
+    commands.add_parser(
+        'explain',
+        help='show the plans of the query shapes, flagging scans and sorts')
+    commands.add_parser(
+        'ensure-indexes',
+        help='create the indexes the query shapes need, concurrently')
+    reconcile_parser = commands.add_parser(
+        'reconcile',
+        help='compare Postgres and the index by id ranges, repair the drift')
+    reconcile_parser.add_argument('--dry-run', action='store_true',
+                                  help='only count the drifted documents')
+    args = parser.parse_args()
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+
+    try:
+        if args.full_reindex:
+            run_full_reindex()
+        elif args.command == 'full-load':
+            run_full_load(args.shards, stop)
+        elif args.command == 'rebuild-fingerprints':
+            run_rebuild_fingerprints()
+        elif args.command == 'replay-dlq':
+            run_replay_dlq()
+        elif args.command == 'explain':
+            run_explain()
+        elif args.command == 'ensure-indexes':
+            run_explain(create_indexes=True)
+        elif args.command == 'reconcile':
+            run_reconcile(args.dry_run)
+        elif args.use_async:
+            run_async_pipeline(ENTITY_TABLES, stop)
+        else:
+            run_pipeline(ENTITY_TABLES, stop)
     except Exception as err:
         log.error(f'Failed while running the pipeline.'
                   f'\n{type(err)}: {err}\n\n')
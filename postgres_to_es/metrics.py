@@ -0,0 +1,141 @@
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+from typing import Callable, Iterator
+
+from prometheus_client import (REGISTRY, Counter, Gauge, Histogram,
+                               start_http_server)
+from prometheus_client.core import GaugeMetricFamily
+
+STAGE_SECONDS = Histogram(
+    'etl_stage_seconds',
+    'Time spent in one call of a pipeline stage.',
+    ['stage'],
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10),
+)
+ROWS = Counter(
+    'etl_rows_total',
+    'Rows read from Postgres, by query.',
+    ['stage'],
+)
+SQL_QUERIES = Counter(
+    'etl_sql_queries_total',
+    'Round trips to Postgres, by prepared statement.',
+    ['statement'],
+)
+DOCUMENTS = Counter(
+    'etl_documents_total',
+    'Documents sent to Elastic, by result.',
+    ['result'],
+)
+BATCH_SIZE = Histogram(
+    'etl_batch_size',
+    'Items in one batch of a stage.',
+    ['stage'],
+    buckets=(1, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000),
+)
+RETRIES = Counter(
+    'etl_retries_total',
+    'Calls repeated by backoff after an error.',
+    ['function'],
+)
+ADAPTIVE_BATCH_SIZE = Gauge(
+    'etl_adaptive_batch_size',
+    'Current size of an adaptive batch.',
+    ['name'],
+)
+CIRCUIT_OPEN = Gauge(
+    'etl_circuit_open',
+    'Whether the circuit breaker of a service is open.',
+    ['name'],
+)
+DEAD_LETTERS = Counter(
+    'etl_dead_letters_total',
+    'Film_works parked in the dead letters, by failed stage.',
+    ['stage'],
+)
+DEAD_LETTERS_REPLAYED = Counter(
+    'etl_dead_letters_replayed_total',
+    'Parked film_works loaded again by replay-dlq.',
+)
+REPLICATION_LAG = Gauge(
+    'etl_replication_lag_seconds',
+    'Now minus the last checkpointed `modified` of the table.',
+    ['table'],
+)
+
+# Last checkpointed `modified` of every table, as a timestamp
+checkpoints: dict[str, float] = {}
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - started)
+
+
+def timed_call(stage: str) -> Callable:
+    """
+    Decorator for `timed`. Doesn't suit generators: their body runs
+    after the call returns.
+    """
+    def func_wrapper(func: Callable) -> Callable:
+        @wraps(func)
+        def inner(*args, **kwargs):
+            with timed(stage):
+                return func(*args, **kwargs)
+        return inner
+
+    return func_wrapper
+
+
+def count_rows(stage: str, count: int) -> None:
+    ROWS.labels(stage).inc(count)
+    BATCH_SIZE.labels(stage).observe(count)
+
+
+def set_checkpoint(table_name: str, modified: datetime) -> None:
+    """
+    The lag is computed when the metrics are scraped, so it keeps growing
+    while the checkpoint stands still.
+    """
+    if table_name not in checkpoints:
+        REPLICATION_LAG.labels(table_name).set_function(
+            lambda: time.time() - checkpoints[table_name])
+    checkpoints[table_name] = modified.timestamp()
+
+
+class StatsCollector:
+    """
+    Exports the `stats()` dictionaries of the pipeline's components,
+    e.g. `etl_pg_pool_in_use` for the key `in_use` of `pg_pool`.
+    """
+
+    def __init__(self):
+        self.sources: dict[str, Callable[[], dict]] = {}
+
+    def collect(self) -> Iterator[GaugeMetricFamily]:
+        for name, stats in list(self.sources.items()):
+            for key, value in stats().items():
+                yield GaugeMetricFamily(f'etl_{name}_{key}',
+                                        f'{key} of {name}.', value=value)
+
+
+stats_collector = StatsCollector()
+REGISTRY.register(stats_collector)
+
+
+def register_stats(name: str, stats: Callable[[], dict]) -> None:
+    stats_collector.sources[name] = stats
+
+
+def serve(port: int, addr: str) -> None:
+    """
+    Serves `/metrics` from a daemon thread. Port 0 turns it off.
+    """
+    if port:
+        start_http_server(port, addr=addr)
@@ -1,24 +1,61 @@
 import logging
+import time
 from datetime import datetime
-from typing import Any, Generator, Optional
+from typing import Any, Generator, NamedTuple, Optional
+from weakref import WeakKeyDictionary
 
 import psycopg2  # type: ignore
+import psycopg2.extensions  # type: ignore
+from adaptive import AdaptiveBatchSize
 from backoff import backoff
 from config import dsn
+from metrics import SQL_QUERIES, count_rows, set_checkpoint, timed
+from psycopg2 import sql  # type: ignore
 from psycopg2.extras import RealDictCursor, RealDictRow  # type: ignore
 from state import State
 
 log = logging.getLogger('Postgres')
 
+MIN_UUID = '00000000-0000-0000-0000-000000000000'
+MAX_UUID = 'ffffffff-ffff-ffff-ffff-ffffffffffff'
 
-def to_query_str(lst: list[str]) -> str:
+
+class Statement(NamedTuple):
+    """
+    A query shape with bind parameters `$1, $2, ...` of `param_types`.
+    It is prepared once per connection by `execute_prepared`.
     """
-    Returns a string for the inner part of an SQL-tuple.
+    name: str
+    param_types: tuple[str, ...]
+    query: sql.Composable
+
 
-    > to_query_str(['1', '2', '3'])
-    "'1', '2', '3'"  # in SQL it will become `('1', '2', '3')`
+class FilmWorkRow(NamedTuple):
     """
-    return ', '.join("'" + i + "'" for i in lst)
+    A row of `query_film_works`. `persons` holds `[role, id, name]` arrays.
+    """
+    id: str
+    title: str
+    description: Optional[str]
+    rating: Optional[float]
+    type: str
+    created: datetime
+    modified: datetime
+    persons: list[list]
+    genres: list[str]
+
+
+class DocumentRow(NamedTuple):
+    """
+    A row of `query_film_work_documents`: the Elastic document built
+    by Postgres, as JSON text.
+    """
+    id: str
+    source: str
+
+
+# Names of the statements prepared on each connection
+prepared_statements: WeakKeyDictionary = WeakKeyDictionary()
 
 
 def only_first_els(ts: list[tuple]) -> list[Any]:
@@ -31,72 +68,259 @@ def only_first_els(ts: list[tuple]) -> list[Any]:
     return [el[0] for el in ts]
 
 
-def entity_ids_query(table_name: str, from_modified: str):
+def entity_ids_query(table_name: str) -> Statement:
     """
-    Query has no `LIMIT`, should be used in generator.
+    Keyset-paginated query: returns the next `$3` rows after the
+    `($1 modified, $2 id)` position. The pair `(modified, id)` is unique,
+    so rows sharing the same `modified` are neither skipped nor read twice.
     """
-    return f"""
-    SELECT id, modified
-    FROM content.{table_name}
-    WHERE modified > '{from_modified}'
-    ORDER BY modified;
+    return Statement(
+        name=f'entity_ids_{table_name}',
+        param_types=('timestamptz', 'uuid', 'int'),
+        query=sql.SQL("""
+        SELECT id, modified
+        FROM content.{table}
+        WHERE (modified, id) > ($1, $2)
+        ORDER BY modified, id
+        LIMIT $3
+        """).format(table=sql.Identifier(table_name)),
+    )
+
+
+def all_film_work_ids_query() -> Statement:
+    """
+    Keyset-paginated query over a range of the catalogue: the next `$3`
+    film_work ids after the `$1` id and up to the `$2` id.
     """
+    return Statement(
+        name='all_film_work_ids',
+        param_types=('uuid', 'uuid', 'int'),
+        query=sql.SQL("""
+        SELECT id
+        FROM content.film_work
+        WHERE id > $1 AND id <= $2
+        ORDER BY id
+        LIMIT $3
+        """),
+    )
 
 
-def query_film_work_ids(table_name: str, ids: list[str]) -> str:
+def query_film_work_ids(table_name: str) -> Statement:
     """
+    Film_works linked to the `$1` array of entity ids.
     Query has no `LIMIT`, should be used in generator.
     """
-    return f"""
-    SELECT fw.id, fw.modified
-    FROM content.film_work fw
-    LEFT JOIN content.{table_name}_film_work tfw ON tfw.film_work_id = fw.id
-    WHERE tfw.{table_name}_id IN ({to_query_str(ids)})
-    ORDER BY fw.modified;
+    return Statement(
+        name=f'film_work_ids_{table_name}',
+        param_types=('uuid[]',),
+        query=sql.SQL("""
+        SELECT fw.id, fw.modified
+        FROM content.film_work fw
+        LEFT JOIN content.{link_table} tfw ON tfw.film_work_id = fw.id
+        WHERE tfw.{link_column} = ANY($1)
+        ORDER BY fw.modified
+        """).format(link_table=sql.Identifier(f'{table_name}_film_work'),
+                    link_column=sql.Identifier(f'{table_name}_id')),
+    )
+
+
+def query_film_works() -> Statement:
+    """
+    Film_works with their persons and genres for the `$1` array of ids.
+    Query has no `LIMIT`, should be used in generator.
     """
+    return Statement(
+        name='film_works',
+        param_types=('uuid[]',),
+        query=sql.SQL("""
+        SELECT
+        fw.id,
+        fw.title,
+        fw.description,
+        fw.rating,
+        fw.type,
+        fw.created,
+        fw.modified,
+        COALESCE (
+            json_agg(
+                DISTINCT jsonb_build_array(pfw.role, p.id, p.full_name)
+            ) FILTER (WHERE p.id is not null),
+            '[]'
+        ) as persons,
+        array_agg(DISTINCT g.name) as genres
+        FROM content.film_work fw
+        LEFT JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id
+        LEFT JOIN content.person p ON p.id = pfw.person_id
+        LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
+        LEFT JOIN content.genre g ON g.id = gfw.genre_id
+        WHERE fw.id = ANY($1)
+        GROUP BY fw.id
+        ORDER BY fw.modified
+        """),
+    )
+
+
+# Person fields of the `fw` film_work's document, for a lateral join
+PERSON_FIELDS = sql.SQL("""
+            SELECT
+            COALESCE(
+                json_agg(json_build_object('id', pr.id, 'name', pr.full_name)
+                         ORDER BY pr.id) FILTER (WHERE pfw.role = 'actor'),
+                '[]'
+            ) AS actors,
+            COALESCE(
+                json_agg(pr.full_name ORDER BY pr.id)
+                FILTER (WHERE pfw.role = 'actor'),
+                '[]'
+            ) AS actors_names,
+            COALESCE(
+                json_agg(json_build_object('id', pr.id, 'name', pr.full_name)
+                         ORDER BY pr.id) FILTER (WHERE pfw.role = 'writer'),
+                '[]'
+            ) AS writers,
+            COALESCE(
+                json_agg(pr.full_name ORDER BY pr.id)
+                FILTER (WHERE pfw.role = 'writer'),
+                '[]'
+            ) AS writers_names,
+            (array_agg(pr.full_name ORDER BY pr.id)
+             FILTER (WHERE pfw.role = 'director'))[1] AS director
+            FROM content.person_film_work pfw
+            JOIN content.person pr ON pr.id = pfw.person_id
+            WHERE pfw.film_work_id = fw.id
+""")
+
+# Genre names of the `fw` film_work's document, for a lateral join
+GENRE_FIELDS = sql.SQL("""
+            SELECT COALESCE(json_agg(DISTINCT gn.name), '[]') AS names
+            FROM content.genre_film_work gfw
+            JOIN content.genre gn ON gn.id = gfw.genre_id
+            WHERE gfw.film_work_id = fw.id
+""")
 
 
-def query_film_works(film_work_ids: list[str]) -> str:
+def query_film_work_documents() -> Statement:
     """
+    Same data as `query_film_works`, but Postgres builds the final Elastic
+    document for each film. It's returned as text, so it isn't parsed
+    on the way to the bulk request.
     Query has no `LIMIT`, should be used in generator.
     """
-    return f"""
-    SELECT
-    fw.id,
-    fw.title,
-    fw.description,
-    fw.rating,
-    fw.type,
-    fw.created,
-    fw.modified,
-    COALESCE (
-        json_agg(
-            DISTINCT jsonb_build_object(
-               'person_role', pfw.role,
-               'person_id', p.id,
-               'person_name', p.full_name
-            )
-        ) FILTER (WHERE p.id is not null),
-        '[]'
-    ) as persons,
-    array_agg(DISTINCT g.name) as genres
-    FROM content.film_work fw
-    LEFT JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id
-    LEFT JOIN content.person p ON p.id = pfw.person_id
-    LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
-    LEFT JOIN content.genre g ON g.id = gfw.genre_id
-    WHERE fw.id IN ({to_query_str(film_work_ids)})
-    GROUP BY fw.id
-    ORDER BY fw.modified;
+    return Statement(
+        name='film_work_documents',
+        param_types=('uuid[]',),
+        query=sql.SQL("""
+        SELECT fw.id, json_build_object(
+            'id', fw.id,
+            'imdb_rating', fw.rating,
+            'genre', g.names,
+            'title', fw.title,
+            'description', fw.description,
+            'director', COALESCE(p.director, ''),
+            'actors_names', p.actors_names,
+            'writers_names', p.writers_names,
+            'actors', p.actors,
+            'writers', p.writers,
+            'modified', fw.modified
+        )::text AS source
+        FROM content.film_work fw
+        LEFT JOIN LATERAL ({person_fields}) p ON true
+        LEFT JOIN LATERAL ({genre_fields}) g ON true
+        WHERE fw.id = ANY($1)
+        ORDER BY fw.modified
+        """).format(person_fields=PERSON_FIELDS, genre_fields=GENRE_FIELDS),
+    )
+
+
+def query_partial_documents(table_name: str) -> Statement:
+    """
+    Only the document fields built from `table_name` (persons or genres)
+    for the film_works linked to the `$1` array of its ids: the film_works
+    themselves and the other links aren't read.
+    Query has no `LIMIT`, should be used in generator.
+    """
+    if table_name == 'person':
+        fields = sql.SQL("""json_build_object(
+            'director', COALESCE(p.director, ''),
+            'actors_names', p.actors_names,
+            'writers_names', p.writers_names,
+            'actors', p.actors,
+            'writers', p.writers
+        )""")
+        lateral = sql.SQL('LEFT JOIN LATERAL ({}) p ON true').format(
+            PERSON_FIELDS)
+    else:
+        fields = sql.SQL("json_build_object('genre', g.names)")
+        lateral = sql.SQL('LEFT JOIN LATERAL ({}) g ON true').format(
+            GENRE_FIELDS)
+
+    return Statement(
+        name=f'partial_documents_{table_name}',
+        param_types=('uuid[]',),
+        query=sql.SQL("""
+        SELECT fw.id, {fields}::text AS source
+        FROM (
+            SELECT DISTINCT film_work_id AS id
+            FROM content.{link_table}
+            WHERE {link_column} = ANY($1)
+        ) fw
+        {lateral}
+        """).format(fields=fields,
+                    lateral=lateral,
+                    link_table=sql.Identifier(f'{table_name}_film_work'),
+                    link_column=sql.Identifier(f'{table_name}_id')),
+    )
+
+
+def prepare(pg_cursor: RealDictCursor, statement: Statement) -> None:
+    """
+    Prepares the statement on the server the first time it's needed on
+    a connection, so Postgres parses and plans each query shape once
+    instead of on every batch.
     """
+    prepared = prepared_statements.setdefault(pg_cursor.connection, set())
+    if statement.name in prepared:
+        return
+    pg_cursor.execute(sql.SQL('PREPARE {} ({}) AS {}').format(
+        sql.Identifier(statement.name),
+        sql.SQL(', ').join(map(sql.SQL, statement.param_types)),
+        statement.query,
+    ))
+    prepared.add(statement.name)
+    SQL_QUERIES.labels(statement.name).inc()
+
+
+def execute_query(statement: Statement) -> sql.Composed:
+    """`EXECUTE` of the prepared statement with `%s` placeholders."""
+    return sql.SQL('EXECUTE {} ({})').format(
+        sql.Identifier(statement.name),
+        sql.SQL(', ').join(sql.SQL(f'%s::{param_type}')
+                           for param_type in statement.param_types),
+    )
+
+
+def execute_prepared(pg_cursor: RealDictCursor,
+                     statement: Statement,
+                     params: tuple) -> None:
+    """
+    Executes the statement with bind parameters, preparing it first
+    if needed. Both round trips are counted in `etl_sql_queries_total`.
+    """
+    prepare(pg_cursor, statement)
+    pg_cursor.execute(execute_query(statement), params)
+    SQL_QUERIES.labels(statement.name).inc()
 
 
 @backoff()
 def connect_pg(failed_cursor: Optional[RealDictCursor] = None):
     if failed_cursor:
         failed_cursor.close()
+        failed_cursor.connection.close()
     try:
         conn = psycopg2.connect(**dsn, cursor_factory=RealDictCursor)
+        # The ETL only reads: a transaction left open between polls
+        # would hold locks on the tables and block DDL behind it.
+        conn.autocommit = True
         log.info(f'{datetime.now()} Successfully connected to Postgres.')
         return conn.cursor()
     except Exception as err:
@@ -104,40 +328,77 @@ def connect_pg(failed_cursor: Optional[RealDictCursor] = None):
         raise
 
 
-def get_entity_state(state: State, entity_table_name: str) -> str:
+def entity_position(saved: Any) -> tuple[str, str]:
+    """
+    The keyset position `(modified, id)` of an entity from its saved
+    state. A state saved as a plain `modified` string continues from
+    the first id with that `modified`.
+
+    > entity_position(State(JsonFileStorage('state.json')).get_state('genre'))
+    ('2022-05-11 13:05:31.142997+00:00', '6a0a479b-cfec-41ac-b520-...')
     """
-    Retrieves the state for the given entity.
+    if not saved:
+        return str(datetime.min), MIN_UUID
+    if isinstance(saved, str):
+        return saved, MIN_UUID
+    return saved['modified'], saved['id']
 
-    > get_entity_state(State(JsonFileStorage('state.json')), 'genre')
-    '2022-05-11 13:05:31.142997+00:00'
+
+def set_entity_state(state: State,
+                     entity_table_name: str,
+                     last_record: RealDictRow,
+                     expected: Any) -> bool:
+    """
+    Saves the keyset position of the last processed record, unless
+    the state isn't `expected` any more: another ETL sharing the state
+    moved it meanwhile, and it mustn't be moved back. Returns whether
+    the position was saved.
     """
-    current_state = state.get_state(entity_table_name)
-    if not current_state:
-        state.set_state(entity_table_name, str(datetime.min))
-        return state.get_state(entity_table_name)
+    saved = state.compare_and_set(entity_table_name, expected, {
+        'modified': str(last_record['modified']),
+        'id': str(last_record['id']),
+    })
+    if saved:
+        set_checkpoint(entity_table_name, last_record['modified'])
     else:
-        return current_state
+        log.warning(f'{datetime.now()} The checkpoint of '
+                    f'{entity_table_name} was moved by another ETL.')
+    return saved
 
 
 @backoff()
 def get_entity_ids(pg_cursor: RealDictCursor,
                    state: State,
                    entity_table_name: str,
-                   batch_size: int = 100
+                   batch_size: int = 100,
+                   sizer: Optional[AdaptiveBatchSize] = None
                    ) -> Generator[list[str], None, None]:
+    """
+    With a `sizer` every query takes its current size instead of
+    `batch_size` and reports its time back to it.
+    """
     try:
         while True:
-            last_modified = get_entity_state(state, entity_table_name)
-            pg_cursor.execute(
-                entity_ids_query(entity_table_name, last_modified)
-            )
-            entity_records = pg_cursor.fetchmany(batch_size)
+            saved = state.get_state(entity_table_name)
+            last_modified, last_id = entity_position(saved)
+            if sizer:
+                batch_size = sizer.value
+            started = time.perf_counter()
+            with timed('entity_ids'):
+                execute_prepared(pg_cursor,
+                                 entity_ids_query(entity_table_name),
+                                 (last_modified, last_id, batch_size))
+                entity_records = pg_cursor.fetchall()
+            if sizer:
+                sizer.observe(len(entity_records),
+                              time.perf_counter() - started)
             if not entity_records:
                 log.info(f'No modifications found in {entity_table_name}.')
                 break
+            count_rows('entity_ids', len(entity_records))
             yield [t['id'] for t in entity_records]
-            next_last_modified = entity_records[-1].get('modified')
-            state.set_state(entity_table_name, str(next_last_modified))
+            set_entity_state(state, entity_table_name, entity_records[-1],
+                             saved)
     except Exception as err:
         log.error(f'''{datetime.now()} Failed while extracting
             {entity_table_name} IDs.\n{err}\n\n''')
@@ -154,13 +415,15 @@ def get_film_work_ids(pg_cursor: RealDictCursor,
         if entity_table_name == 'film_work':
             yield entity_ids
         else:
-            pg_cursor.execute(
-                query_film_work_ids(entity_table_name, entity_ids)
-            )
+            with timed('film_work_ids'):
+                execute_prepared(pg_cursor,
+                                 query_film_work_ids(entity_table_name),
+                                 (entity_ids,))
             while True:
                 film_work_records = pg_cursor.fetchmany(batch_size)
                 if not film_work_records:
                     break
+                count_rows('film_work_ids', len(film_work_records))
                 yield [t['id'] for t in film_work_records]
     except Exception as err:
         log.error(
@@ -173,18 +436,106 @@ def get_film_work_ids(pg_cursor: RealDictCursor,
 def get_film_works(pg_cursor: RealDictCursor,
                    film_work_ids: list[str],
                    batch_size=100
-                   ) -> Generator[list[RealDictRow], None, None]:
+                   ) -> Generator[list[FilmWorkRow], None, None]:
+    """
+    Reads the rows through a plain tuple cursor on the same connection:
+    they are packed into `FilmWorkRow`s without building a dict per row.
+    """
     try:
-        pg_cursor.execute(query_film_works(film_work_ids))
+        with pg_cursor.connection.cursor(
+                cursor_factory=psycopg2.extensions.cursor) as tuple_cursor:
+            with timed('film_works'):
+                execute_prepared(tuple_cursor, query_film_works(),
+                                 (film_work_ids,))
 
-        while True:
-            records = pg_cursor.fetchmany(batch_size)
+            while True:
+                records = tuple_cursor.fetchmany(batch_size)
 
-            if not records:
-                break
+                if not records:
+                    break
 
-            yield records
+                count_rows('film_works', len(records))
+                yield list(map(FilmWorkRow._make, records))
     except Exception as err:
         log.error(f'{datetime.now()} Failed while extracting film_works data.'
                   f'\n{err}\n\n')
         raise
+
+
+@backoff()
+def get_all_film_work_ids(pg_cursor: RealDictCursor,
+                          batch_size: int = 100,
+                          after_id: str = MIN_UUID,
+                          last_id: str = MAX_UUID
+                          ) -> Generator[list[str], None, None]:
+    """
+    Yields the ids of every film_work in the catalogue, ordered by id,
+    or only of those after `after_id` and up to `last_id`.
+    """
+    try:
+        while True:
+            execute_prepared(pg_cursor, all_film_work_ids_query(),
+                             (after_id, last_id, batch_size))
+            film_work_ids = [t['id'] for t in pg_cursor.fetchall()]
+            if not film_work_ids:
+                break
+            yield film_work_ids
+            after_id = film_work_ids[-1]
+    except Exception as err:
+        log.error(f'{datetime.now()} Failed while extracting all film_work '
+                  f'IDs.\n{err}\n\n')
+        raise
+
+
+@backoff()
+def get_film_work_documents(pg_cursor: RealDictCursor,
+                            film_work_ids: list[str],
+                            batch_size=100
+                            ) -> Generator[list[DocumentRow], None, None]:
+    try:
+        with pg_cursor.connection.cursor(
+                cursor_factory=psycopg2.extensions.cursor) as tuple_cursor:
+            with timed('film_work_documents'):
+                execute_prepared(tuple_cursor, query_film_work_documents(),
+                                 (film_work_ids,))
+
+            while True:
+                records = tuple_cursor.fetchmany(batch_size)
+
+                if not records:
+                    break
+
+                count_rows('film_work_documents', len(records))
+                yield list(map(DocumentRow._make, records))
+    except Exception as err:
+        log.error(f'{datetime.now()} Failed while extracting film_work '
+                  f'documents.\n{err}\n\n')
+        raise
+
+
+@backoff()
+def get_partial_documents(pg_cursor: RealDictCursor,
+                          table_name: str,
+                          entity_ids: list[str],
+                          batch_size=100
+                          ) -> Generator[list[DocumentRow], None, None]:
+    try:
+        with pg_cursor.connection.cursor(
+                cursor_factory=psycopg2.extensions.cursor) as tuple_cursor:
+            with timed('partial_documents'):
+                execute_prepared(tuple_cursor,
+                                 query_partial_documents(table_name),
+                                 (entity_ids,))
+
+            while True:
+                records = tuple_cursor.fetchmany(batch_size)
+
+                if not records:
+                    break
+
+                count_rows('partial_documents', len(records))
+                yield list(map(DocumentRow._make, records))
+    except Exception as err:
+        log.error(f'{datetime.now()} Failed while extracting partial '
+                  f'{table_name} documents.\n{err}\n\n')
+        raise
@@ -0,0 +1,155 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Iterator, Optional
+
+from backoff import backoff
+from psycopg2.extensions import connection  # type: ignore
+from psycopg2.extras import RealDictCursor  # type: ignore
+from psycopg2.pool import PoolError, ThreadedConnectionPool  # type: ignore
+
+log = logging.getLogger('Postgres')
+
+
+@backoff()
+def create_pool(dsn: dict, size: int) -> ThreadedConnectionPool:
+    """
+    Opens all `size` connections at once: `ThreadedConnectionPool` keeps
+    only `minconn` returned connections and closes the others.
+    """
+    try:
+        pool = ThreadedConnectionPool(size, size, **dsn,
+                                      cursor_factory=RealDictCursor)
+        log.info(f'{datetime.now()} Opened {size} connections to Postgres.')
+        return pool
+    except Exception as err:
+        log.error(f'{datetime.now()} Postgres connection failed.\n{err}\n\n')
+        raise
+
+
+class PgPool:
+    """
+    Postgres connections shared by the threads of the pipeline. A thread
+    borrows a connection for one unit of work and waits up to `timeout`
+    seconds when all `size` connections are busy.
+
+    Connections are checked passively: a connection is tested with
+    `SELECT 1` only after a failed unit of work, or before reuse if it
+    has been idle for more than `check_interval` seconds. Broken ones
+    are closed and replaced on the next checkout.
+    """
+
+    def __init__(self,
+                 dsn: dict,
+                 size: int,
+                 timeout: float,
+                 check_interval: float):
+        self._pool = create_pool(dsn, size)
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._checked_at: dict[connection, float] = {}
+        self.size = size
+        self.timeout = timeout
+        self.check_interval = check_interval
+
+        self.in_use = 0
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.wait_seconds = 0.0
+        self.discarded = 0
+
+    @contextmanager
+    def cursor(self) -> Iterator[RealDictCursor]:
+        """
+        Borrows a connection for the body of the `with` block and
+        returns it to the pool afterwards.
+        """
+        conn = self.getconn()
+        healthy = True
+        try:
+            with conn.cursor() as pg_cursor:
+                yield pg_cursor
+        except Exception:
+            healthy = self.is_healthy(conn)
+            raise
+        finally:
+            self.putconn(conn, healthy)
+
+    def getconn(self) -> connection:
+        started = time.monotonic()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self.checkout_failures += 1
+            raise PoolError(f'No free Postgres connection '
+                            f'in {self.timeout}s.')
+        try:
+            conn = self._checkout()
+        except Exception as err:
+            self._slots.release()
+            with self._lock:
+                self.checkout_failures += 1
+            log.error(f'{datetime.now()} Postgres connection failed.'
+                      f'\n{err}\n\n')
+            raise
+
+        with self._lock:
+            self.in_use += 1
+            self.checkouts += 1
+            self.wait_seconds += time.monotonic() - started
+        return conn
+
+    def putconn(self, conn: connection, healthy: bool = True) -> None:
+        with self._lock:
+            self.in_use -= 1
+            if healthy:
+                self._checked_at[conn] = time.monotonic()
+            else:
+                self._checked_at.pop(conn, None)
+                self.discarded += 1
+        self._pool.putconn(conn, close=not healthy)
+        self._slots.release()
+
+    def _checkout(self) -> connection:
+        while True:
+            conn = self._pool.getconn()
+            if conn not in self._checked_at:
+                # A connection used for the first time, set up as in
+                # `connect_pg`
+                conn.autocommit = True
+                return conn
+            if self._is_fresh(conn) or self.is_healthy(conn):
+                return conn
+            with self._lock:
+                self._checked_at.pop(conn, None)
+                self.discarded += 1
+            self._pool.putconn(conn, close=True)
+
+    def _is_fresh(self, conn: connection) -> bool:
+        checked_at: Optional[float] = self._checked_at.get(conn)
+        return checked_at is not None \
+            and time.monotonic() - checked_at < self.check_interval
+
+    @staticmethod
+    def is_healthy(conn: connection) -> bool:
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor() as pg_cursor:
+                pg_cursor.execute('SELECT 1;')
+            return True
+        except Exception:
+            return False
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'size': self.size,
+                    'in_use': self.in_use,
+                    'checkouts': self.checkouts,
+                    'checkout_failures': self.checkout_failures,
+                    'wait_seconds': round(self.wait_seconds, 3),
+                    'discarded': self.discarded}
+
+    def close(self) -> None:
+        self._pool.closeall()
@@ -0,0 +1,201 @@
+import logging
+import math
+from datetime import datetime
+from itertools import product
+from typing import Iterator, Optional
+
+from config import ES_BULK_CHUNK_SIZE, ES_INDEX
+from elasticsearch import Elasticsearch
+from fingerprint import FingerprintCache
+from pg_extractor import MAX_UUID, MIN_UUID
+from psycopg2.extras import RealDictCursor  # type: ignore
+from scheduler import load_film_works
+
+log = logging.getLogger('Reconcile')
+
+HEX_DIGITS = '0123456789abcdef'
+# Film_works per bucket aimed at on the first level. Elastic sums
+# `modified` as doubles: the sums of millisecond timestamps are exact
+# for up to ~4000 documents per bucket.
+BUCKET_SIZE = 1000
+# Buckets per aggregation request to Elastic
+PAGE_SIZE = 256
+# Drifted buckets this small are compared id by id
+LEAF_SIZE = 500
+# Prefixes stay in the first group of the uuid, which has 8 digits
+MAX_DEPTH = 8
+
+# (count, sum of `modified` in milliseconds) of a bucket
+Bucket = tuple[int, int]
+
+
+def id_range(prefix: str) -> tuple[str, str]:
+    """
+    The first and the last uuid starting with the hex `prefix`.
+    """
+    padding = MAX_DEPTH - len(prefix)
+    return (prefix + '0' * padding + MIN_UUID[MAX_DEPTH:],
+            prefix + 'f' * padding + MAX_UUID[MAX_DEPTH:])
+
+
+def pg_buckets(pg_cursor: RealDictCursor, parent: str,
+               depth: int) -> dict[str, Bucket]:
+    """
+    Buckets of the ids under `parent` by their first `depth` digits,
+    in one `GROUP BY` over the range of `parent`.
+    """
+    lower, upper = id_range(parent)
+    pg_cursor.execute("""
+        SELECT left(id::text, %(depth)s) AS prefix,
+               count(*) AS count,
+               sum(floor(extract(epoch FROM modified) * 1000))::bigint
+                   AS modified
+        FROM content.film_work
+        WHERE id BETWEEN %(lower)s AND %(upper)s
+        GROUP BY 1;
+        """, {'depth': depth, 'lower': lower, 'upper': upper})
+    return {row['prefix']: (row['count'], row['modified'])
+            for row in pg_cursor.fetchall()}
+
+
+def es_buckets(es_client: Elasticsearch, index: str, parent: str,
+               depth: int) -> dict[str, Bucket]:
+    """
+    The same buckets in Elastic: a `filters` aggregation of the prefixes
+    of `id` with the sum of `modified` in each, `PAGE_SIZE` buckets
+    per request.
+    """
+    prefixes = [parent + ''.join(digits) for digits
+                in product(HEX_DIGITS, repeat=depth - len(parent))]
+    query = {'prefix': {'id': parent}} if parent else {'match_all': {}}
+    buckets = {}
+    for start in range(0, len(prefixes), PAGE_SIZE):
+        response = es_client.search(index=index, body={
+            'size': 0,
+            'query': query,
+            'aggs': {'buckets': {
+                'filters': {'filters': {
+                    prefix: {'prefix': {'id': prefix}}
+                    for prefix in prefixes[start:start + PAGE_SIZE]
+                }},
+                'aggs': {'modified': {'sum': {'field': 'modified'}}},
+            }},
+        })
+        for prefix, bucket in \
+                response['aggregations']['buckets']['buckets'].items():
+            if bucket['doc_count']:
+                buckets[prefix] = (bucket['doc_count'],
+                                   round(bucket['modified']['value']))
+    return buckets
+
+
+def find_drift(pg_cursor: RealDictCursor, es_client: Elasticsearch,
+               index: str, stats: dict) -> Iterator[tuple[str, int]]:
+    """
+    Yields the drifted buckets small enough to compare id by id, with
+    the larger of their two counts. The first level has about
+    `BUCKET_SIZE` film_works per bucket; a drifted bucket above
+    `LEAF_SIZE` is split by the next digit, so only the drifted ranges
+    are looked into.
+    """
+    pg_cursor.execute('SELECT count(*) AS count FROM content.film_work;')
+    total = pg_cursor.fetchone()['count']
+    depth = min(MAX_DEPTH, max(1, math.ceil(
+        math.log(max(total / BUCKET_SIZE, 1), len(HEX_DIGITS)))))
+
+    parents = [('', depth)]
+    while parents:
+        parent, depth = parents.pop()
+        pg = pg_buckets(pg_cursor, parent, depth)
+        es = es_buckets(es_client, index, parent, depth)
+        stats['buckets'] += len(HEX_DIGITS) ** (depth - len(parent))
+        for prefix in sorted(pg.keys() | es.keys()):
+            pg_bucket, es_bucket = pg.get(prefix, (0, 0)), \
+                es.get(prefix, (0, 0))
+            if pg_bucket == es_bucket:
+                continue
+            count = max(pg_bucket[0], es_bucket[0])
+            if count <= LEAF_SIZE or len(prefix) == MAX_DEPTH:
+                stats['drifted_buckets'] += 1
+                yield prefix, count
+            else:
+                parents.append((prefix, len(prefix) + 1))
+
+
+def compare_ids(pg_cursor: RealDictCursor, es_client: Elasticsearch,
+                index: str, prefix: str,
+                count: int) -> tuple[list[str], list[str]]:
+    """
+    Returns the film_works of the bucket which are missing in Elastic
+    or have another `modified` there, and the documents Postgres no
+    longer has.
+    """
+    lower, upper = id_range(prefix)
+    pg_cursor.execute("""
+        SELECT id, floor(extract(epoch FROM modified) * 1000)::bigint
+                   AS modified
+        FROM content.film_work
+        WHERE id BETWEEN %s AND %s;
+        """, (lower, upper))
+    pg_modified = {row['id']: row['modified']
+                   for row in pg_cursor.fetchall()}
+
+    response = es_client.search(index=index, body={
+        'size': count,
+        'query': {'prefix': {'id': prefix}},
+        '_source': False,
+        'docvalue_fields': [{'field': 'modified', 'format': 'epoch_millis'}],
+    })
+    es_modified: dict[str, Optional[int]] = {}
+    for hit in response['hits']['hits']:
+        # Documents saved before `modified` was added have none
+        values = hit.get('fields', {}).get('modified')
+        es_modified[hit['_id']] = int(float(values[0])) if values else None
+
+    stale = [film_work_id for film_work_id, modified in pg_modified.items()
+             if film_work_id not in es_modified
+             or es_modified[film_work_id] != modified]
+    orphans = [film_work_id for film_work_id in es_modified
+               if film_work_id not in pg_modified]
+    return stale, orphans
+
+
+def reconcile(pg_cursor: RealDictCursor,
+              es_client: Elasticsearch,
+              index: str = ES_INDEX,
+              fingerprints: Optional[FingerprintCache] = None,
+              dry_run: bool = False) -> dict:
+    """
+    Finds the film_works whose documents drifted from Postgres and loads
+    them again; orphaned documents are deleted. The id space is split
+    into buckets by the leading hex digits of the id, and the count and
+    the sum of `modified` of every bucket are compared on both sides,
+    so the work grows with the drift, not with the catalogue.
+
+    Only `modified` of the film_work is compared: a lost change of its
+    persons or genres alone isn't found.
+    """
+    stats = dict.fromkeys(['buckets', 'drifted_buckets', 'reindexed',
+                           'deleted'], 0)
+    es_client.indices.refresh(index=index)
+    for prefix, count in list(find_drift(pg_cursor, es_client, index,
+                                         stats)):
+        stale, orphans = compare_ids(pg_cursor, es_client, index, prefix,
+                                     count)
+        stats['reindexed'] += len(stale)
+        stats['deleted'] += len(orphans)
+        if dry_run or not (stale or orphans):
+            continue
+
+        film_work_ids = stale + orphans
+        if fingerprints:
+            # The cached digests describe documents the index doesn't have
+            fingerprints.forget(film_work_ids)
+        for start in range(0, len(film_work_ids), ES_BULK_CHUNK_SIZE):
+            # Ids missing in Postgres are deleted by `load_film_works`
+            load_film_works(pg_cursor, es_client,
+                            film_work_ids[start:start + ES_BULK_CHUNK_SIZE],
+                            index, fingerprints=fingerprints)
+
+    log.info(f'{datetime.now()} Reconciled {index}: {stats}.')
+    return stats
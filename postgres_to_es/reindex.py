@@ -0,0 +1,157 @@
+import copy
+import logging
+from datetime import datetime
+from typing import Generator
+
+from config import ENTITY_TABLES, ES_INDEX, ES_SCHEMA_FILE
+from elasticsearch import Elasticsearch
+from es_loader import get_elastic_schema
+from pg_extractor import (MIN_UUID, entity_ids_query, execute_prepared,
+                          get_all_film_work_ids, get_film_work_ids)
+from psycopg2.extras import RealDictCursor  # type: ignore
+from reconcile import reconcile
+from scheduler import load_film_works
+
+log = logging.getLogger('Reindex')
+
+# Index settings for the time of the bulk load
+BULK_SETTINGS = {'refresh_interval': '-1', 'number_of_replicas': 0}
+
+
+def get_changed_film_work_ids(pg_cursor: RealDictCursor,
+                              since: datetime,
+                              batch_size: int = 100
+                              ) -> Generator[list[str], None, None]:
+    """
+    Yields the ids of the film_works affected by changes in any entity
+    table after `since`. Doesn't touch the checkpoints of the ETL.
+    """
+    for table_name in ENTITY_TABLES:
+        last_modified, last_id = since, MIN_UUID
+        while True:
+            execute_prepared(pg_cursor, entity_ids_query(table_name),
+                             (last_modified, last_id, batch_size))
+            entity_records = pg_cursor.fetchall()
+            if not entity_records:
+                break
+            last_modified = entity_records[-1]['modified']
+            last_id = entity_records[-1]['id']
+            # The ids are read out before they are yielded: the caller
+            # runs its own queries on the same cursor.
+            film_work_ids = dict.fromkeys(
+                film_work_id
+                for chunk in get_film_work_ids(
+                    pg_cursor, table_name, [t['id'] for t in entity_records])
+                for film_work_id in chunk
+            )
+            if film_work_ids:
+                yield list(film_work_ids)
+
+
+def get_db_time(pg_cursor: RealDictCursor) -> datetime:
+    """
+    Current time of the database, not of the transaction start.
+    """
+    pg_cursor.execute('SELECT clock_timestamp() AS now;')
+    return pg_cursor.fetchone()['now']
+
+
+def get_live_indices(es_client: Elasticsearch) -> list[str]:
+    """
+    Returns the indices behind the `ES_INDEX` alias. Before the first full
+    reindex `ES_INDEX` is a plain index: then it's returned itself.
+    """
+    if es_client.indices.exists_alias(name=ES_INDEX):
+        return list(es_client.indices.get_alias(name=ES_INDEX))
+    if es_client.indices.exists(index=ES_INDEX):
+        return [ES_INDEX]
+    return []
+
+
+def get_live_settings(es_client: Elasticsearch, schema: dict) -> dict:
+    """
+    Settings to restore after the bulk load: the replicas of the live
+    index and the refresh interval from the schema.
+    """
+    settings = {
+        'refresh_interval': schema['settings'].get('refresh_interval', '1s'),
+        'number_of_replicas': 1,
+    }
+    live_indices = get_live_indices(es_client)
+    if live_indices:
+        live_settings = es_client.indices.get_settings(index=live_indices[0])
+        index_settings = live_settings[live_indices[0]]['settings']['index']
+        settings['number_of_replicas'] = int(
+            index_settings.get('number_of_replicas', 1))
+    return settings
+
+
+def swap_alias(es_client: Elasticsearch, new_index: str) -> None:
+    """
+    Atomically points the `ES_INDEX` alias to the new index. A plain
+    `ES_INDEX` index left from incremental loads is deleted in the same
+    request, since an alias can't share its name.
+    """
+    actions: list[dict] = []
+    if es_client.indices.exists_alias(name=ES_INDEX):
+        for old_index in es_client.indices.get_alias(name=ES_INDEX):
+            actions.append({'remove': {'index': old_index,
+                                       'alias': ES_INDEX}})
+    elif es_client.indices.exists(index=ES_INDEX):
+        actions.append({'remove_index': {'index': ES_INDEX}})
+    actions.append({'add': {'index': new_index, 'alias': ES_INDEX}})
+
+    es_client.indices.update_aliases(body={'actions': actions})
+
+
+def full_reindex(pg_cursor: RealDictCursor, es_client: Elasticsearch) -> str:
+    """
+    Rebuilds the index without downtime for readers:
+
+    1. creates a versioned index with refresh and replicas disabled;
+    2. loads every film_work into it through the usual extract/transform;
+    3. catches up the changes made during the load and deletes the
+       film_works deleted meanwhile, which no change points to;
+    4. restores the settings, force-merges and moves the alias to it;
+    5. catches up the changes made before the alias was moved.
+
+    Returns the name of the new index. The previous indices are kept,
+    so the alias can be moved back to them.
+    """
+    schema = get_elastic_schema(ES_SCHEMA_FILE)
+    live_settings = get_live_settings(es_client, schema)
+    new_index = f'{ES_INDEX}_{datetime.now():%Y%m%d%H%M%S}'
+
+    bulk_schema = copy.deepcopy(schema)
+    bulk_schema['settings'].update(BULK_SETTINGS)
+    es_client.indices.create(index=new_index, body=bulk_schema)
+    log.info(f'{datetime.now()} Index {new_index} was created.')
+
+    load_started = get_db_time(pg_cursor)
+    loaded = 0
+    for film_work_ids in get_all_film_work_ids(pg_cursor, batch_size=500):
+        load_film_works(pg_cursor, es_client, film_work_ids, new_index)
+        loaded += len(film_work_ids)
+    log.info(f'{datetime.now()} {loaded} film_works were loaded '
+             f'to {new_index}.')
+
+    catch_up_started = get_db_time(pg_cursor)
+    for film_work_ids in get_changed_film_work_ids(pg_cursor, load_started):
+        load_film_works(pg_cursor, es_client, film_work_ids, new_index)
+    # A deleted film_work leaves no row to be found by its `modified`
+    reconcile(pg_cursor, es_client, new_index)
+
+    es_client.indices.put_settings(index=new_index,
+                                   body={'index': live_settings})
+    es_client.indices.refresh(index=new_index)
+    es_client.indices.forcemerge(index=new_index, max_num_segments=1)
+    es_client.cluster.health(index=new_index, wait_for_status='yellow')
+
+    swap_alias(es_client, new_index)
+    log.info(f'{datetime.now()} Alias {ES_INDEX} was moved to {new_index}.')
+
+    for film_work_ids in get_changed_film_work_ids(pg_cursor,
+                                                   catch_up_started):
+        load_film_works(pg_cursor, es_client, film_work_ids)
+
+    return new_index
@@ -0,0 +1,71 @@
+-- Notifies the ETL about every film_work affected by a change. The payload
+-- is the film_work id; duplicates in a transaction are merged by Postgres.
+-- The script is idempotent; the listener runs it when it connects and some
+-- of the triggers are missing.
+-- Creating a trigger locks out the writers of its table, so the script
+-- gives up rather than queue the writers behind a long transaction.
+
+BEGIN;
+SET LOCAL lock_timeout = '5s';
+SELECT pg_advisory_xact_lock(hashtext('content.notify_film_work_change'));
+
+CREATE OR REPLACE FUNCTION content.notify_film_work_change()
+RETURNS trigger AS $$
+DECLARE
+    channel text := TG_ARGV[0];
+BEGIN
+    IF TG_TABLE_NAME = 'film_work' THEN
+        IF TG_OP <> 'INSERT' THEN
+            PERFORM pg_notify(channel, OLD.id::text);
+        END IF;
+        IF TG_OP <> 'DELETE' THEN
+            PERFORM pg_notify(channel, NEW.id::text);
+        END IF;
+    ELSIF TG_TABLE_NAME IN ('person_film_work', 'genre_film_work') THEN
+        IF TG_OP <> 'INSERT' THEN
+            PERFORM pg_notify(channel, OLD.film_work_id::text);
+        END IF;
+        IF TG_OP <> 'DELETE' THEN
+            PERFORM pg_notify(channel, NEW.film_work_id::text);
+        END IF;
+    ELSIF TG_TABLE_NAME = 'person' THEN
+        PERFORM pg_notify(channel, pfw.film_work_id::text)
+        FROM content.person_film_work pfw
+        WHERE pfw.person_id = CASE TG_OP WHEN 'DELETE' THEN OLD.id
+                                         ELSE NEW.id END;
+    ELSIF TG_TABLE_NAME = 'genre' THEN
+        PERFORM pg_notify(channel, gfw.film_work_id::text)
+        FROM content.genre_film_work gfw
+        WHERE gfw.genre_id = CASE TG_OP WHEN 'DELETE' THEN OLD.id
+                                        ELSE NEW.id END;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS etl_notify ON content.film_work;
+CREATE TRIGGER etl_notify
+    AFTER INSERT OR UPDATE OR DELETE ON content.film_work
+    FOR EACH ROW EXECUTE FUNCTION content.notify_film_work_change('film_work_changes');
+
+DROP TRIGGER IF EXISTS etl_notify ON content.person;
+CREATE TRIGGER etl_notify
+    AFTER UPDATE OR DELETE ON content.person
+    FOR EACH ROW EXECUTE FUNCTION content.notify_film_work_change('film_work_changes');
+
+DROP TRIGGER IF EXISTS etl_notify ON content.genre;
+CREATE TRIGGER etl_notify
+    AFTER UPDATE OR DELETE ON content.genre
+    FOR EACH ROW EXECUTE FUNCTION content.notify_film_work_change('film_work_changes');
+
+DROP TRIGGER IF EXISTS etl_notify ON content.person_film_work;
+CREATE TRIGGER etl_notify
+    AFTER INSERT OR UPDATE OR DELETE ON content.person_film_work
+    FOR EACH ROW EXECUTE FUNCTION content.notify_film_work_change('film_work_changes');
+
+DROP TRIGGER IF EXISTS etl_notify ON content.genre_film_work;
+CREATE TRIGGER etl_notify
+    AFTER INSERT OR UPDATE OR DELETE ON content.genre_film_work
+    FOR EACH ROW EXECUTE FUNCTION content.notify_film_work_change('film_work_changes');
+
+COMMIT;
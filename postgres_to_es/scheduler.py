@@ -0,0 +1,454 @@
+import logging
+import queue
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Generator, Optional
+
+from adaptive import AdaptiveBatchSize
+from coalescer import InFlight
+from config import (ES_BULK_CHUNK_SIZE, ES_BULK_THREADS, ES_INDEX,
+                    ETL_TRANSFORM)
+from elasticsearch import Elasticsearch
+from es_loader import (Document, elastic_breaker, park_rejected,
+                       save_to_elastic, transform_pg_to_es,
+                       wrap_pg_documents)
+from fingerprint import FingerprintCache
+from metrics import timed
+from pg_extractor import (get_entity_ids, get_film_work_documents,
+                          get_film_work_ids, get_film_works,
+                          get_partial_documents)
+from pg_pool import PgPool
+from psycopg2.extras import RealDictCursor  # type: ignore
+from spool import Spool
+from state import State
+
+log = logging.getLogger('Scheduler')
+
+
+def is_alive(pg_cursor: Optional[RealDictCursor]) -> bool:
+    return bool(pg_cursor) \
+        and not pg_cursor.closed \
+        and not pg_cursor.connection.closed
+
+
+def extract_documents(pg_cursor: RealDictCursor,
+                      film_work_ids: list[str],
+                      index: str = ES_INDEX
+                      ) -> Generator[list[Document], None, None]:
+    """
+    Yields the documents of the given film_works, shaped either by
+    `transform_pg_to_es` or by Postgres itself (`ETL_TRANSFORM=sql`).
+    The film_works are sent in one bulk request: the caller sizes
+    `film_work_ids` for it.
+
+    The ids Postgres doesn't return belong to deleted film_works, so
+    deletions are yielded for them last. Rows parked by the transform
+    are found, they aren't deleted.
+    """
+    batch_size = max(len(film_work_ids), 1)
+    missing_ids = dict.fromkeys(film_work_ids)
+    if ETL_TRANSFORM == 'sql':
+        for pg_documents in get_film_work_documents(pg_cursor, film_work_ids,
+                                                    batch_size):
+            for row in pg_documents:
+                missing_ids.pop(row.id, None)
+            yield wrap_pg_documents(pg_documents, index)
+    else:
+        for film_works in get_film_works(pg_cursor, film_work_ids,
+                                         batch_size):
+            for row in film_works:
+                missing_ids.pop(row.id, None)
+            yield transform_pg_to_es(film_works, index)
+
+    if missing_ids:
+        log.info(f'{datetime.now()} {len(missing_ids)} deleted film_works '
+                 f'are removed from {index}.')
+        yield [Document(index, film_work_id, None)
+               for film_work_id in missing_ids]
+
+
+def load_film_works(pg_cursor: RealDictCursor,
+                    es_client: Elasticsearch,
+                    film_work_ids: list[str],
+                    index: str = ES_INDEX,
+                    sizer: Optional[AdaptiveBatchSize] = None,
+                    fingerprints: Optional[FingerprintCache] = None,
+                    spool: Optional[Spool] = None
+                    ) -> None:
+    """
+    Saves the given film_works to Elastic, or deletes them from it when
+    they are deleted in Postgres. With a `spool` the documents are only
+    written to it: `SpoolLoader` saves them.
+
+    The time and the bulk body size of the whole load are reported to
+    the `sizer` of the chunks, the time also to the `load` stage metric.
+    Documents which are in `fingerprints` unchanged are skipped.
+    """
+    started = time.perf_counter()
+    size_bytes = 0
+    with timed('load'):
+        for documents in extract_documents(pg_cursor, film_work_ids, index):
+            size_bytes += sum(len(document.source or '')
+                              for document in documents)
+            if spool:
+                spool.append(documents)
+            else:
+                save_documents(es_client, documents, sizer, fingerprints)
+
+    if sizer:
+        sizer.observe(len(film_work_ids), time.perf_counter() - started,
+                      size_bytes)
+
+
+def save_documents(es_client: Elasticsearch,
+                   documents: list[Document],
+                   sizer: Optional[AdaptiveBatchSize] = None,
+                   fingerprints: Optional[FingerprintCache] = None) -> None:
+    """
+    Documents rejected by Elastic are parked in the dead letters, so
+    the rest of the batch counts as loaded. Only the fingerprints of
+    the saved documents are stored.
+    """
+    if fingerprints:
+        documents = fingerprints.changed(documents)
+        if not documents:
+            return
+    failed = save_to_elastic(es_client, documents, sizer)
+    parked = park_rejected(documents, failed) if failed else set()
+    if fingerprints:
+        fingerprints.remember(document for document in documents
+                              if document.id not in parked)
+
+
+def update_film_works(pg_cursor: RealDictCursor,
+                      es_client: Elasticsearch,
+                      table_name: str,
+                      entity_ids: list[str],
+                      index: str = ES_INDEX,
+                      fingerprints: Optional[FingerprintCache] = None,
+                      spool: Optional[Spool] = None,
+                      in_flight: Optional[InFlight] = None,
+                      stop_event: Optional[threading.Event] = None
+                      ) -> None:
+    """
+    Updates only the fields built from `table_name` (persons or genres)
+    in the documents of the film_works linked to the changed entities.
+
+    Film_works missing in the index can't be updated, they are loaded
+    in full. With a `spool` the updates are only written to it.
+
+    With `in_flight` the linked film_works are taken before they are
+    read, waiting for the workers loading them, so a partial update and
+    a full load of one film_work never overlap.
+    """
+    held: Optional[set[str]] = None
+    if in_flight:
+        held = {film_work_id
+                for film_work_ids in get_film_work_ids(pg_cursor, table_name,
+                                                       entity_ids)
+                for film_work_id in film_work_ids}
+        if not in_flight.acquire(list(held), stop_event):
+            raise Exception(f'Stopped before updating {table_name} '
+                            f'changes.')
+    try:
+        for rows in get_partial_documents(pg_cursor, table_name, entity_ids,
+                                          ES_BULK_CHUNK_SIZE):
+            # A film_work linked after the ids were read isn't held:
+            # the change was found before it was linked
+            documents = [Document(index, row.id, row.source, partial=True)
+                         for row in rows if held is None or row.id in held]
+            if spool:
+                spool.append(documents)
+                continue
+            missing_ids = save_partial_documents(es_client, documents,
+                                                 fingerprints)
+            if missing_ids:
+                load_film_works(pg_cursor, es_client, missing_ids, index,
+                                fingerprints=fingerprints)
+    finally:
+        if in_flight and held:
+            in_flight.release(held)
+
+
+def save_partial_documents(es_client: Elasticsearch,
+                           documents: list[Document],
+                           fingerprints: Optional[FingerprintCache] = None
+                           ) -> list[str]:
+    """
+    Sends the partial updates and returns the ids of the film_works
+    missing in the index. The fingerprints of the updated documents are
+    forgotten: their digests don't match the index any more.
+    """
+    if fingerprints:
+        fingerprints.forget(document.id for document in documents)
+    failed = save_to_elastic(es_client, documents)
+
+    missing_ids, rejected = [], []
+    for op_result in failed:
+        result = op_result['update']
+        if result.get('status') == 404:
+            missing_ids.append(result['_id'])
+        else:
+            rejected.append(op_result)
+    if rejected:
+        park_rejected(documents, rejected)
+    return missing_ids
+
+
+class Batch:
+    """
+    Film_work ids found for one batch of entity ids. The producer puts them
+    into the queue and waits until the workers have loaded every id before
+    it moves the checkpoint of its table.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded = threading.Event()
+        self._pending = 0
+        self._sealed = False
+        self.failed = False
+
+    def add(self, count: int) -> None:
+        with self._lock:
+            self._pending += count
+
+    def done(self, count: int, failed: bool = False) -> None:
+        with self._lock:
+            self._pending -= count
+            self.failed = self.failed or failed
+            self._notify()
+
+    def seal(self) -> None:
+        """No more ids will be added to the batch."""
+        with self._lock:
+            self._sealed = True
+            self._notify()
+
+    @property
+    def sealed(self) -> bool:
+        return self._sealed
+
+    def wait(self, timeout: float) -> bool:
+        return self._loaded.wait(timeout)
+
+    def _notify(self) -> None:
+        if self._sealed and self._pending == 0:
+            self._loaded.set()
+
+
+class Producer(threading.Thread):
+    """
+    Polls one entity table with a connection borrowed from the pool for
+    each poll and feeds the ids of the affected film_works to the
+    coalescer.
+
+    With `partial` the producer updates the affected documents itself
+    through `update_film_works`: the film_works aren't loaded anew, and
+    not while the workers load them (`in_flight`).
+    With a `spool` it doesn't wait for Elastic.
+    """
+
+    def __init__(self,
+                 table_name: str,
+                 film_work_queue: queue.Queue,
+                 state: State,
+                 stop_event: threading.Event,
+                 poll_interval: float,
+                 pg_pool: PgPool,
+                 batch_size: AdaptiveBatchSize,
+                 es_client: Optional[Elasticsearch] = None,
+                 partial: bool = False,
+                 fingerprints: Optional[FingerprintCache] = None,
+                 spool: Optional[Spool] = None,
+                 in_flight: Optional[InFlight] = None):
+        super().__init__(name=f'producer-{table_name}', daemon=True)
+        self.table_name = table_name
+        self.film_work_queue = film_work_queue
+        self.state = state
+        self.stop_event = stop_event
+        self.poll_interval = poll_interval
+        self.pg_pool = pg_pool
+        self.batch_size = batch_size
+        self.es_client = es_client
+        self.partial = partial
+        self.fingerprints = fingerprints
+        self.spool = spool
+        self.in_flight = in_flight
+
+    def run(self) -> None:
+        while not self.stop_event.is_set():
+            if elastic_breaker.is_open and not self.spool:
+                # Elastic is down: the extracted film_works would only
+                # wait in the workers' retries
+                self.stop_event.wait(1)
+                continue
+            try:
+                log.info(f'Exporting {self.table_name}...\n')
+                with self.pg_pool.cursor() as pg_cursor:
+                    self.export(pg_cursor)
+            except Exception as err:
+                log.error(f'{datetime.now()} Failed while exporting '
+                          f'{self.table_name}.\n{err}\n\n')
+            self.stop_event.wait(self.poll_interval)
+
+    def export(self, pg_cursor: RealDictCursor) -> None:
+        for entity_ids in get_entity_ids(pg_cursor, self.state,
+                                         self.table_name,
+                                         sizer=self.batch_size):
+            if self.partial:
+                update_film_works(pg_cursor, self.es_client, self.table_name,
+                                  entity_ids, fingerprints=self.fingerprints,
+                                  spool=self.spool, in_flight=self.in_flight,
+                                  stop_event=self.stop_event)
+                continue
+
+            batch = Batch()
+            for film_work_ids in get_film_work_ids(pg_cursor,
+                                                   self.table_name,
+                                                   entity_ids):
+                batch.add(len(film_work_ids))
+                if not self.put((film_work_ids, batch)):
+                    return
+            batch.seal()
+
+            while not batch.wait(timeout=1):
+                if self.stop_event.is_set():
+                    return
+            if batch.failed:
+                # Leaving the loop keeps the checkpoint before this batch,
+                # so it is extracted again on the next poll.
+                raise Exception(f'Failed to load a batch of '
+                                f'{self.table_name} changes.')
+
+    def put(self, item: tuple[list[str], Batch]) -> bool:
+        """
+        Waits for a free place in the queue. Returns `False` if the
+        scheduler was stopped meanwhile.
+        """
+        while not self.stop_event.is_set():
+            try:
+                self.film_work_queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+
+class Worker(threading.Thread):
+    """
+    Takes chunks of coalesced film_work ids from the shared queue, enriches
+    them in Postgres through a connection borrowed from the pool and saves
+    them to Elastic, or to the `spool`. The ids of a chunk are released
+    from `in_flight` once it's loaded or failed.
+    """
+
+    def __init__(self,
+                 number: int,
+                 film_work_queue: queue.Queue,
+                 es_client: Elasticsearch,
+                 stop_event: threading.Event,
+                 pg_pool: PgPool,
+                 chunk_size: AdaptiveBatchSize,
+                 fingerprints: Optional[FingerprintCache] = None,
+                 spool: Optional[Spool] = None,
+                 in_flight: Optional[InFlight] = None):
+        super().__init__(name=f'worker-{number}', daemon=True)
+        self.film_work_queue = film_work_queue
+        self.es_client = es_client
+        self.stop_event = stop_event
+        self.pg_pool = pg_pool
+        self.chunk_size = chunk_size
+        self.fingerprints = fingerprints
+        self.spool = spool
+        self.in_flight = in_flight
+
+    def run(self) -> None:
+        while not self.stop_event.is_set():
+            try:
+                film_work_ids, batches = self.film_work_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            try:
+                with self.pg_pool.cursor() as pg_cursor:
+                    load_film_works(pg_cursor, self.es_client,
+                                    film_work_ids, sizer=self.chunk_size,
+                                    fingerprints=self.fingerprints,
+                                    spool=self.spool)
+                self.acknowledge(batches)
+            except Exception as err:
+                log.error(f'{datetime.now()} Failed while loading '
+                          f'film_works.\n{err}\n\n')
+                self.acknowledge(batches, failed=True)
+            finally:
+                if self.in_flight:
+                    self.in_flight.release(film_work_ids)
+                self.film_work_queue.task_done()
+
+    @staticmethod
+    def acknowledge(batches: Counter, failed: bool = False) -> None:
+        for batch, count in batches.items():
+            batch.done(count, failed=failed)
+
+
+class SpoolLoader(threading.Thread):
+    """
+    Drains the spool into Elastic in order. A read is committed once
+    Elastic has taken it; a failed one is read again after a pause.
+    Partial updates of film_works missing in the index are loaded
+    from Postgres in full.
+    """
+
+    def __init__(self,
+                 spool: Spool,
+                 es_client: Elasticsearch,
+                 stop_event: threading.Event,
+                 pg_pool: PgPool,
+                 fingerprints: Optional[FingerprintCache] = None):
+        super().__init__(name='spool-loader', daemon=True)
+        self.spool = spool
+        self.es_client = es_client
+        self.stop_event = stop_event
+        self.pg_pool = pg_pool
+        self.fingerprints = fingerprints
+
+    def run(self) -> None:
+        while not self.stop_event.is_set():
+            if elastic_breaker.is_open:
+                self.stop_event.wait(1)
+                continue
+            documents = self.spool.read(ES_BULK_CHUNK_SIZE * ES_BULK_THREADS)
+            if not documents:
+                continue
+            try:
+                self.load(documents)
+                self.spool.commit()
+            except Exception as err:
+                log.error(f'{datetime.now()} Failed while loading spooled '
+                          f'documents.\n{err}\n\n')
+                self.spool.rewind()
+                self.stop_event.wait(1)
+
+    def load(self, documents: list[Document]) -> None:
+        full = [document for document in documents if not document.partial]
+        if full:
+            save_documents(self.es_client, full,
+                           fingerprints=self.fingerprints)
+
+        partial = [document for document in documents if document.partial]
+        if not partial:
+            return
+        missing_ids = save_partial_documents(self.es_client, partial,
+                                             self.fingerprints)
+        if not missing_ids:
+            return
+        indices = {document.id: document.index for document in partial}
+        with self.pg_pool.cursor() as pg_cursor:
+            for index in set(indices.values()):
+                load_film_works(pg_cursor, self.es_client,
+                                [film_work_id for film_work_id in missing_ids
+                                 if indices[film_work_id] == index],
+                                index, fingerprints=self.fingerprints)
@@ -0,0 +1,335 @@
+import logging
+import os
+import threading
+from datetime import datetime
+from typing import Iterator, NamedTuple
+
+import orjson
+from es_loader import Document
+from state import State
+
+log = logging.getLogger('Spool')
+
+SUFFIX = '.spool'
+
+
+class SpoolClosedError(Exception):
+    pass
+
+
+class Position(NamedTuple):
+    segment: int
+    offset: int
+
+
+def encode(document: Document) -> bytes:
+    """
+    One line per document: a JSON header, a tab and the serialized source,
+    which is left as it is. A deletion has no source. JSON text escapes
+    tabs and newlines, so neither appears in the source.
+    """
+    header = orjson.dumps({'index': document.index, 'id': document.id,
+                           'partial': document.partial})
+    return b'%s\t%s\n' % (header, (document.source or '').encode())
+
+
+def decode(line: bytes) -> Document:
+    header, source = line.rstrip(b'\n').split(b'\t', 1)
+    meta = orjson.loads(header)
+    return Document(meta['index'], meta['id'], source.decode() or None,
+                    meta['partial'])
+
+
+def decode_key(line: bytes) -> tuple[tuple[str, str], bool]:
+    """
+    The `(index, id)` of the line and whether it replaces the whole
+    document: a full document or a deletion, not a partial update.
+    """
+    meta = orjson.loads(line.split(b'\t', 1)[0])
+    return (meta['index'], meta['id']), not meta['partial']
+
+
+def fsync_directory(directory: str) -> None:
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+class Spool:
+    """
+    Durable buffer of documents between the workers, which extract and
+    transform film_works, and `SpoolLoader`, which saves them to Elastic.
+    While Elastic is slow or down, extraction goes on until the spool
+    holds `max_bytes`.
+
+    The documents are appended to numbered segment files of about
+    `segment_bytes` and synced before `append` returns, so the producer
+    may move its checkpoint past them. The loader reads them in order
+    and `commit`s what Elastic has accepted: the position is kept in
+    `state` under `state_key` and the segments before it are deleted.
+    After a crash the loader starts again from the last saved position
+    (documents are saved by id, so loading some of them twice does no
+    harm) and a line torn by the crash is cut off.
+
+    When the spool is full, the sealed segments not read yet are
+    compacted: a document followed by a newer full version or by
+    a deletion of the same film_work is dropped.
+    """
+
+    def __init__(self,
+                 directory: str,
+                 state: State,
+                 segment_bytes: int = 64 * 1024 * 1024,
+                 max_bytes: int = 1024 * 1024 * 1024,
+                 state_key: str = 'spool'):
+        if max_bytes <= segment_bytes:
+            raise ValueError(f'The spool of {max_bytes} bytes has to hold '
+                             f'more than a segment of {segment_bytes}.')
+        self.directory = directory
+        self.state = state
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.state_key = state_key
+        self._condition = threading.Condition()
+        self._closed = False
+        self._compacted_segment = -1
+        self._dropped = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._sizes: dict[int, int] = {
+            int(name[:-len(SUFFIX)]): os.path.getsize(
+                os.path.join(directory, name))
+            for name in os.listdir(directory) if name.endswith(SUFFIX)
+        }
+        if self._sizes:
+            self._cut_torn_line(max(self._sizes))
+
+        saved = state.get_state(state_key)
+        self._committed = self._resume(
+            Position(**saved) if saved else Position(0, 0))
+        self._read = self._committed
+        self._segment = max(self._sizes, default=self._committed.segment)
+        self._sizes.setdefault(self._segment, 0)
+        self._file = open(self.path(self._segment), 'ab')
+
+    def path(self, segment: int) -> str:
+        return os.path.join(self.directory, f'{segment:012d}{SUFFIX}')
+
+    def append(self, documents: list[Document]) -> None:
+        """
+        Writes the documents durably. Waits while the spool is full: the
+        segment being written is sealed, so once it's loaded it can be
+        deleted too.
+        """
+        data = b''.join(map(encode, documents))
+        if not data:
+            return
+        with self._condition:
+            while self._used() and self._used() + len(data) > self.max_bytes:
+                if self._closed:
+                    break
+                if self._compacted_segment < self._segment - 1:
+                    self._compact()
+                    continue
+                if self._sizes[self._segment]:
+                    self._roll()
+                    self._delete_loaded()
+                    continue
+                self._condition.wait(1)
+            if self._closed:
+                raise SpoolClosedError(f'Spool {self.directory} is closed.')
+
+            if self._sizes[self._segment] >= self.segment_bytes:
+                self._roll()
+            self._file.write(data)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._sizes[self._segment] += len(data)
+            self._condition.notify_all()
+
+    def read(self, max_documents: int, timeout: float = 1) -> list[Document]:
+        """
+        Returns up to `max_documents` documents after the last read ones,
+        waiting up to `timeout` seconds for some. A film_work appears once
+        in a read: its next version waits for the next read, so the two
+        are never saved concurrently.
+        """
+        with self._condition:
+            if self._at_end():
+                self._condition.wait(timeout)
+
+            documents: list[Document] = []
+            keys: set[tuple[str, str]] = set()
+            segment, offset = self._read
+            full = False
+            while not full and not self._closed:
+                if offset >= self._sizes[segment]:
+                    later = [s for s in self._sizes if s > segment]
+                    if not later:
+                        break
+                    segment, offset = min(later), 0
+                    continue
+
+                with open(self.path(segment), 'rb') as f:
+                    f.seek(offset)
+                    for line in f:
+                        document = decode(line)
+                        key = (document.index, document.id)
+                        full = key in keys or len(documents) >= max_documents
+                        if full:
+                            break
+                        keys.add(key)
+                        documents.append(document)
+                        offset += len(line)
+
+            self._read = Position(segment, offset)
+            return documents
+
+    def commit(self) -> None:
+        """
+        Marks the documents read so far as saved to Elastic.
+        """
+        with self._condition:
+            self._committed = self._read
+            self._delete_loaded()
+            self._condition.notify_all()
+
+    def rewind(self) -> None:
+        """
+        The documents read since the last commit are read again.
+        """
+        with self._condition:
+            self._read = self._committed
+
+    def close(self) -> None:
+        """
+        Wakes the writers waiting for room: they fail with
+        `SpoolClosedError`, so their batches aren't checkpointed.
+        """
+        with self._condition:
+            self._closed = True
+            self._file.close()
+            self._condition.notify_all()
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                'segments': len(self._sizes),
+                'bytes': self._used(),
+                'pending_bytes': sum(
+                    size for segment, size in self._sizes.items()
+                    if segment >= self._committed.segment)
+                - self._committed.offset,
+                'compacted_documents': self._dropped,
+            }
+
+    def _used(self) -> int:
+        return sum(self._sizes.values())
+
+    def _delete_loaded(self) -> None:
+        """
+        Saves the committed position and deletes the segments before it.
+        A position at the end of a sealed segment is moved to the start
+        of the next one, so that segment is deleted as well.
+        """
+        segment, offset = self._committed
+        if segment < self._segment and offset >= self._sizes[segment]:
+            self._committed = Position(
+                min(s for s in self._sizes if s > segment), 0)
+            if self._read.segment == segment:
+                self._read = self._committed
+        self.state.set_state(self.state_key, self._committed._asdict())
+        for segment in [s for s in self._sizes
+                        if s < self._committed.segment]:
+            os.remove(self.path(segment))
+            del self._sizes[segment]
+
+    def _at_end(self) -> bool:
+        return self._read.offset >= self._sizes[self._read.segment] \
+            and self._read.segment == self._segment
+
+    def _resume(self, position: Position) -> Position:
+        """
+        Segments before the saved position are loaded already: the crash
+        came before they were deleted. A missing segment of the position
+        was deleted after it was loaded, so the next one is started.
+        """
+        for segment in [s for s in self._sizes if s < position.segment]:
+            os.remove(self.path(segment))
+            del self._sizes[segment]
+        if position.segment in self._sizes:
+            return Position(position.segment,
+                            min(position.offset,
+                                self._sizes[position.segment]))
+        return Position(min(self._sizes, default=position.segment), 0)
+
+    def _cut_torn_line(self, segment: int) -> None:
+        size = self._sizes[segment]
+        with open(self.path(segment), 'rb+') as f:
+            end = size
+            while end > 0:
+                start = max(end - 65536, 0)
+                f.seek(start)
+                newline = f.read(end - start).rfind(b'\n')
+                if newline >= 0:
+                    end = start + newline + 1
+                    break
+                end = start
+            if end < size:
+                log.warning(f'{datetime.now()} {size - end} bytes of a torn '
+                            f'line are cut off from {self.path(segment)}.')
+                f.truncate(end)
+                self._sizes[segment] = end
+
+    def _roll(self) -> None:
+        self._file.close()
+        self._segment += 1
+        self._sizes[self._segment] = 0
+        self._file = open(self.path(self._segment), 'ab')
+        fsync_directory(self.directory)
+
+    def _lines(self, segment: int) -> Iterator[bytes]:
+        with open(self.path(segment), 'rb') as f:
+            yield from f
+
+    def _compact(self) -> None:
+        """
+        Rewrites the sealed segments after the one being read. Only
+        the last version of a document has to reach Elastic.
+        """
+        self._compacted_segment = self._segment - 1
+        segments = sorted(s for s in self._sizes
+                          if self._read.segment < s < self._segment)
+        if not segments:
+            return
+
+        latest: dict[tuple[str, str], tuple[int, int]] = {}
+        for segment in segments + [self._segment]:
+            for number, line in enumerate(self._lines(segment)):
+                key, replaces = decode_key(line)
+                if replaces:
+                    latest[key] = (segment, number)
+
+        dropped = 0
+        for segment in segments:
+            temp_path = f'{self.path(segment)}.compacting'
+            size = 0
+            with open(temp_path, 'wb') as f:
+                for number, line in enumerate(self._lines(segment)):
+                    key, _ = decode_key(line)
+                    if latest.get(key, (segment, number)) > (segment, number):
+                        dropped += 1
+                        continue
+                    f.write(line)
+                    size += len(line)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path(segment))
+            self._sizes[segment] = size
+        fsync_directory(self.directory)
+
+        self._dropped += dropped
+        log.info(f'{datetime.now()} {dropped} superseded documents are '
+                 f'compacted out of {len(segments)} spool segments.')
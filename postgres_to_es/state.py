@@ -1,12 +1,20 @@
 import abc
 import json
+import os
+import tempfile
+import threading
+import time
 from pathlib import Path
 from typing import Any, Optional
 
 from redis import Redis
+from redis.exceptions import WatchError
 
 
 class BaseStorage:
+    # Хранилище, в которое пишут и другие процессы ETL
+    shared = False
+
     @abc.abstractmethod
     def save_state(self, state: dict) -> None:
         """Сохранить состояние в постоянное хранилище"""
@@ -17,6 +25,14 @@ class BaseStorage:
         """Загрузить состояние локально из постоянного хранилища"""
         pass
 
+    def compare_and_set(self, key: str, expected: Any, value: Any) -> bool:
+        """
+        Атомарно записать `value`, если в хранилище сейчас `expected`.
+        Вернуть `False`, если значение успели поменять.
+        """
+        raise NotImplementedError(
+            f'{type(self).__name__} does not support compare-and-set.')
+
 
 class JsonFileStorage(BaseStorage):
     """
@@ -33,10 +49,27 @@ class JsonFileStorage(BaseStorage):
         Path(self.file_path).touch()
 
     def save_state(self, state):
+        """
+        Replaces the file atomically: the new state is written and synced
+        to a temporary file, which is then renamed over the old one.
+        A crash leaves either the old or the new state, never a torn file.
+        """
         prev_state = self.retrieve_state()
         new_state = {**prev_state, **state}
-        with open(self.file_path, 'w') as file:
+
+        directory = os.path.dirname(os.path.abspath(self.file_path))
+        with tempfile.NamedTemporaryFile('w', dir=directory,
+                                         delete=False) as file:
             file.write(json.dumps(new_state))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(file.name, self.file_path)
+
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
 
     def retrieve_state(self):
         with open(self.file_path, 'r') as f:
@@ -47,6 +80,16 @@ class JsonFileStorage(BaseStorage):
 
             return json.loads(content)
 
+    def compare_and_set(self, key: str, expected: Any, value: Any) -> bool:
+        """
+        The file has a single writer, so reading and then replacing it
+        is enough.
+        """
+        if self.retrieve_state().get(key) != expected:
+            return False
+        self.save_state({key: value})
+        return True
+
 
 class State:
     """
@@ -54,19 +97,72 @@ class State:
     не перечитывать данные с начала. Здесь представлена реализация
     с сохранением состояния в файл. В целом ничего не мешает поменять это
     поведение на работу с БД или распределённым хранилищем.
+
+    Состояние хранится в памяти и сбрасывается в хранилище раз в
+    `flush_every` изменений, а также при вызове `flush()`. Общее хранилище
+    (`shared`) перечитывается при каждом `get_state`, чтобы видеть
+    чекпоинты других процессов.
     """
 
-    def __init__(self, storage: BaseStorage):
+    def __init__(self, storage: BaseStorage, flush_every: int = 1):
         self.storage = storage
+        self.flush_every = flush_every
+        # Producers of different tables share one State
+        self._lock = threading.Lock()
+        self._state = storage.retrieve_state()
+        self._unsaved: dict = {}
+        self._updates = 0
 
     def set_state(self, key: str, value: Any) -> None:
         """Установить состояние для определённого ключа"""
-        self.storage.save_state({key: value})
+        with self._lock:
+            self._set(key, value)
 
     def get_state(self, key: str) -> Any:
         """Получить состояние по определённому ключу"""
-        state = self.storage.retrieve_state()
-        return state.get(key)
+        with self._lock:
+            if self.storage.shared:
+                self._state = {**self.storage.retrieve_state(),
+                               **self._unsaved}
+            return self._state.get(key)
+
+    def flush(self) -> None:
+        """Сохранить накопленные изменения в хранилище"""
+        with self._lock:
+            self._flush()
+
+    def compare_and_set(self, key: str, expected: Any, value: Any) -> bool:
+        """
+        Атомарно заменить значение в хранилище, если его не поменял другой
+        процесс. Используется, когда состояние делят несколько ETL.
+        Хранилище, в которое пишет только этот процесс, сравнивается
+        с состоянием в памяти, и запись копится, как в `set_state`.
+        """
+        with self._lock:
+            if not self.storage.shared:
+                if self._state.get(key) != expected:
+                    return False
+                self._set(key, value)
+                return True
+
+            self._flush()
+            if not self.storage.compare_and_set(key, expected, value):
+                return False
+            self._state[key] = value
+            return True
+
+    def _set(self, key: str, value: Any) -> None:
+        self._state[key] = value
+        self._unsaved[key] = value
+        self._updates += 1
+        if self._updates >= self.flush_every:
+            self._flush()
+
+    def _flush(self) -> None:
+        if self._unsaved:
+            self.storage.save_state(self._unsaved)
+            self._unsaved = {}
+        self._updates = 0
 
 
 class RedisStorage(BaseStorage):
@@ -77,16 +173,82 @@ class RedisStorage(BaseStorage):
     принимает на вход объект соединения с Redis. Всё остальное остаётся
     таким же: нужно читать и записывать состояние. Для тестирования
     используйте файл с тестами Python💾.
+
+    Each key is a field of the `key` hash, so saving one checkpoint doesn't
+    touch the others. Reads are served from a local cache for `cache_ttl`
+    seconds. State saved by the old single-key format under `"data"`
+    is read for the keys the hash doesn't have yet.
     """
 
-    def __init__(self, redis_adapter: Redis):
+    shared = True
+
+    def __init__(self,
+                 redis_adapter: Redis,
+                 key: str = 'etl_state',
+                 cache_ttl: float = 1.0):
         self.redis_adapter = redis_adapter
+        self.key = key
+        self.cache_ttl = cache_ttl
+        self._cache: Optional[dict] = None
+        self._cached_at = 0.0
 
     def save_state(self, state: dict):
-        self.redis_adapter.set("data", json.dumps(state))
+        pipeline = self.redis_adapter.pipeline()
+        for key, value in state.items():
+            pipeline.hset(self.key, key, json.dumps(value))
+        pipeline.execute()
+
+        if self._cache is not None:
+            self._cache.update(state)
 
     def retrieve_state(self) -> dict:
-        data = self.redis_adapter.get("data")
-        if data:
-            return json.loads(data)
-        return {}
+        if self._cache is not None \
+                and time.monotonic() - self._cached_at < self.cache_ttl:
+            return dict(self._cache)
+
+        fields = self.redis_adapter.hgetall(self.key)
+        state = {**self._legacy_state(),
+                 **{decode(key): json.loads(value)
+                    for key, value in fields.items()}}
+
+        self._cache = state
+        self._cached_at = time.monotonic()
+        return dict(state)
+
+    def compare_and_set(self, key: str, expected: Any, value: Any) -> bool:
+        """
+        Uses `WATCH`/`MULTI`: the write is dropped by Redis if another
+        client changed the hash after it was read.
+        """
+        with self.redis_adapter.pipeline() as pipeline:
+            try:
+                pipeline.watch(self.key)
+                current = pipeline.hget(self.key, key)
+                if current is not None:
+                    current = json.loads(current)
+                else:
+                    # Not saved since the old format, see `retrieve_state`
+                    current = self._legacy_state().get(key)
+                if current != expected:
+                    pipeline.unwatch()
+                    self._cache = None
+                    return False
+
+                pipeline.multi()
+                pipeline.hset(self.key, key, json.dumps(value))
+                pipeline.execute()
+            except WatchError:
+                self._cache = None
+                return False
+
+        if self._cache is not None:
+            self._cache[key] = value
+        return True
+
+    def _legacy_state(self) -> dict:
+        legacy_data = self.redis_adapter.get('data')
+        return json.loads(legacy_data) if legacy_data else {}
+
+
+def decode(value: Any) -> str:
+    return value.decode() if isinstance(value, bytes) else value
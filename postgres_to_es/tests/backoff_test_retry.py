@@ -0,0 +1,209 @@
+import inspect
+import logging
+import re
+import sys
+
+sys.path.append('../postgres_to_es')
+import backoff as backoff_module  # noqa: E402
+from backoff import CircuitBreaker, backoff  # noqa: E402
+
+logging.disable(logging.WARNING)
+
+
+class Clock:
+    """
+    Время для `time.monotonic`, которое двигает только `sleep`.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def patch_clock():
+    clock = Clock()
+    backoff_module.time.monotonic = clock.monotonic
+    backoff_module.sleep = clock.sleep
+    # Пауза всегда равна своей границе
+    backoff_module.random.uniform = lambda low, high: high
+    return clock
+
+
+def failing(errors, result='ok'):
+    """
+    Функция, которая бросает `errors` по одной, а потом возвращает
+    `result`.
+    """
+    errors = list(errors)
+    calls = []
+
+    def func():
+        calls.append(1)
+        if errors:
+            raise errors.pop(0)
+        return result
+
+    return func, calls
+
+
+def test_permanent_error_raised_at_once():
+    clock = patch_clock()
+    func, calls = failing([ValueError('bug')])
+
+    try:
+        backoff()(func)()
+    except ValueError:
+        assert len(calls) == 1
+        assert clock.sleeps == []
+        return
+
+    assert False
+
+
+def test_transient_error_retried():
+    clock = patch_clock()
+    func, calls = failing([ConnectionError(), TimeoutError()])
+
+    assert backoff(start_sleep_time=1, factor=2)(func)() == 'ok'
+    assert len(calls) == 3
+    assert clock.sleeps == [1, 2]
+
+
+def test_retries_stop_at_deadline():
+    clock = patch_clock()
+    func, calls = failing([ConnectionError()] * 100)
+
+    try:
+        backoff(start_sleep_time=1, factor=2, border_sleep_time=4,
+                deadline=10)(func)()
+    except ConnectionError:
+        # 1 + 2 + 4 = 7, ещё 4 секунды вышли бы за дедлайн
+        assert clock.sleeps == [1, 2, 4]
+        assert len(calls) == 4
+        return
+
+    assert False
+
+
+def test_generator_restarted_before_first_item():
+    clock = patch_clock()
+    calls = []
+
+    def generate():
+        calls.append(1)
+        if len(calls) == 1:
+            raise ConnectionError()
+        yield from [1, 2]
+
+    assert list(backoff()(generate)()) == [1, 2]
+    assert len(calls) == 2
+    assert len(clock.sleeps) == 1
+
+
+def test_generator_error_after_item_raised():
+    clock = patch_clock()
+    calls = []
+    items = []
+
+    def generate():
+        calls.append(1)
+        yield 1
+        raise ConnectionError()
+
+    try:
+        for item in backoff()(generate)():
+            items.append(item)
+    except ConnectionError:
+        assert items == [1]
+        assert len(calls) == 1
+        assert clock.sleeps == []
+        return
+
+    assert False
+
+
+def test_breaker_opens_at_threshold():
+    clock = patch_clock()
+    breaker = CircuitBreaker('test_threshold', failure_threshold=3,
+                             reset_timeout=30)
+
+    breaker.record(ConnectionError())
+    breaker.record(ValueError('permanent errors reset the count'))
+    breaker.record(ConnectionError())
+    breaker.record(ConnectionError())
+
+    assert not breaker.is_open
+    assert breaker.allow()
+
+    breaker.record(ConnectionError())
+
+    assert breaker.is_open
+    assert not breaker.allow()
+
+    clock.now += 29
+
+    assert not breaker.allow()
+
+
+def test_breaker_trial_reopens_and_closes():
+    clock = patch_clock()
+    breaker = CircuitBreaker('test_trial', failure_threshold=1,
+                             reset_timeout=30)
+    breaker.record(ConnectionError())
+
+    clock.now += 30
+
+    assert not breaker.is_open
+    assert breaker.allow()
+    # Пробный вызов один
+    assert not breaker.allow()
+
+    breaker.record(ConnectionError())
+
+    assert breaker.is_open
+    assert not breaker.allow()
+
+    clock.now += 30
+
+    assert breaker.allow()
+
+    breaker.record()
+
+    assert not breaker.is_open
+    assert breaker.allow()
+    assert breaker.allow()
+
+
+def test_open_breaker_stops_calls():
+    clock = patch_clock()
+    breaker = CircuitBreaker('test_calls', failure_threshold=2,
+                             reset_timeout=100)
+    func, calls = failing([ConnectionError()] * 100)
+
+    try:
+        backoff(start_sleep_time=1, border_sleep_time=1, deadline=10,
+                breaker=breaker)(func)()
+    except backoff_module.CircuitOpenError:
+        # После двух ошибок цепь разомкнута, функция больше не вызывается
+        assert len(calls) == 2
+        assert len(clock.sleeps) == 10
+        return
+
+    assert False
+
+
+def run_tests(pattern='test_*'):
+    search_pattern = re.compile(pattern)
+    for name, func in inspect.getmembers(sys.modules[__name__]):
+        if search_pattern.match(name):
+            func()
+
+
+run_tests()
@@ -0,0 +1,151 @@
+import inspect
+import queue
+import re
+import sys
+import threading
+from collections import Counter
+
+sys.path.append('../postgres_to_es')
+from adaptive import AdaptiveBatchSize  # noqa: E402
+from coalescer import Coalescer, InFlight  # noqa: E402
+from scheduler import Batch, Worker  # noqa: E402
+
+
+def new_coalescer(chunk_size, in_flight=None):
+    return Coalescer(queue.Queue(), queue.Queue(), threading.Event(),
+                     window_seconds=0.1, window_size=100,
+                     chunk_size=AdaptiveBatchSize('test', chunk_size,
+                                                  1, 100, 1),
+                     in_flight=in_flight)
+
+
+def send(coalescer, film_work_ids):
+    """
+    Отправляет id фильмов одного пакета, как `Producer`.
+    """
+    batch = Batch()
+    batch.add(len(film_work_ids))
+    coalescer.input_queue.put((film_work_ids, batch))
+    batch.seal()
+    return batch
+
+
+def window(coalescer):
+    """
+    Проводит одно окно и возвращает чанки для воркеров.
+    """
+    coalescer.collect()
+    coalescer.flush()
+    chunks = []
+    while not coalescer.output_queue.empty():
+        chunks.append(coalescer.output_queue.get())
+    return chunks
+
+
+def coalesce(chunk_size, *batches_ids):
+    """
+    Проводит пакеты через одно окно `Coalescer` и возвращает их и чанки
+    для воркеров.
+    """
+    coalescer = new_coalescer(chunk_size)
+    batches = [send(coalescer, film_work_ids) for film_work_ids in batches_ids]
+    return batches, window(coalescer)
+
+
+def loaded(batch):
+    return batch.wait(timeout=0)
+
+
+def test_shared_id_sent_once():
+    _, chunks = coalesce(100, ['a', 'b'], ['b', 'c'])
+
+    assert [chunk for chunk, _ in chunks] == [['a', 'b', 'c']]
+
+
+def test_batches_loaded_after_every_chunk():
+    (first, second), chunks = coalesce(1, ['a', 'b'], ['b', 'c'])
+    chunks = {chunk[0]: counter for chunk, counter in chunks}
+
+    Worker.acknowledge(chunks['a'])
+
+    # Id `b` первого пакета ещё не загружен
+    assert not loaded(first)
+
+    Worker.acknowledge(chunks['b'])
+
+    assert loaded(first) and not first.failed
+    assert not loaded(second)
+
+    Worker.acknowledge(chunks['c'])
+
+    assert loaded(second) and not second.failed
+
+
+def test_failed_shared_id_fails_both_batches():
+    (first, second), chunks = coalesce(1, ['a', 'b'], ['b', 'c'])
+    chunks = {chunk[0]: counter for chunk, counter in chunks}
+
+    Worker.acknowledge(chunks['b'], failed=True)
+
+    assert not loaded(first)
+    assert not loaded(second)
+
+    # Загруженные потом id не отменяют ошибку
+    Worker.acknowledge(chunks['a'])
+    Worker.acknowledge(chunks['c'])
+
+    assert loaded(first) and first.failed
+    assert loaded(second) and second.failed
+
+
+def test_failed_chunk_fails_only_its_batch():
+    (first, second), chunks = coalesce(2, ['a', 'b'], ['b', 'c'])
+
+    assert [chunk for chunk, _ in chunks] == [['a', 'b'], ['c']]
+
+    Worker.acknowledge(chunks[0][1])
+    Worker.acknowledge(chunks[1][1], failed=True)
+
+    assert loaded(first) and not first.failed
+    assert loaded(second) and second.failed
+
+
+def test_id_in_flight_held_back():
+    # Общий с воркерами, пока пустой
+    in_flight = InFlight()
+    coalescer = new_coalescer(100, in_flight)
+    first = send(coalescer, ['a', 'b'])
+    [(chunk, counter)] = window(coalescer)
+
+    assert chunk == ['a', 'b']
+
+    # Id `a` ещё загружается, пока приходит его новая версия
+    second = send(coalescer, ['a', 'c'])
+    [(chunk, counter)] = window(coalescer)
+
+    assert chunk == ['c']
+    assert window(coalescer) == []
+
+    Worker.acknowledge(counter)
+
+    assert not loaded(second)
+
+    in_flight.release(['a', 'b'])
+    Worker.acknowledge(Counter({first: 2}))
+    [(chunk, counter)] = window(coalescer)
+
+    assert chunk == ['a']
+
+    Worker.acknowledge(counter)
+
+    assert loaded(first) and loaded(second)
+
+
+def run_tests(pattern='test_*'):
+    search_pattern = re.compile(pattern)
+    for name, func in inspect.getmembers(sys.modules[__name__]):
+        if search_pattern.match(name):
+            func()
+
+
+run_tests()
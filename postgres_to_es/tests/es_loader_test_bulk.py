@@ -0,0 +1,116 @@
+import inspect
+import re
+import sys
+
+sys.path.append('../postgres_to_es')
+import es_loader  # noqa: E402
+from es_loader import Document, save_to_elastic  # noqa: E402
+
+# Повторные попытки без пауз
+es_loader.time.sleep = lambda seconds: None
+
+
+class FakeElastic:
+    """
+    Отвечает на каждый bulk-запрос следующим ответом из `responses`
+    и запоминает id документов в запросах.
+    """
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def bulk(self, body, filter_path=None):
+        lines = body.decode().splitlines()
+        self.requests.append([es_loader.orjson.loads(line)
+                              for line in lines if '"_id"' in line])
+        return self.responses.pop(0)
+
+
+def item(op, _id, status, error=None):
+    result = {'_id': _id, 'status': status}
+    if error:
+        result['error'] = {'type': error}
+    return {op: result}
+
+
+def documents(*ids):
+    return [Document('movies', _id, '{"title": "%s"}' % _id) for _id in ids]
+
+
+def test_permanent_failure_kept_after_retry():
+    es_client = FakeElastic([
+        {'errors': True, 'items': [
+            item('index', 'a', 400, 'mapper_parsing_exception'),
+            item('index', 'b', 429, 'es_rejected_execution_exception'),
+            item('index', 'c', 201),
+        ]},
+        {'errors': False, 'items': [item('index', 'b', 201)]},
+    ])
+
+    failed = save_to_elastic(es_client, documents('a', 'b', 'c'))
+
+    assert failed == [item('index', 'a', 400, 'mapper_parsing_exception')]
+    assert len(es_client.requests) == 2
+    assert [next(iter(action.values()))['_id']
+            for action in es_client.requests[1]] == ['b']
+
+
+def test_missing_update_kept_after_retry():
+    es_client = FakeElastic([
+        {'errors': True, 'items': [
+            item('update', 'a', 404, 'document_missing_exception'),
+            item('update', 'b', 503),
+        ]},
+        {'errors': False, 'items': [item('update', 'b', 200)]},
+    ])
+    partial = [document._replace(partial=True)
+               for document in documents('a', 'b')]
+
+    failed = save_to_elastic(es_client, partial)
+
+    assert failed == [item('update', 'a', 404, 'document_missing_exception')]
+
+
+def test_transient_failure_left_after_last_retry():
+    rejected = {'errors': True, 'items': [
+        item('index', 'a', 429, 'es_rejected_execution_exception')]}
+    es_client = FakeElastic(
+        [rejected] * (es_loader.ES_BULK_MAX_RETRIES + 1))
+
+    failed = save_to_elastic(es_client, documents('a'))
+
+    assert failed == rejected['items']
+    assert len(es_client.requests) == es_loader.ES_BULK_MAX_RETRIES + 1
+
+
+def count(label):
+    return es_loader.DOCUMENTS.labels(label)._value.get()
+
+
+def test_failures_counted_by_op():
+    es_client = FakeElastic([{'errors': True, 'items': [
+        item('index', 'a', 201),
+        item('index', 'b', 400, 'mapper_parsing_exception'),
+        item('delete', 'c', 409, 'version_conflict_engine_exception'),
+    ]}])
+    before = {label: count(label)
+              for label in ('indexed', 'deleted', 'failed')}
+
+    save_to_elastic(es_client, documents('a', 'b')
+                    + [Document('movies', 'c', None)])
+
+    # Неудачное удаление не вычитается из проиндексированных
+    assert count('indexed') - before['indexed'] == 1
+    assert count('deleted') - before['deleted'] == 0
+    assert count('failed') - before['failed'] == 2
+
+
+def run_tests(pattern='test_*'):
+    search_pattern = re.compile(pattern)
+    for name, func in inspect.getmembers(sys.modules[__name__]):
+        if search_pattern.match(name):
+            func()
+
+
+run_tests()
@@ -0,0 +1,195 @@
+import inspect
+import os
+import re
+import sys
+import tempfile
+import threading
+
+sys.path.append('../postgres_to_es')
+from es_loader import Document  # noqa: E402
+from spool import Position, Spool, encode  # noqa: E402
+from state import JsonFileStorage, State  # noqa: E402
+
+
+def open_spool(directory, **kwargs):
+    state = State(JsonFileStorage(os.path.join(directory, 'state.json')))
+    return Spool(os.path.join(directory, 'spool'), state, **kwargs)
+
+
+def document(_id, version=1, partial=False):
+    return Document('movies', _id, '{"version": %s}' % version, partial)
+
+
+def deletion(_id):
+    return Document('movies', _id, None)
+
+
+def segments(spool):
+    return sorted(name for name in os.listdir(spool.directory)
+                  if name.endswith('.spool'))
+
+
+def read_all(spool):
+    reads = []
+    while True:
+        documents = spool.read(100, timeout=0)
+        if not documents:
+            return reads
+        reads.append(documents)
+
+
+def test_read_and_commit():
+    spool = open_spool(tempfile.mkdtemp(), segment_bytes=1)
+    for _id in 'abc':
+        spool.append([document(_id)])
+
+    assert len(segments(spool)) == 3
+    assert read_all(spool) == [[document('a'), document('b'),
+                                document('c')]]
+
+    spool.commit()
+
+    # The segment being written is kept
+    assert len(segments(spool)) == 1
+    assert spool.state.get_state('spool') == {'segment': 2,
+                                              'offset': spool.stats()['bytes']}
+    assert read_all(spool) == []
+
+
+def test_film_work_once_per_read():
+    spool = open_spool(tempfile.mkdtemp())
+    spool.append([document('a'), document('b'), document('a', 2),
+                  deletion('b')])
+
+    assert read_all(spool) == [[document('a'), document('b')],
+                               [document('a', 2), deletion('b')]]
+
+
+def test_rewind():
+    spool = open_spool(tempfile.mkdtemp())
+    spool.append([document('a'), document('b')])
+    spool.read(1, timeout=0)
+    spool.commit()
+
+    assert spool.read(100, timeout=0) == [document('b')]
+
+    spool.rewind()
+
+    assert spool.read(100, timeout=0) == [document('b')]
+
+
+def test_torn_line_is_cut():
+    directory = tempfile.mkdtemp()
+    spool = open_spool(directory)
+    spool.append([document('a'), document('b')])
+    size = spool.stats()['bytes']
+    spool.close()
+    with open(spool.path(0), 'ab') as f:
+        f.write(b'{"index": "movies", "id": "c", "par')
+
+    spool = open_spool(directory)
+
+    assert spool.stats()['bytes'] == size
+    assert read_all(spool) == [[document('a'), document('b')]]
+
+    spool.append([document('c')])
+
+    assert read_all(spool) == [[document('c')]]
+
+
+def test_resume_after_crash_before_segments_deleted():
+    directory = tempfile.mkdtemp()
+    spool = open_spool(directory, segment_bytes=1)
+    for _id in 'abc':
+        spool.append([document(_id)])
+    spool.read(2, timeout=0)
+    # The position is saved, the crash comes before the loaded
+    # segments are deleted
+    spool.state.set_state('spool', Position(2, 0)._asdict())
+    spool.close()
+
+    spool = open_spool(directory, segment_bytes=1)
+
+    assert len(segments(spool)) == 1
+    assert read_all(spool) == [[document('c')]]
+
+
+def test_resume_when_segment_of_position_deleted():
+    directory = tempfile.mkdtemp()
+    spool = open_spool(directory, segment_bytes=1)
+    for _id in 'abc':
+        spool.append([document(_id)])
+    spool.state.set_state('spool', Position(0, 10)._asdict())
+    spool.close()
+    os.remove(spool.path(0))
+
+    spool = open_spool(directory, segment_bytes=1)
+
+    assert read_all(spool) == [[document('b'), document('c')]]
+
+
+def test_compaction():
+    spool = open_spool(tempfile.mkdtemp(), segment_bytes=1)
+    for documents in ([document('c')], [document('a')], [document('b')],
+                      [document('a', 2)], [document('a', 3, partial=True)],
+                      [deletion('b')]):
+        spool.append(documents)
+
+    spool._compact()
+
+    # The superseded full documents are dropped, the partial update
+    # after the last full document is kept
+    assert spool.stats()['compacted_documents'] == 2
+    assert read_all(spool) == [[document('c'), document('a', 2)],
+                               [document('a', 3, partial=True),
+                                deletion('b')]]
+
+
+def test_segment_must_fit_in_spool():
+    try:
+        open_spool(tempfile.mkdtemp(), segment_bytes=100, max_bytes=100)
+    except ValueError:
+        return
+
+    assert False
+
+
+def test_full_spool_with_one_segment_drained():
+    size = len(encode(document('a')))
+    spool = open_spool(tempfile.mkdtemp(), segment_bytes=3 * size,
+                       max_bytes=3 * size + 1)
+    spool.append([document('a'), document('b'), document('c')])
+
+    # Всё непрочитанное лежит в сегменте, в который идёт запись
+    writer = threading.Thread(target=spool.append, args=([document('d')],))
+    writer.start()
+    assert read_all(spool) == [[document('a'), document('b'),
+                                document('c')]]
+    spool.commit()
+    writer.join(5)
+
+    assert not writer.is_alive()
+    assert read_all(spool) == [[document('d')]]
+    assert len(segments(spool)) == 1
+
+
+def test_pending_bytes():
+    size = len(encode(document('a')))
+    spool = open_spool(tempfile.mkdtemp(), segment_bytes=2 * size)
+    spool.append([document('a'), document('b')])
+    spool.append([document('c')])
+    spool.read(1, timeout=0)
+    spool.commit()
+
+    assert len(segments(spool)) == 2
+    assert spool.stats()['pending_bytes'] == 2 * size
+
+
+def run_tests(pattern='test_*'):
+    search_pattern = re.compile(pattern)
+    for name, func in inspect.getmembers(sys.modules[__name__]):
+        if search_pattern.match(name):
+            func()
+
+
+run_tests()
@@ -0,0 +1,57 @@
+import inspect
+import json
+import os
+import re
+import sys
+import tempfile
+
+sys.path.append('../postgres_to_es')
+from state import JsonFileStorage, State  # noqa: E402
+
+
+def storage_file():
+    directory = tempfile.mkdtemp()
+    return os.path.join(directory, 'state.json')
+
+
+def read(file_path):
+    with open(file_path) as f:
+        content = f.read()
+    return json.loads(content) if content else {}
+
+
+def test_storage_compare_and_set():
+    file_path = storage_file()
+    storage = JsonFileStorage(file_path)
+    storage.save_state({'key': 1, 'other': 10})
+
+    assert storage.compare_and_set('key', 1, 2)
+    assert not storage.compare_and_set('key', 1, 3)
+    assert not storage.compare_and_set('missing', 1, 3)
+    assert storage.compare_and_set('missing', None, 3)
+    assert read(file_path) == {'key': 2, 'other': 10, 'missing': 3}
+
+
+def test_compare_and_set_is_buffered():
+    file_path = storage_file()
+    state = State(JsonFileStorage(file_path), flush_every=3)
+
+    assert state.compare_and_set('key', None, 1)
+    assert state.compare_and_set('key', 1, 2)
+    assert not state.compare_and_set('key', 1, 3)
+    assert read(file_path) == {}
+
+    state.flush()
+
+    assert read(file_path) == {'key': 2}
+    assert State(JsonFileStorage(file_path)).get_state('key') == 2
+
+
+def run_tests(pattern='test_*'):
+    search_pattern = re.compile(pattern)
+    for name, func in inspect.getmembers(sys.modules[__name__]):
+        if search_pattern.match(name):
+            func()
+
+
+run_tests()
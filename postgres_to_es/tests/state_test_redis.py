@@ -3,6 +3,8 @@ import re
 import sys
 from json import JSONDecodeError
 
+from redis.exceptions import WatchError
+
 sys.path.append('../postgres_to_es')
 from state import RedisStorage, State
 
@@ -12,12 +14,78 @@ from state import RedisStorage, State
 class FakeRedis:
     def __init__(self):
         self.data = {}
+        self.versions = {}
+        # Вызывается в WATCH, чтобы сымитировать запись другого клиента
+        self.on_watch = None
 
     def get(self, name):
         return self.data.get(name)
 
     def set(self, name, value):
         self.data[name] = value
+        self.versions[name] = self.versions.get(name, 0) + 1
+
+    def hget(self, name, key):
+        return self.data.get(name, {}).get(key)
+
+    def hset(self, name, key, value):
+        self.data.setdefault(name, {})[key] = value
+        self.versions[name] = self.versions.get(name, 0) + 1
+
+    def hgetall(self, name):
+        return dict(self.data.get(name, {}))
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    """
+    Команды копятся до `execute()`. После `watch()` они выполняются сразу,
+    пока не вызван `multi()`, как в redis-py.
+    """
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+        self.watched = None
+        self.buffered = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.commands = []
+
+    def watch(self, name):
+        self.watched = (name, self.redis.versions.get(name, 0))
+        self.buffered = False
+        if self.redis.on_watch:
+            self.redis.on_watch()
+
+    def unwatch(self):
+        self.watched = None
+
+    def multi(self):
+        self.buffered = True
+
+    def hget(self, name, key):
+        return self.redis.hget(name, key)
+
+    def hset(self, name, key, value):
+        if not self.buffered:
+            return self.redis.hset(name, key, value)
+        self.commands.append((name, key, value))
+        return self
+
+    def execute(self):
+        if self.watched:
+            name, version = self.watched
+            if self.redis.versions.get(name, 0) != version:
+                raise WatchError()
+        for command in self.commands:
+            self.redis.hset(*command)
+        self.commands = []
 
 
 def test_get_empty_state():
@@ -35,7 +103,7 @@ def test_save_new_state():
 
     state.set_state('key', 123)
 
-    assert redis_adapter.data == {'data': '{"key": 123}'}
+    assert redis_adapter.data == {'etl_state': {'key': '123'}}
 
 
 def test_retrieve_existing_state():
@@ -64,6 +132,87 @@ def test_save_state_and_retrieve():
     assert state.get_state('key') == 123
 
 
+def test_keys_saved_separately():
+    redis_adapter = FakeRedis()
+    state = State(RedisStorage(redis_adapter))
+
+    state.set_state('person', {'modified': '2022-01-01', 'id': '1'})
+    state.set_state('genre', {'modified': '2022-02-02', 'id': '2'})
+
+    state = State(RedisStorage(redis_adapter))
+
+    assert state.get_state('person') == {'modified': '2022-01-01', 'id': '1'}
+    assert state.get_state('genre') == {'modified': '2022-02-02', 'id': '2'}
+
+
+def test_buffered_state_is_flushed():
+    redis_adapter = FakeRedis()
+    state = State(RedisStorage(redis_adapter), flush_every=3)
+
+    state.set_state('key', 1)
+    state.set_state('key', 2)
+
+    assert redis_adapter.data == {}
+
+    state.flush()
+
+    assert redis_adapter.data == {'etl_state': {'key': '2'}}
+
+
+def test_compare_and_set():
+    redis_adapter = FakeRedis()
+    state = State(RedisStorage(redis_adapter))
+    state.set_state('key', 1)
+
+    assert state.compare_and_set('key', 1, 2)
+    assert not state.compare_and_set('key', 1, 3)
+    assert state.get_state('key') == 2
+    assert redis_adapter.data == {'etl_state': {'key': '2'}}
+
+
+def test_compare_and_set_on_concurrent_write():
+    redis_adapter = FakeRedis()
+    storage = RedisStorage(redis_adapter)
+    storage.save_state({'key': 1})
+
+    def another_worker_writes():
+        redis_adapter.on_watch = None
+        RedisStorage(redis_adapter).save_state({'key': 5})
+
+    redis_adapter.on_watch = another_worker_writes
+
+    assert not storage.compare_and_set('key', 5, 6)
+    assert storage.retrieve_state() == {'key': 5}
+
+
+def test_compare_and_set_on_legacy_state():
+    redis_adapter = FakeRedis()
+    redis_adapter.data = {'data': '{"key": 1, "other": 10}'}
+    state = State(RedisStorage(redis_adapter, cache_ttl=0))
+
+    assert state.compare_and_set('key', 1, 2)
+
+    state = State(RedisStorage(redis_adapter))
+
+    assert state.get_state('key') == 2
+    assert state.get_state('other') == 10
+
+
+def test_state_sees_other_process_checkpoints():
+    redis_adapter = FakeRedis()
+    state = State(RedisStorage(redis_adapter, cache_ttl=0))
+    another_state = State(RedisStorage(redis_adapter, cache_ttl=0))
+
+    assert state.get_state('key') is None
+
+    another_state.set_state('key', 1)
+
+    assert state.get_state('key') == 1
+    assert not state.compare_and_set('key', None, 2)
+    assert state.compare_and_set('key', 1, 2)
+    assert another_state.get_state('key') == 2
+
+
 def test_error_on_corrupted_data():
     try:
         redis_adapter = FakeRedis()